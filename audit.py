@@ -0,0 +1,156 @@
+'''
+# Password Audit
+
+Checks every stored password against a list of candidate passwords, such
+as a breached password list, to find the users who should change theirs.
+
+Records written by earlier versions hold a bare sha256 hexdigest, so each
+candidate is hashed once and those records are matched by looking their
+digest up. Salted hashes have to be derived for every pair of record and
+candidate, so that work is spread over a process pool, split by users
+and by slices of the candidate list, and matches are yielded as they are
+found.
+'''
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from hashlib import sha256
+
+from hashing import LEGACY_SCHEME, hash_scheme, verify_password
+from store import CredentialStore
+
+
+# candidates checked by a worker process, set once when it starts
+_candidates = []
+
+
+def _start_worker(candidates: list[str]) -> None:
+    '''
+    Keeps the candidates in a worker process, so they are sent once per
+    worker rather than with every task.
+    '''
+
+    global _candidates
+    _candidates = candidates
+
+    return
+
+
+def _check_records(records: list[tuple[str, str]], start: int,
+                   stop: int) -> list[tuple[str, str]]:
+    '''
+    Returns `(username_hash, password)` for each record whose salted hash
+    matches one of the candidates from `start` to `stop`.
+    '''
+
+    matches = []
+    for username_hash, stored_hash in records:
+        for candidate in _candidates[start:stop]:
+            if verify_password(candidate, stored_hash):
+                matches.append((username_hash, candidate))
+                break
+
+    return matches
+
+
+def legacy_digests(candidates: list[str]) -> dict[str, str]:
+    '''
+    Returns each candidate by the bare sha256 hexdigest earlier versions
+    stored for it.
+    '''
+
+    return {
+        sha256(candidate.encode()).hexdigest(): candidate
+        for candidate in candidates
+    }
+
+
+def audit_passwords(store: CredentialStore, candidates: list[str],
+                    workers: int | None = None, chunk_size: int = 8):
+    '''
+    Yields `(username_hash, password)` for every user whose password is
+    one of `candidates`, in the order they are found.
+
+    Salted hashes are checked `chunk_size` users at a time on `workers`
+    processes, defaulting to the number of CPUs. Each chunk is split
+    across the candidates too, so every worker has a share even when
+    there are only a few users. Records whose hash cannot be read are
+    skipped.
+    '''
+
+    candidates = list(dict.fromkeys(candidates))
+    if not candidates:
+        return
+
+    workers = workers or os.cpu_count() or 1
+    legacy = legacy_digests(candidates)
+
+    # candidates checked by each task, so one chunk keeps every worker busy
+    slice_size = -(-len(candidates) // workers)
+    slices = [
+        (start, min(start + slice_size, len(candidates)))
+        for start in range(0, len(candidates), slice_size)
+    ]
+
+    # the pool is only started once there is salted work for it
+    pool = None
+    pending = set()
+    chunk = []
+
+    def submit(records: list[tuple[str, str]]) -> None:
+        nonlocal pool
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                workers,
+                initializer=_start_worker,
+                initargs=(candidates,)
+            )
+        for start, stop in slices:
+            pending.add(pool.submit(_check_records, records, start, stop))
+
+        return
+
+    def collect(block: bool):
+        nonlocal pending
+        done, pending = wait(
+            pending,
+            timeout=None if block else 0,
+            return_when=FIRST_COMPLETED
+        )
+        for future in done:
+            yield from future.result()
+
+        return
+
+    try:
+        for username_hash, record in store.items():
+            try:
+                scheme = hash_scheme(record.password)[0]
+            except ValueError:
+                continue
+
+            # legacy digests are unsalted, so one lookup checks them all
+            if scheme == LEGACY_SCHEME:
+                if record.password in legacy:
+                    yield username_hash, legacy[record.password]
+                continue
+
+            chunk.append((username_hash, record.password))
+            if len(chunk) >= chunk_size:
+                submit(chunk)
+                chunk = []
+
+                # bound the tasks waiting, and hand back what is done
+                yield from collect(block=False)
+                while len(pending) >= 4 * workers:
+                    yield from collect(block=True)
+
+        if chunk:
+            submit(chunk)
+        while pending:
+            yield from collect(block=True)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return
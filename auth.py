@@ -0,0 +1,507 @@
+'''
+# Auth Service
+
+Authentication and account management for `login.Login`, without any
+terminal input or output.
+
+Every operation returns an `AuthResult` instead of printing, so the same
+rules can be driven by the interactive `Login` flows, a server or a
+script.
+'''
+
+from hashlib import sha256
+
+from changefeed import ChangeFeed
+from hashing import PasswordHasher
+from metrics import metrics
+from ratelimit import RateLimiter
+from sessions import SessionManager
+from store import (RECORD_FIELDS, ConflictError, CredentialStore,
+                   DuplicateEmailError, FieldTooLongError, RecordExistsError,
+                   UserRecord)
+from validation import ValidationPolicy, default_policy
+
+
+# user facing text for each result code
+MESSAGES = {
+    'ok': 'Success.',
+    'username_blank': 'Field blank, please enter a username.',
+    'field_invalid': 'Field must be text, please try again.',
+    'field_too_long': 'Field is too long, please try again.',
+    'account_missing': 'Account does not exist, please try again.',
+    'account_exists': 'Account already exists, please use a different name.',
+    'password_incorrect': 'Password is incorrect, please try again.',
+    'email_invalid': 'Email is invalid, please try again.',
+    'email_taken': 'Email is already in use, please use a different one.',
+    'password_short': 'Password must be 8 or more characters, please try again.',
+    'password_no_upper': 'Password needs an uppercase, please try again.',
+    'password_no_lower': 'Password needs a lowercase, please try again.',
+    'password_no_number': 'Password needs a number, please try again.',
+    'password_breached': 'Password is known from a data breach, please '
+        'choose another.',
+    'conflict': 'Account was changed elsewhere, please try again.',
+    'session_invalid': 'Session has expired, please log in again.',
+    'rate_limited': 'Too many incorrect attempts, please try again later.'
+}
+
+
+class AuthResult:
+    '''
+    Outcome of an `AuthService` operation.
+
+    `code` is `'ok'` on success, or one of the keys of `MESSAGES`
+    describing why the operation failed. `profile` holds the display name
+    and email address of the user, where the operation looked them up,
+    and `token` the session token issued by a successful login.
+
+    A plain class rather than a dataclass, as importing `dataclasses`
+    costs more than the rest of startup.
+    '''
+
+    __slots__ = ('code', 'username_hash', 'profile', 'token')
+
+    def __init__(self, code: str = 'ok', username_hash: str | None = None,
+                 profile: dict | None = None,
+                 token: str | None = None) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.code = code
+        self.username_hash = username_hash
+        self.profile = profile
+        self.token = token
+
+        return
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, AuthResult):
+            return NotImplemented
+
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'AuthResult(code={self.code!r}, '
+            f'username_hash={self.username_hash!r})'
+        )
+
+    @property
+    def ok(self) -> bool:
+        return self.code == 'ok'
+
+    @property
+    def message(self) -> str:
+        return MESSAGES[self.code]
+
+
+def hash_username(username: str) -> str:
+    '''
+    Returns the key a username is stored under.
+    '''
+
+    return sha256(username.encode()).hexdigest()
+
+
+def public_profile(record: UserRecord) -> dict:
+    '''
+    Returns the fields of a record that are safe to hand back to callers.
+    '''
+
+    return {
+        'display_name': record.display_name,
+        'email_address': record.email_address
+    }
+
+
+class AuthService:
+    '''
+    Collection of methods for authenticating users and changing their
+    accounts, on top of a `CredentialStore` and a `PasswordHasher`.
+
+    Given a `SessionManager`, a successful login also issues a session
+    token that can be passed to `resume()` instead of the password.
+
+    Failed password checks are counted per user and per client address
+    by a `RateLimiter`, and once either runs out further checks are
+    refused without hashing or reading the store. Callers that only
+    ever serve one person at a time, such as the interactive `Login`,
+    pass `client=None` so only the per user count applies.
+
+    Usernames, email addresses and passwords are checked against a
+    `ValidationPolicy`, the default rules unless another is given.
+
+    Given a `ChangeFeed`, every change made to an account is published
+    to it.
+    '''
+
+    def __init__(self, store: CredentialStore,
+                 hasher: PasswordHasher | None = None,
+                 sessions: SessionManager | None = None,
+                 limiter: RateLimiter | None = None,
+                 policy: ValidationPolicy | None = None,
+                 feed: ChangeFeed | None = None) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.store = store
+        self.hasher = hasher or PasswordHasher()
+        self.sessions = sessions
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.policy = policy or default_policy
+        self.feed = feed
+
+        return
+
+    def _publish(self, type: str, username_hash: str, fields=(),
+                 **details: str) -> None:
+        '''
+        Publishes a stored change to the feed, if there is one.
+        '''
+
+        if self.feed is not None:
+            self.feed.publish(type, username_hash, fields, **details)
+
+        return
+
+    @staticmethod
+    def _client_keys(client: str | None) -> tuple[str, ...]:
+        '''
+        Returns the rate limiter keys of a client address, none if the
+        client is not tracked.
+        '''
+
+        return () if client is None else (f'client:{client}',)
+
+    def _check_password(self, username_hash: str, password: str,
+                        client: str | None
+                        ) -> tuple[AuthResult, UserRecord | None]:
+        '''
+        Checks the password of a user, subject to the rate limiter, and
+        returns the result along with the user's record.
+        '''
+
+        user_key = f'user:{username_hash}'
+        client_keys = self._client_keys(client)
+
+        # refuse before doing any work
+        if self.limiter.retry_after(user_key, *client_keys) > 0:
+            metrics.increment('auth_failed_attempts_total', reason='rate_limited')
+            return AuthResult('rate_limited', username_hash), None
+
+        record = self.store.get(username_hash)
+        if record is None:
+            self.limiter.consume(*client_keys)
+            metrics.increment(
+                'auth_failed_attempts_total',
+                reason='account_missing'
+            )
+            return AuthResult('account_missing', username_hash), None
+
+        if not self.hasher.verify(password, record.password):
+            self.limiter.consume(user_key, *client_keys)
+            metrics.increment(
+                'auth_failed_attempts_total',
+                reason='password_incorrect'
+            )
+            return AuthResult('password_incorrect', username_hash), record
+
+        self.limiter.reset(user_key)
+
+        return AuthResult('ok', username_hash, public_profile(record)), record
+
+    def check_username(self, username: str,
+                       available: bool = False) -> AuthResult:
+        '''
+        Checks a username is valid and exists, or with `available` that
+        it is free to be taken.
+        '''
+
+        error = self.policy.validate_username(username)
+        if error:
+            return AuthResult(error)
+
+        username_hash = hash_username(username)
+        exists = username_hash in self.store
+        if available and exists:
+            return AuthResult('account_exists', username_hash)
+        elif not available and not exists:
+            return AuthResult('account_missing', username_hash)
+
+        return AuthResult('ok', username_hash)
+
+    def check_email(self, email_address: str,
+                    username_hash: str | None = None) -> AuthResult:
+        '''
+        Checks an email address is valid and not used by anyone other than
+        `username_hash`.
+        '''
+
+        error = self.policy.validate_email(email_address)
+        if error:
+            return AuthResult(error, username_hash)
+
+        owner = self.store.find_by_email(email_address)
+        if owner is not None and owner != username_hash:
+            return AuthResult('email_taken', username_hash)
+
+        return AuthResult('ok', username_hash)
+
+    def authenticate(self, username: str, password: str,
+                     client: str | None = 'local') -> AuthResult:
+        '''
+        Checks a username and password, sent from the `client` address.
+
+        A correct password stored with an outdated hash is rehashed in the
+        background.
+        '''
+
+        error = self.policy.validate_username(username)
+        if error:
+            return AuthResult(error)
+
+        username_hash = hash_username(username)
+        result, record = self._check_password(username_hash, password, client)
+        if not result.ok:
+            return result
+
+        # move the stored hash on to the current scheme and cost
+        if self.hasher.needs_rehash(record.password):
+            self.rehash(username_hash, record, password)
+
+        token = None
+        if self.sessions is not None:
+            token = self.sessions.issue(username_hash)
+
+        result.token = token
+
+        return result
+
+    def retry_after(self, username_hash: str,
+                    client: str | None = 'local') -> float:
+        '''
+        Returns how many seconds until a user may try their password again
+        from a client, or `0` if they may try now.
+        '''
+
+        return self.limiter.retry_after(
+            f'user:{username_hash}',
+            *self._client_keys(client)
+        )
+
+    def resume(self, token: str) -> AuthResult:
+        '''
+        Identifies the user a session token belongs to, without any
+        password hashing.
+        '''
+
+        if self.sessions is None:
+            return AuthResult('session_invalid')
+
+        username_hash = self.sessions.validate(token)
+        if username_hash is None:
+            return AuthResult('session_invalid')
+
+        return AuthResult('ok', username_hash, token=token)
+
+    def logout(self, token: str) -> AuthResult:
+        '''
+        Ends a session.
+        '''
+
+        if self.sessions is not None:
+            self.sessions.revoke(token)
+
+        return AuthResult('ok')
+
+    def verify(self, username_hash: str, password: str,
+               client: str | None = 'local') -> AuthResult:
+        '''
+        Checks the password of an already identified user.
+        '''
+
+        return self._check_password(username_hash, password, client)[0]
+
+    def rehash(self, username_hash: str, record: UserRecord,
+               password: str) -> None:
+        '''
+        Rehashes a verified password with the current hasher settings and
+        stores it in the background, only touching that user's record.
+        '''
+
+        def store_hash(password_future) -> None:
+            # skip if the record changed since the password was checked
+            try:
+                self.store.update(
+                    username_hash,
+                    expected_version=record.version,
+                    password=password_future.result()
+                )
+            except (ConflictError, KeyError):
+                return
+
+            self._publish('rehash', username_hash, ('password',))
+
+            return
+
+        self.hasher.submit_hash(password).add_done_callback(store_hash)
+
+        return
+
+    def register(self, username: str, display_name: str,
+                 email_address: str, password: str) -> AuthResult:
+        '''
+        Creates a new user.
+        '''
+
+        # check every field before doing any hashing
+        error = self.policy.validate(username, email_address, password)
+        if error:
+            return AuthResult(error)
+
+        username_hash = hash_username(username)
+        if username_hash in self.store:
+            return AuthResult('account_exists', username_hash)
+        if self.store.find_by_email(email_address) is not None:
+            return AuthResult('email_taken', username_hash)
+
+        record = UserRecord(
+            self.hasher.hash(password),
+            display_name,
+            email_address
+        )
+
+        # username or email may have been taken while hashing
+        try:
+            self.store.insert(username_hash, record)
+        except RecordExistsError:
+            return AuthResult('account_exists', username_hash)
+        except DuplicateEmailError:
+            return AuthResult('email_taken', username_hash)
+        except FieldTooLongError:
+            return AuthResult('field_too_long', username_hash)
+
+        self._publish('signup', username_hash, RECORD_FIELDS)
+
+        return AuthResult('ok', username_hash, public_profile(record))
+
+    def get_profile(self, username_hash: str) -> AuthResult:
+        '''
+        Looks up the display name and email address of a user.
+        '''
+
+        record = self.store.get(username_hash)
+        if record is None:
+            return AuthResult('account_missing', username_hash)
+
+        return AuthResult('ok', username_hash, public_profile(record))
+
+    def update_profile(self, username_hash: str,
+                       display_name: str | None = None,
+                       email_address: str | None = None) -> AuthResult:
+        '''
+        Changes the display name and/or email address of a user.
+        '''
+
+        # refuse anything but text before it can reach the store
+        for value in (display_name, email_address):
+            if value is not None and not isinstance(value, str):
+                return AuthResult('field_invalid', username_hash)
+
+        fields = {}
+        if display_name is not None:
+            fields['display_name'] = display_name
+        if email_address is not None:
+            error = self.policy.validate_email(email_address)
+            if error:
+                return AuthResult(error, username_hash)
+            fields['email_address'] = email_address
+
+        try:
+            self.store.update(username_hash, **fields)
+        except KeyError:
+            return AuthResult('account_missing', username_hash)
+        except DuplicateEmailError:
+            return AuthResult('email_taken', username_hash)
+        except FieldTooLongError:
+            return AuthResult('field_too_long', username_hash)
+
+        if fields:
+            self._publish('profile', username_hash, fields)
+
+        return self.get_profile(username_hash)
+
+    def change_password(self, username_hash: str, current_password: str,
+                        new_password: str,
+                        client: str | None = 'local') -> AuthResult:
+        '''
+        Changes the password of a user, after checking the current one.
+        '''
+
+        error = self.policy.validate_password(new_password)
+        if error:
+            return AuthResult(error, username_hash)
+
+        result, record = self._check_password(
+            username_hash,
+            current_password,
+            client
+        )
+        if not result.ok:
+            return result
+
+        # only store if nothing changed since the password was checked
+        try:
+            self.store.update(
+                username_hash,
+                expected_version=record.version,
+                password=self.hasher.hash(new_password)
+            )
+        except ConflictError:
+            return AuthResult('conflict', username_hash)
+        except KeyError:
+            return AuthResult('account_missing', username_hash)
+
+        self._publish('password', username_hash, ('password',))
+
+        # sessions started with the old password end with it
+        if self.sessions is not None:
+            self.sessions.revoke_user(username_hash)
+
+        return result
+
+    def rename(self, username_hash: str, new_username: str) -> AuthResult:
+        '''
+        Moves a user to a new username.
+        '''
+
+        error = self.policy.validate_username(new_username)
+        if error:
+            return AuthResult(error, username_hash)
+
+        new_username_hash = hash_username(new_username)
+        record = self.store.get(username_hash)
+        if record is None:
+            return AuthResult('account_missing', username_hash)
+
+        # move current user details to new username in one change
+        try:
+            self.store.rename(username_hash, new_username_hash, record.version)
+        except RecordExistsError:
+            return AuthResult('account_exists', username_hash)
+        except ConflictError:
+            return AuthResult('conflict', username_hash)
+        except KeyError:
+            return AuthResult('account_missing', username_hash)
+
+        self._publish('rename', username_hash, new_user=new_username_hash)
+
+        # sessions follow the user to their new username
+        if self.sessions is not None:
+            self.sessions.rename_user(username_hash, new_username_hash)
+
+        return AuthResult('ok', new_username_hash, public_profile(record))
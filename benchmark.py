@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+
+'''
+# Benchmark
+
+Measures how `login.Login` performs as the user database grows.
+
+For each backend and store size, a synthetic store is generated and then
+login, signup and each `account_options()` change are driven through the
+real `Login` flows with a `login.ScriptedInterface` feeding in the
+answers.
+`cold_login` reopens the store before each login, with nothing cached,
+as a new process would. Every case runs in a fresh process, and reports
+for each operation:
+
+    ops_per_sec, p50_ms, p99_ms, bytes_written_per_op
+
+along with the peak RSS of the case, which covers every operation run,
+so pass `--operation cold_login` alone to see the RSS of a cold login.
+The results are written as JSON, and passing an earlier results file to
+`--compare` prints how each operation has changed, so regressions
+between versions can be spotted.
+
+Password hashing dominates most operations at the default cost, use
+`--fast-hash` to measure the store on its own.
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import login
+from auth import hash_username
+from hashing import PasswordHasher
+from ratelimit import RateLimiter
+from store import UserRecord, open_store, userdata_cache
+
+
+# operations measured, in the order they are run
+OPERATIONS = (
+    'cold_login', 'login', 'signup', 'rename', 'display_name', 'email',
+    'password'
+)
+
+# file extension used for each backend
+BACKENDS = {'json': 'json', 'sqlite': 'db', 'sharded': 'shards'}
+
+# password every synthetic user starts with
+PASSWORD = 'Benchmark1'
+
+# cheap hasher settings for `--fast-hash`
+FAST_HASH = ('pbkdf2-sha256', {'i': 1})
+
+
+def bytes_written() -> int | None:
+    '''
+    Returns how many bytes this process has written so far, or `None`
+    where the platform does not report it.
+    '''
+
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            for line in io_file:
+                name, _, value = line.partition(':')
+                if name == 'wchar':
+                    return int(value)
+    except OSError:
+        pass
+
+    return None
+
+
+def peak_rss() -> int | None:
+    '''
+    Returns the peak resident memory of this process in bytes, or `None`
+    where the platform does not report it.
+    '''
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # reported in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(timings: list[float], fraction: float) -> float:
+    '''
+    Returns the nearest rank percentile of sorted timings.
+    '''
+
+    rank = max(1, math.ceil(fraction * len(timings)))
+
+    return timings[rank - 1]
+
+
+def make_hasher(fast_hash: bool) -> PasswordHasher:
+    '''
+    Returns the hasher to benchmark with.
+    '''
+
+    if fast_hash:
+        return PasswordHasher(*FAST_HASH)
+
+    return PasswordHasher()
+
+
+def generate_store(path: str, users: int, fast_hash: bool,
+                   chunk_size: int = 10_000) -> None:
+    '''
+    Fills a new store with synthetic users, all sharing one password hash
+    so generating millions of them does not mean hashing millions of
+    passwords.
+    '''
+
+    hasher = make_hasher(fast_hash)
+    password_hash = hasher.hash(PASSWORD)
+    hasher.close()
+
+    store = open_store(path)
+    try:
+        for start in range(0, users, chunk_size):
+            store.insert_many([
+                (hash_username(f'user{i}'), UserRecord(
+                    password_hash,
+                    f'User {i}',
+                    f'user{i}@example.com'
+                ))
+                for i in range(start, min(users, start + chunk_size))
+            ])
+
+        # leave the store as it would be after normal use
+        if hasattr(store, 'compact'):
+            store.compact()
+    finally:
+        store.close()
+
+    return
+
+
+def store_files(path: str) -> list[str]:
+    '''
+    Returns the files making up a store, other than a whole directory.
+    '''
+
+    return [
+        file_path for file_path in
+        (path, f'{path}.journal', f'{path}.index', f'{path}-wal')
+        if os.path.isfile(file_path)
+    ]
+
+
+class Case:
+    '''
+    Collection of methods for running every operation against one store.
+    '''
+
+    def __init__(self, path: str, users: int, fast_hash: bool,
+                 seed: int) -> None:
+        '''
+        Opens the store and sets up a `Login` driven by a script.
+        '''
+
+        self.path = path
+        self.random = random.Random(seed)
+        self.warm = False
+
+        # how many users there are, and the usernames and passwords of
+        # those that differ from the generated ones, so the harness does
+        # not hold a list of every user
+        self.user_count = users
+        self.usernames = {}
+        self.passwords = {}
+        self.serial = 0
+
+        # any error message means a run went wrong, and only the latest
+        # messages are kept so memory does not grow with the runs
+        self.interface = login.ScriptedInterface(strict=True, max_messages=16)
+        self.login = login.Login(
+            open_store(path),
+            make_hasher(fast_hash),
+            RateLimiter(),
+            interface=self.interface
+        )
+
+        return
+
+    def unique(self, prefix: str) -> str:
+        '''
+        Returns a name no synthetic user has.
+        '''
+
+        self.serial += 1
+
+        return f'{prefix}{self.serial}'
+
+    def username(self, index: int) -> str:
+        '''
+        Returns the current username of a user.
+        '''
+
+        return self.usernames.get(index, f'user{index}')
+
+    def pick_user(self) -> int:
+        '''
+        Picks an existing user at random, logged in as current user.
+        '''
+
+        index = self.random.randrange(self.user_count)
+        self.login.current_user = hash_username(self.username(index))
+
+        return index
+
+    def reopen(self) -> None:
+        '''
+        Swaps in a newly opened store, with nothing cached.
+        '''
+
+        self.login.store.close()
+        userdata_cache.invalidate()
+        self.login.auth.store = open_store(self.path)
+        self.warm = False
+
+        return
+
+    def run_cold_login(self) -> None:
+        self.reopen()
+        self.run_login()
+
+        return
+
+    def run_login(self) -> None:
+        username = self.username(self.random.randrange(self.user_count))
+        self.interface.load(username, self.passwords.get(username, PASSWORD))
+        self.login.login()
+
+        return
+
+    def run_signup(self) -> None:
+        username = self.unique('new')
+        self.interface.load(
+            username,
+            f'New User {self.serial}',
+            f'{username}@example.com',
+            PASSWORD,
+            PASSWORD
+        )
+        self.login.signup()
+        self.usernames[self.user_count] = username
+        self.user_count += 1
+
+        return
+
+    def run_rename(self) -> None:
+        index = self.pick_user()
+        username = self.unique('renamed')
+        self.interface.load(1, username, 5)
+        self.login.account_options()
+
+        # the password moves with the account
+        old_username = self.username(index)
+        if old_username in self.passwords:
+            self.passwords[username] = self.passwords.pop(old_username)
+        self.usernames[index] = username
+
+        return
+
+    def run_display_name(self) -> None:
+        self.pick_user()
+        self.interface.load(2, self.unique('Display '), 5)
+        self.login.account_options()
+
+        return
+
+    def run_email(self) -> None:
+        self.pick_user()
+        self.interface.load(3, f'{self.unique("changed")}@example.com', 5)
+        self.login.account_options()
+
+        return
+
+    def run_password(self) -> None:
+        username = self.username(self.pick_user())
+        current = self.passwords.get(username, PASSWORD)
+        password = f'{self.unique("Changed")}x'
+        self.interface.load(4, current, password, password, 5)
+        self.login.account_options()
+        self.passwords[username] = password
+
+        return
+
+    def measure(self, operation: str, count: int) -> dict:
+        '''
+        Runs an operation `count` times, returning its figures.
+        '''
+
+        run = getattr(self, f'run_{operation}')
+        timings = []
+
+        # read the store in before anything else is timed
+        if operation != 'cold_login' and not self.warm:
+            len(self.login.store)
+            self.warm = True
+
+        written = bytes_written()
+        started = time.perf_counter()
+        for _ in range(count):
+            op_started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - op_started)
+            if self.interface.pending():
+                raise login.ScriptError(f'{operation} left answers unused')
+        elapsed = time.perf_counter() - started
+
+        # include buffered writes in the figure
+        self.login.store.flush()
+        if written is not None:
+            written = (bytes_written() - written) / count
+
+        timings.sort()
+
+        return {
+            'ops': count,
+            'seconds': elapsed,
+            'ops_per_sec': count / elapsed,
+            'p50_ms': percentile(timings, 0.5) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            'bytes_written_per_op': written
+        }
+
+    def close(self) -> None:
+        '''
+        Waits for hashing to finish and closes the store.
+        '''
+
+        self.login.hasher.close()
+        self.login.store.close()
+
+        return
+
+
+def run_case(backend: str, users: int, operations: list[str], count: int,
+             fast_hash: bool, seed: int, data_dir: str | None) -> dict:
+    '''
+    Benchmarks every operation against a store of `users` users, in the
+    current process.
+
+    With `data_dir`, generated stores are kept there and reused by later
+    runs, and each run works on a copy.
+    '''
+
+    work_dir = tempfile.mkdtemp(prefix='login-benchmark-')
+    name = f'users-{users}{"-fast" if fast_hash else ""}.{BACKENDS[backend]}'
+    path = os.path.join(work_dir, name)
+
+    try:
+        # generate the store, or copy a kept one
+        started = time.perf_counter()
+        if data_dir is None:
+            generate_store(path, users, fast_hash)
+        else:
+            kept_path = os.path.join(data_dir, name)
+            if not os.path.exists(kept_path):
+                generate_store(kept_path, users, fast_hash)
+            if os.path.isdir(kept_path):
+                shutil.copytree(kept_path, path)
+            for file_path in store_files(kept_path):
+                shutil.copy2(
+                    file_path,
+                    path + file_path[len(kept_path):]
+                )
+        setup_seconds = time.perf_counter() - started
+
+        case = Case(path, users, fast_hash, seed)
+        try:
+            results = {
+                operation: case.measure(operation, count)
+                for operation in operations
+            }
+        finally:
+            case.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'backend': backend,
+        'users': users,
+        'setup_seconds': setup_seconds,
+        'peak_rss_bytes': peak_rss(),
+        'operations': results
+    }
+
+
+def compare(baseline: dict, current: dict) -> None:
+    '''
+    Prints the change in throughput of each operation since a baseline.
+    '''
+
+    baseline_cases = {
+        (case['backend'], case['users']): case for case in baseline['cases']
+    }
+
+    print(f'Compared with {baseline["version"]}:', file=sys.stderr)
+    for case in current['cases']:
+        old_case = baseline_cases.get((case['backend'], case['users']))
+        if old_case is None:
+            continue
+        for operation, figures in case['operations'].items():
+            old_figures = old_case['operations'].get(operation)
+            if old_figures is None:
+                continue
+            change = figures['ops_per_sec'] / old_figures['ops_per_sec'] - 1
+            print(f'  {case["backend"]:<6} {case["users"]:>10} '
+                f'{operation:<12} {change:+7.1%}', file=sys.stderr)
+
+    return
+
+
+def main() -> None:
+    '''
+    Parses arguments and runs the benchmark.
+    '''
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the login feature against large stores.'
+    )
+    parser.add_argument(
+        '--users',
+        type=int,
+        nargs='+',
+        default=[1_000, 10_000, 100_000],
+        help='store sizes to run, up to millions'
+    )
+    parser.add_argument(
+        '--backend',
+        choices=list(BACKENDS),
+        nargs='+',
+        default=list(BACKENDS)
+    )
+    parser.add_argument(
+        '--operation',
+        choices=OPERATIONS,
+        nargs='+',
+        default=list(OPERATIONS)
+    )
+    parser.add_argument(
+        '--ops',
+        type=int,
+        default=100,
+        help='times to run each operation'
+    )
+    parser.add_argument(
+        '--fast-hash',
+        action='store_true',
+        help='use a trivial hash cost to measure the store alone'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--data-dir',
+        help='directory to keep generated stores in between runs'
+    )
+    parser.add_argument(
+        '--output',
+        help='file to write the JSON results to (default: stdout)'
+    )
+    parser.add_argument(
+        '--compare',
+        help='earlier results file to compare against'
+    )
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        os.makedirs(args.data_dir, exist_ok=True)
+
+    report = {
+        'version': login.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fast_hash': args.fast_hash,
+        'seed': args.seed,
+        'cases': []
+    }
+
+    # a fresh process per case, so peak RSS and caches are its own
+    context = get_context('spawn')
+    for backend in args.backend:
+        for users in args.users:
+            print(f'Running {backend} with {users} users...', file=sys.stderr)
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                report['cases'].append(executor.submit(
+                    run_case,
+                    backend,
+                    users,
+                    args.operation,
+                    args.ops,
+                    args.fast_hash,
+                    args.seed,
+                    args.data_dir
+                ).result())
+
+    # write the results
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            compare(json.load(baseline_file), report)
+
+    return
+
+
+# only execute if called directly
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print()
+        sys.exit()
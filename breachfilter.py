@@ -0,0 +1,184 @@
+'''
+# Breach Filter
+
+Read-only Bloom filter of passwords known from breaches, so signup and
+password changes can refuse them without holding the list in memory.
+
+The filter is built once from a breach list and kept in a file that is
+memory mapped, so a lookup hashes the password, tests a few bits in
+place and only touches the pages holding them, whatever the size of the
+list. Layout, little endian:
+
+    header  magic, bit count, hash count, password count
+    bits    bit `i` is bit `i % 8` of byte `i // 8`
+
+Passwords are keyed by their SHA-1 digest, so lists published as SHA-1
+hashes, such as Have I Been Pwned's `HASH:COUNT` lines, can be built
+from directly. The two halves of the digest give every bit position by
+double hashing. A password that is not in the list is reported as in it
+at about the error rate the filter was built for, and a password that
+is in the list is always reported.
+'''
+
+import math
+import mmap
+import os
+import struct
+from hashlib import sha1
+
+
+MAGIC = b'LBF1'
+HEADER = struct.Struct('<4sQIQ')
+
+# share of passwords not in the list that are reported as in it
+ERROR_RATE = 0.001
+
+
+def password_key(password: str) -> bytes:
+    '''
+    Returns the digest a password is filtered by.
+    '''
+
+    return sha1(password.encode()).digest()
+
+
+def bit_positions(key: bytes, bits: int, hashes: int):
+    '''
+    Yields the `hashes` bits, out of `bits`, set for a key.
+    '''
+
+    first = int.from_bytes(key[:8], 'little')
+    # odd, so the steps never fall into a short cycle
+    step = int.from_bytes(key[8:16], 'little') | 1
+
+    for index in range(hashes):
+        yield (first + index * step) % bits
+
+    return
+
+
+def filter_size(count: int, error_rate: float = ERROR_RATE
+                ) -> tuple[int, int]:
+    '''
+    Returns the bit and hash counts for a filter of `count` passwords
+    with `error_rate` false positives.
+    '''
+
+    count = max(count, 1)
+    bits = math.ceil(-count * math.log(error_rate) / math.log(2) ** 2)
+    # whole bytes, since that is what is stored
+    bits = -(-bits // 8) * 8
+    hashes = max(1, round(bits / count * math.log(2)))
+
+    return bits, hashes
+
+
+def read_keys(file, hashed: bool = False):
+    '''
+    Yields the key of each password in an open breach list, one password
+    per line, or with `hashed` one SHA-1 hexdigest per line, optionally
+    followed by `:` and a count. Blank lines are skipped.
+    '''
+
+    for line in file:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+
+        if hashed:
+            yield bytes.fromhex(line.partition(':')[0].strip())
+        else:
+            yield password_key(line)
+
+    return
+
+
+def build_filter(path: str, keys, count: int,
+                 error_rate: float = ERROR_RATE) -> int:
+    '''
+    Writes a filter over an iterable of keys, sized for `count` of them,
+    replacing any old filter in one step, and returns how many keys were
+    added.
+
+    More keys than `count` can be added, at the cost of a higher error
+    rate.
+    '''
+
+    bits, hashes = filter_size(count, error_rate)
+    table = bytearray(bits // 8)
+
+    added = 0
+    for key in keys:
+        for position in bit_positions(key, bits, hashes):
+            table[position >> 3] |= 1 << (position & 7)
+        added += 1
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as filter_file:
+        filter_file.write(HEADER.pack(MAGIC, bits, hashes, added))
+        filter_file.write(table)
+        filter_file.flush()
+        os.fsync(filter_file.fileno())
+    os.replace(temp_path, path)
+
+    return added
+
+
+class BreachFilter:
+    '''
+    A breach filter file mapped into memory for lookups, supporting `in`
+    with a password.
+    '''
+
+    def __init__(self, path: str) -> None:
+        '''
+        Maps a filter file, raising `ValueError` if it is not one.
+        '''
+
+        with open(path, 'rb') as filter_file:
+            size = os.fstat(filter_file.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError(f'Not a breach filter: {path}')
+            self._map = mmap.mmap(
+                filter_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+
+        magic, bits, hashes, count = HEADER.unpack_from(self._map, 0)
+        if (magic != MAGIC or not bits or not hashes
+            or size != HEADER.size + bits // 8):
+            self._map.close()
+            raise ValueError(f'Not a breach filter: {path}')
+
+        self.path = path
+        self.bits = bits
+        self.hashes = hashes
+        self.count = count
+
+        return
+
+    def __contains__(self, password: str) -> bool:
+        return self.contains_key(password_key(password))
+
+    def contains_key(self, key: bytes) -> bool:
+        '''
+        Returns whether a key may be in the list, `False` meaning it is
+        certainly not.
+        '''
+
+        table = self._map
+        for position in bit_positions(key, self.bits, self.hashes):
+            if not table[HEADER.size + (position >> 3)] >> (position & 7) & 1:
+                return False
+
+        return True
+
+    def close(self) -> None:
+        '''
+        Unmaps the file.
+        '''
+
+        self._map.close()
+
+        return
@@ -0,0 +1,254 @@
+'''
+# Bulk Import and Export
+
+Streams users into and out of a `CredentialStore` as CSV or JSON lines.
+
+Import rows hold either a new user to sign up, with the same fields and
+rules as `login.Login.signup()`:
+
+    username, display_name, email_address, password
+
+or a user exported from another store, whose password is already hashed:
+
+    username_hash, password, display_name, email_address
+
+which is also the layout written by export. Rows are read, checked,
+hashed and committed `chunk_size` at a time, so memory use stays the same
+however large the file is.
+'''
+
+import csv
+import json
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import islice
+
+from auth import hash_username
+from changefeed import ChangeFeed
+from hashing import LEGACY_SCHEME, PasswordHasher, hash_scheme
+from store import (RECORD_FIELDS, CredentialStore, FieldTooLongError,
+                   UserRecord, check_field_lengths)
+from validation import ValidationPolicy, default_policy
+
+
+# columns written by export, in order
+EXPORT_FIELDS = ('username_hash', 'password', 'display_name', 'email_address')
+
+# columns an import row may have
+IMPORT_FIELDS = ('username', *EXPORT_FIELDS)
+
+# form of username hashes and legacy password hashes, sha256 hexdigests
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+@dataclass
+class ImportReport:
+    '''
+    Outcome of an import.
+
+    `invalid` holds the row number and error code of each rejected row,
+    and `email_taken` the row number of each row skipped because another
+    user has its email address.
+    '''
+
+    imported: int = 0
+    skipped: int = 0
+    invalid: list[tuple[int, str]] = field(default_factory=list)
+    email_taken: list[int] = field(default_factory=list)
+
+
+def detect_format(path: str, format: str | None = None) -> str:
+    '''
+    Returns `'csv'` or `'jsonl'`, from `format` if given or else from the
+    file extension.
+    '''
+
+    if format is None:
+        extension = os.path.splitext(path)[1].lower()
+        format = 'csv' if extension == '.csv' else 'jsonl'
+    if format not in ('csv', 'jsonl'):
+        raise ValueError(f'Unknown format: {format}')
+
+    return format
+
+
+def read_rows(file, format: str):
+    '''
+    Yields each row of an open file as a dict.
+    '''
+
+    if format == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+    return
+
+
+def write_rows(file, format: str, rows) -> int:
+    '''
+    Writes rows of export fields to an open file, returning how many were
+    written.
+    '''
+
+    count = 0
+    if format == 'csv':
+        writer = csv.DictWriter(file, EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(
+                {key: row[key] for key in EXPORT_FIELDS}
+            ) + '\n')
+            count += 1
+
+    return count
+
+
+def row_fields(row: dict) -> tuple[str | None, str | None, dict]:
+    '''
+    Returns the username hash a row should be stored under, an error code
+    if the row is malformed, and the values in it to check against a
+    `ValidationPolicy`.
+    '''
+
+    # JSON rows may hold anything, but only text can be stored
+    for name in IMPORT_FIELDS:
+        if row.get(name) is not None and not isinstance(row[name], str):
+            return None, 'field_invalid', {}
+
+    display_name = row.get('display_name')
+    email_address = row.get('email_address') or ''
+    password = row.get('password') or ''
+    if display_name is None:
+        return None, 'display_name_missing', {}
+
+    if row.get('username_hash'):
+        # exported row, the password must already be hashed
+        username_hash = row['username_hash']
+        if not DIGEST_PATTERN.fullmatch(username_hash):
+            return None, 'username_invalid', {}
+        try:
+            scheme = hash_scheme(password)[0]
+        except ValueError:
+            return username_hash, 'password_invalid', {}
+        # anything else not in a known format may be a plain password
+        if scheme == LEGACY_SCHEME and not DIGEST_PATTERN.fullmatch(password):
+            return username_hash, 'password_invalid', {}
+
+        return username_hash, None, {'email_address': email_address}
+
+    username = row.get('username') or ''
+
+    return hash_username(username) if username else None, None, {
+        'username': username,
+        'email_address': email_address,
+        'password': password
+    }
+
+
+def import_users(store: CredentialStore, hasher: PasswordHasher, rows,
+                 chunk_size: int = 1000, replace: bool = False,
+                 policy: ValidationPolicy = default_policy,
+                 feed: ChangeFeed | None = None) -> ImportReport:
+    '''
+    Adds users from an iterable of rows to a store, checked against
+    `policy`.
+
+    Plain text passwords in each chunk are hashed in parallel on the
+    hasher pool before the chunk is committed. Existing users are skipped,
+    or with `replace` overwritten. Users whose email address is already
+    taken are always skipped. A `signup` event is published to `feed`
+    for every user stored, once their chunk is committed.
+    '''
+
+    report = ImportReport()
+    numbered_rows = enumerate(rows, start=1)
+
+    while True:
+        chunk = list(islice(numbered_rows, chunk_size))
+        if not chunk:
+            break
+
+        # check the shape of every row, then their values in one batch
+        shaped = [(row_number, row, *row_fields(row))
+            for row_number, row in chunk]
+        errors = policy.validate_many(fields for *_, fields in shaped)
+
+        # start hashing the new passwords of the valid rows
+        pending = []
+        checked = zip(shaped, errors)
+        for (row_number, row, username_hash, error, _), value_error in checked:
+            error = error or value_error
+            if error:
+                report.invalid.append((row_number, error))
+                continue
+
+            if row.get('username_hash'):
+                password_hash = row['password']
+            else:
+                password_hash = hasher.submit_hash(row['password'])
+            pending.append((username_hash, password_hash, row_number, row))
+
+        # collect the hashes and commit the chunk in one go
+        records = []
+        row_numbers = {}
+        for username_hash, password_hash, row_number, row in pending:
+            if not isinstance(password_hash, str):
+                password_hash = password_hash.result()
+            record = UserRecord(
+                password_hash,
+                row['display_name'],
+                row.get('email_address') or ''
+            )
+
+            # one row too long for the store would fail the whole chunk
+            try:
+                check_field_lengths(record, store.max_field_bytes)
+            except FieldTooLongError:
+                report.invalid.append((row_number, 'field_too_long'))
+                continue
+
+            records.append((username_hash, record))
+            row_numbers.setdefault(username_hash, row_number)
+        skipped = store.insert_many(records, replace)
+
+        if feed is not None:
+            # a user is skipped once for each of their rows left out
+            left_out = Counter(skipped)
+            for username_hash, _ in records:
+                if left_out[username_hash]:
+                    left_out[username_hash] -= 1
+                else:
+                    feed.publish('signup', username_hash, RECORD_FIELDS)
+
+        # users skipped without being stored lost out on their email
+        report.imported += len(records) - len(skipped)
+        for username_hash in skipped:
+            if not replace and store.exists(username_hash):
+                report.skipped += 1
+            else:
+                report.email_taken.append(row_numbers[username_hash])
+
+    return report
+
+
+def export_users(store: CredentialStore, file, format: str) -> int:
+    '''
+    Writes every user in a store to an open file, returning how many were
+    written.
+    '''
+
+    rows = (
+        {'username_hash': username_hash} | record.to_dict()
+        for username_hash, record in store.items()
+    )
+
+    return write_rows(file, format, rows)
@@ -0,0 +1,243 @@
+'''
+# Change Feed
+
+Stream of account changes for downstream systems such as audit logs,
+caches and analytics, so they can follow signups and edits as they
+happen instead of polling the store and diffing it.
+
+Every change is an event like:
+
+    {"seq": 7, "time": 1700000000.0, "type": "profile",
+     "user": "<username hash>", "fields": ["display_name"]}
+
+`type` is one of `signup`, `profile`, `password`, `rehash` and `rename`,
+which also gives the user's `new_user` hash. Only the names of changed
+fields are given, never their values, so the feed holds nothing that
+needs protecting and consumers read the record if they need it.
+
+Events are handed to subscriber callbacks in the process making the
+change and, given a path, appended as JSON lines to a feed file that
+other processes can tail. Sequence numbers carry on from the last event
+in the file, so they keep increasing across restarts and processes
+sharing the file. A consumer remembers the byte offset it has read up
+to and resumes from it with `read_changes()` or `follow()`.
+
+Events are published once a change has been stored, so a crash between
+the two can lose an event but never reports a change that did not
+happen.
+'''
+
+import json
+import os
+import threading
+import time
+
+from metrics import metrics
+from store import file_lock
+
+
+def last_sequence(feed_file) -> tuple[int, int]:
+    '''
+    Returns the offset just past the last complete line of an open feed
+    file, and the sequence number of the event on it, or `0` if there is
+    none.
+    '''
+
+    size = feed_file.seek(0, os.SEEK_END)
+    position = size
+    data = b''
+
+    # step back until the last complete line has been read in full
+    while position > 0:
+        start = max(0, position - 4096)
+        feed_file.seek(start)
+        data = feed_file.read(position - start) + data
+        position = start
+
+        lines = data.split(b'\n')
+        if len(lines) > 2 or (position == 0 and len(lines) > 1):
+            return size - len(lines[-1]), json.loads(lines[-2])['seq']
+
+    return 0, 0
+
+
+def iter_changes(path: str, offset: int = 0, limit: int | None = None):
+    '''
+    Yields `(event, offset)` for the events written after `offset`, at
+    most `limit` of them, the offset being where to resume after each.
+
+    A partly written final line is left for the next read.
+    '''
+
+    try:
+        feed_file = open(path, 'rb')
+    except FileNotFoundError:
+        return
+
+    with feed_file:
+        feed_file.seek(offset)
+        count = 0
+        for line in feed_file:
+            if not line.endswith(b'\n') or count == limit:
+                break
+            offset += len(line)
+            count += 1
+            yield json.loads(line), offset
+
+    return
+
+
+def read_changes(path: str, offset: int = 0,
+                 limit: int | None = None) -> tuple[list[dict], int]:
+    '''
+    Reads the events written after `offset`, at most `limit` of them,
+    and returns them along with the offset to resume from.
+    '''
+
+    events = []
+    for event, offset in iter_changes(path, offset, limit):
+        events.append(event)
+
+    return events, offset
+
+
+def follow(path: str, offset: int = 0, interval: float = 1.0):
+    '''
+    Yields `(event, offset)` for every event written after `offset`, as
+    `iter_changes()`, waiting `interval` seconds between checks for more.
+    Runs until closed.
+    '''
+
+    while True:
+        found = False
+        for event, offset in iter_changes(path, offset, limit=1000):
+            found = True
+            yield event, offset
+
+        if not found:
+            time.sleep(interval)
+
+    return
+
+
+class ChangeFeed:
+    '''
+    Collection of methods for publishing account changes to subscribers
+    and, if `path` is given, to a feed file.
+    '''
+
+    def __init__(self, path: str | None = None) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.path = path
+
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+        # feed file is opened on the first event, and the sequence number
+        # is only read back from it if someone else has written since
+        self._feed_file = None
+        self._sequence = 0
+        self._end = None
+
+        return
+
+    def subscribe(self, callback) -> None:
+        '''
+        Calls `callback` with every event published from now on, in
+        sequence order.
+
+        Callbacks run while the change is being made, so should be quick,
+        and errors raised by them are counted and otherwise ignored.
+        '''
+
+        with self._lock:
+            self._subscribers.append(callback)
+
+        return
+
+    def unsubscribe(self, callback) -> None:
+        '''
+        Stops calling a subscribed callback.
+        '''
+
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+        return
+
+    def _append(self, event: dict) -> None:
+        '''
+        Numbers an event after the last one in the feed file and appends
+        it.
+
+        Must be called with the thread lock held.
+        '''
+
+        if self._feed_file is None:
+            self._feed_file = open(self.path, 'a+b')
+
+        with file_lock(self._feed_file):
+            # catch up with anything written by another process, dropping
+            # a partly written line left by a crash mid-append
+            if os.fstat(self._feed_file.fileno()).st_size != self._end:
+                end, self._sequence = last_sequence(self._feed_file)
+                self._feed_file.truncate(end)
+
+            self._sequence += 1
+            event['seq'] = self._sequence
+            self._feed_file.write(json.dumps(event).encode() + b'\n')
+            self._feed_file.flush()
+            self._end = os.fstat(self._feed_file.fileno()).st_size
+
+        return
+
+    def publish(self, type: str, username_hash: str, fields=(),
+                **details: str) -> dict:
+        '''
+        Records a change to a user, naming the fields changed, and
+        returns the event. Extra details, such as the `new_user` of a
+        rename, are added to the event as given.
+        '''
+
+        event = {
+            'seq': None,
+            'time': time.time(),
+            'type': type,
+            'user': username_hash,
+            'fields': list(fields)
+        } | details
+
+        with self._lock:
+            if self.path is not None:
+                self._append(event)
+            else:
+                self._sequence += 1
+                event['seq'] = self._sequence
+
+            # in order, as the lock is still held
+            for callback in self._subscribers:
+                try:
+                    callback(event)
+                except Exception:
+                    metrics.increment('change_feed_subscriber_errors_total')
+
+        metrics.increment('change_feed_events_total', type=type)
+
+        return event
+
+    def close(self) -> None:
+        '''
+        Closes the feed file.
+        '''
+
+        with self._lock:
+            if self._feed_file is not None:
+                self._feed_file.close()
+                self._feed_file = None
+                self._end = None
+
+        return
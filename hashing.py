@@ -0,0 +1,284 @@
+'''
+# Password Hashing
+
+Salted, deliberately slow password hashing for `login.Login`.
+
+Hashes are stored in a self-describing format that records the scheme
+and cost parameters used, so they can be verified after the defaults
+change:
+
+    $scrypt$ln=14,r=8,p=1$<salt>$<hash>
+    $pbkdf2-sha256$i=600000$<salt>$<hash>
+
+with the salt and hash base64 encoded. Records written by earlier
+versions hold a bare sha256 hexdigest instead, which still verifies and
+is reported as the `sha256` scheme so it can be rehashed on next login.
+Hashing and verifying run on a bounded pool of workers so the calling
+thread only waits on a future.
+'''
+
+import hashlib
+import hmac
+import os
+import time
+from base64 import b64decode, b64encode
+
+from metrics import metrics
+
+
+# supported schemes and their default cost parameters
+SCHEMES = {
+    'scrypt': {'ln': 14, 'r': 8, 'p': 1},
+    'pbkdf2-sha256': {'i': 600_000}
+}
+
+# scheme reported for the bare sha256 hexdigests of earlier versions
+LEGACY_SCHEME = 'sha256'
+
+# length of generated salts and hashes, in bytes
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+
+def _derive(scheme: str, params: dict, password: str, salt: bytes) -> bytes:
+    '''
+    Runs the key derivation function for a scheme.
+    '''
+
+    match scheme:
+        case 'scrypt':
+            n = 2 ** params['ln']
+            return hashlib.scrypt(
+                password.encode(),
+                salt=salt,
+                n=n,
+                r=params['r'],
+                p=params['p'],
+                # allow twice the memory the parameters need
+                maxmem=256 * n * params['r'] * params['p'],
+                dklen=HASH_SIZE
+            )
+        case 'pbkdf2-sha256':
+            return hashlib.pbkdf2_hmac(
+                'sha256',
+                password.encode(),
+                salt,
+                params['i'],
+                dklen=HASH_SIZE
+            )
+        case _:
+            raise ValueError(f'Unknown hash scheme: {scheme}')
+
+
+def format_hash(scheme: str, params: dict, salt: bytes,
+                digest: bytes) -> str:
+    '''
+    Encodes a hash in the stored format.
+    '''
+
+    param_text = ','.join(f'{key}={value}' for key, value in params.items())
+
+    return (f'${scheme}${param_text}'
+        f'${b64encode(salt).decode()}${b64encode(digest).decode()}')
+
+
+def parse_hash(stored_hash: str) -> tuple[str, dict, bytes, bytes]:
+    '''
+    Decodes a hash in the stored format into its scheme, parameters, salt
+    and digest.
+
+    Raises `ValueError` if the hash is not in the stored format.
+    '''
+
+    parts = stored_hash.split('$')
+    if len(parts) != 5 or parts[0] or parts[1] not in SCHEMES:
+        raise ValueError('Not a recognised password hash')
+
+    params = {}
+    for item in parts[2].split(','):
+        key, _, value = item.partition('=')
+        params[key] = int(value)
+
+    return parts[1], params, b64decode(parts[3]), b64decode(parts[4])
+
+
+def hash_scheme(stored_hash: str) -> tuple[str, dict]:
+    '''
+    Returns the scheme and cost parameters a stored hash was made with.
+    '''
+
+    if not stored_hash.startswith('$'):
+        return LEGACY_SCHEME, {}
+
+    scheme, params, _, _ = parse_hash(stored_hash)
+
+    return scheme, params
+
+
+def hash_password(password: str, scheme: str, params: dict) -> str:
+    '''
+    Hashes a password with a new random salt.
+    '''
+
+    salt = os.urandom(SALT_SIZE)
+
+    return format_hash(
+        scheme,
+        params,
+        salt,
+        _derive(scheme, params, password, salt)
+    )
+
+
+def verify_password(password: str, stored_hash: str) -> bool:
+    '''
+    Checks a password against a stored hash.
+
+    Hashes not in the stored format are treated as the bare sha256
+    hexdigests written by earlier versions.
+    '''
+
+    if hash_scheme(stored_hash)[0] == LEGACY_SCHEME:
+        return hmac.compare_digest(
+            hashlib.sha256(password.encode()).hexdigest(),
+            stored_hash
+        )
+
+    scheme, params, salt, digest = parse_hash(stored_hash)
+
+    return hmac.compare_digest(
+        _derive(scheme, params, password, salt),
+        digest
+    )
+
+
+class PasswordHasher:
+    '''
+    Hashes and verifies passwords on a pool of workers.
+
+    `scheme` picks the key derivation function and `params` overrides any
+    of its default cost parameters. `workers` bounds the pool size, and
+    defaults to the number of CPUs. A thread pool is used by default, as
+    `hashlib` releases the GIL while deriving keys; pass `processes=True`
+    to use separate processes instead.
+    '''
+
+    def __init__(self, scheme: str = 'scrypt', params: dict | None = None,
+                 workers: int | None = None, processes: bool = False) -> None:
+        '''
+        Initialises the object. The pool is started on first use.
+        '''
+
+        if scheme not in SCHEMES:
+            raise ValueError(f'Unknown hash scheme: {scheme}')
+
+        self.scheme = scheme
+        self.params = SCHEMES[scheme] | (params or {})
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = processes
+
+        self._pool = None
+
+        return
+
+    @property
+    def pool(self) -> 'Executor':
+        '''
+        The pool hashing runs on, started if not already running.
+        '''
+
+        if self._pool is None:
+            # imported here as `concurrent.futures` pulls in `logging`, and
+            # process pools `multiprocessing`, which are slow to import
+            if self.processes:
+                from concurrent.futures import ProcessPoolExecutor
+
+                self._pool = ProcessPoolExecutor(self.workers)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self._pool = ThreadPoolExecutor(
+                    self.workers,
+                    thread_name_prefix='hasher'
+                )
+
+        return self._pool
+
+    @staticmethod
+    def _timed(future: 'Future', operation: str, scheme: str) -> 'Future':
+        '''
+        Records how long a future takes to finish, including any time
+        queued for a worker, if metrics are enabled.
+        '''
+
+        if metrics.enabled:
+            started = time.perf_counter()
+            future.add_done_callback(lambda _: metrics.observe(
+                'hash_seconds',
+                time.perf_counter() - started,
+                operation=operation,
+                scheme=scheme
+            ))
+
+        return future
+
+    def submit_hash(self, password: str) -> 'Future':
+        '''
+        Starts hashing a password, returning a future for the hash.
+        '''
+
+        return self._timed(self.pool.submit(
+            hash_password,
+            password,
+            self.scheme,
+            self.params
+        ), 'hash', self.scheme)
+
+    def submit_verify(self, password: str, stored_hash: str) -> 'Future':
+        '''
+        Starts checking a password, returning a future for the result.
+        '''
+
+        future = self.pool.submit(verify_password, password, stored_hash)
+        if not metrics.enabled:
+            return future
+
+        try:
+            scheme = hash_scheme(stored_hash)[0]
+        except ValueError:
+            scheme = 'unknown'
+
+        return self._timed(future, 'verify', scheme)
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        '''
+        Returns whether a stored hash was made with a different scheme or
+        cost parameters than this hasher uses, including legacy hashes.
+        '''
+
+        return hash_scheme(stored_hash) != (self.scheme, self.params)
+
+    def hash(self, password: str) -> str:
+        '''
+        Hashes a password, waiting for the result.
+        '''
+
+        return self.submit_hash(password).result()
+
+    def verify(self, password: str, stored_hash: str) -> bool:
+        '''
+        Checks a password against a stored hash, waiting for the result.
+        '''
+
+        return self.submit_verify(password, stored_hash).result()
+
+    def close(self) -> None:
+        '''
+        Shuts down the pool.
+        '''
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        return
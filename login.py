@@ -24,26 +24,67 @@ __credits__ = ['Max Harrison']
 # source: https://github.com/Cornelius-Figgle/HW-005_Login_Feature_Project
 
 
-import json
 import os
 import sys
-from getpass import getpass
-from hashlib import sha256
-from re import fullmatch
+import time
+from collections import deque
+from itertools import islice
 
 
-# version check
+# version check, before the project modules whose annotations need 3.10
 if (sys.version_info[0] < 3
     or (sys.version_info[0] >= 3 and sys.version_info[1] < 10)):
     
     print("Must be running Python >= 3.10, please upgrade.")
     sys.exit()
 
+# taken as the module loads, so `--check` can time startup
+STARTED = time.perf_counter()
+
+# most seconds from loading to being ready, checked by `--check`
+STARTUP_BUDGET = 0.15
+
+# project modules are imported where they are first used, as they pull in
+# `json`, `re` and `hashlib`, so a health check or `--help` loads none of
+# them
+
+
+def default_userdata_path() -> str:
+    '''
+    Returns the path of the data file used when none is given.
+    '''
+
+    return os.path.join(
+        os.path.dirname(__file__),
+        'userdata.json'
+    )
+
+
+def default_tenant_root() -> str:
+    '''
+    Returns the directory tenant stores are kept in when none is given.
+    '''
+
+    return os.path.join(
+        os.path.dirname(__file__),
+        'tenants'
+    )
+
+
+class ScriptError(Exception):
+    '''
+    Raised when a scripted run does not go as scripted.
+    '''
+
 
 class Interface:
     '''
     Collection of methods for displaying information to, and receiving
     information from, the user in a consistant and modifiable way. 
+
+    All output goes through `write()` and all input through `read()`, so
+    other drivers only need to replace those, see `BufferedInterface`,
+    `SilentInterface` and `ScriptedInterface`.
     '''
 
     def __init__(self) -> None:
@@ -53,6 +94,29 @@ class Interface:
         
         return
 
+    def write(self, text: str) -> None:
+        '''
+        Shows a line of output.
+        '''
+
+        print(text)
+
+        return
+
+    def read(self, prompt_text: str, hidden: bool = False) -> str:
+        '''
+        Shows a prompt and returns the line entered.
+
+        Optionally masks the user input with `getpass.getpass()`.
+        '''
+
+        if hidden:
+            from getpass import getpass
+
+            return getpass(prompt_text)
+
+        return input(prompt_text)
+
     def info(self, message_text: str, title: bool = False,
              error: bool = False) -> None:
         '''
@@ -63,11 +127,11 @@ class Interface:
 
         # format & print the message
         if title:
-            print(f'# {message_text}\n')
+            self.write(f'# {message_text}\n')
         elif error:
-            print(f'\n\tERROR: {message_text}\n')
+            self.write(f'\n\tERROR: {message_text}\n')
         else:
-            print(f'{message_text}\n')
+            self.write(f'{message_text}\n')
 
         return
     
@@ -75,14 +139,11 @@ class Interface:
         '''
         Prompts the user for an input and returns this input.
 
-        Optionally masks the user input with `getpass.getpass()`.
+        Optionally masks the user input.
         '''
 
         # prompt and store the input value
-        if hidden:
-            user_text = getpass(prompt_text)
-        else:
-            user_text = input(prompt_text)
+        user_text = self.read(prompt_text, hidden)
 
         return user_text
 
@@ -93,14 +154,15 @@ class Interface:
         '''
 
         # print the question
-        print(f'{prompt_text}')
+        self.write(f'{prompt_text}')
         # print options in a numbered list
-        for option in options:
-            print(f'{options.index(option)+1}) {option}')
+        for number, option in enumerate(options, start=1):
+            self.write(f'{number}) {option}')
 
         while True:
-            # retrieve choice
-            choice = int(input('\nPlease enter a number: ')) - 1
+            # retrieve choice, anything but a number is out of range
+            answer = self.read('\nPlease enter a number: ').strip()
+            choice = int(answer) - 1 if answer.isdecimal() else -1
             
             # check selection in range
             if choice in range(len(options)):
@@ -112,23 +174,226 @@ class Interface:
                 )
                 continue
 
-        print()
+        self.write('')
 
         return choice
 
+    def close(self) -> None:
+        '''
+        Shows any output still held back.
+        '''
+
+        return
+
+
+class BufferedInterface(Interface):
+    '''
+    Interface holding output back and writing it to `stream` in one go,
+    once `buffer_size` characters are waiting, before reading any input,
+    or on `close()`.
+
+    Saves a write per line when a run prints a lot between prompts.
+    '''
+
+    def __init__(self, stream=None, buffer_size: int = 64 * 1024) -> None:
+        '''
+        Initialises the object, writing to stdout unless given a stream.
+        '''
+
+        self.stream = stream if stream is not None else sys.stdout
+        self.buffer_size = buffer_size
+
+        self._parts = []
+        self._size = 0
+
+        return
+
+    def write(self, text: str) -> None:
+        self._parts.append(text + '\n')
+        self._size += len(text) + 1
+        if self._size >= self.buffer_size:
+            self.flush()
+
+        return
+
+    def read(self, prompt_text: str, hidden: bool = False) -> str:
+        # the user must see everything before the prompt
+        self.flush()
+
+        return super().read(prompt_text, hidden)
+
+    def flush(self) -> None:
+        '''
+        Writes out the held back output.
+        '''
+
+        if self._parts:
+            self.stream.write(''.join(self._parts))
+            self._parts.clear()
+            self._size = 0
+        self.stream.flush()
+
+        return
+
+    def close(self) -> None:
+        self.flush()
+
+        return
+
+
+class SilentInterface(Interface):
+    '''
+    Interface printing nothing, keeping the messages it is given in
+    `messages` as `(message_text, title, error)` instead, at most
+    `max_messages` of the latest if given. Input is still read from the
+    terminal, but without showing the prompt.
+    '''
+
+    def __init__(self, max_messages: int | None = None) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.messages = deque(maxlen=max_messages)
+
+        return
+
+    def write(self, text: str) -> None:
+        return
+
+    def read(self, prompt_text: str, hidden: bool = False) -> str:
+        if hidden:
+            from getpass import getpass
+
+            return getpass('')
+
+        return input()
+
+    def info(self, message_text: str, title: bool = False,
+             error: bool = False) -> None:
+        self.messages.append((message_text, title, error))
+
+        return
+
+    def errors(self) -> list[str]:
+        '''
+        Returns the error messages kept.
+        '''
+
+        return [
+            message_text for message_text, _, error in self.messages if error
+        ]
+
+
+class ScriptedInterface(SilentInterface):
+    '''
+    Interface answering from a script instead of the terminal, for
+    replaying sessions and driving `Login` from code.
+
+    The script is any iterable of answers, such as a list or an open
+    file of one answer per line, each being what a user would type:
+    the text for a prompt, or the number shown for an option. Answers can
+    also be queued from code with `load()`. Running out of answers raises
+    `ScriptError`, as does any error message when `strict`, as that means
+    the run has gone off script.
+    '''
+
+    def __init__(self, script=(), strict: bool = False,
+                 max_messages: int | None = None) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        super().__init__(max_messages)
+        self.strict = strict
+        self.script = deque()
+        self._source = iter(script)
+
+        return
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> 'ScriptedInterface':
+        '''
+        Returns an interface answering with the lines of a file.
+        '''
+
+        with open(path, 'r') as script_file:
+            return cls(script_file.read().splitlines(), **kwargs)
+
+    def load(self, *answers: str | int) -> None:
+        '''
+        Queues more answers, to be used before the rest of the script.
+        '''
+
+        self.script.extend(answers)
+
+        return
+
+    def pending(self) -> bool:
+        '''
+        Returns whether any answers are left unused.
+        '''
+
+        # only take from the script as needed, it may be a long file
+        if not self.script:
+            self.script.extend(islice(self._source, 1))
+
+        return bool(self.script)
+
+    def read(self, prompt_text: str, hidden: bool = False) -> str:
+        if not self.pending():
+            raise ScriptError(f'Script ran out at {prompt_text!r}')
+
+        # lines read from a file keep their line ending
+        return str(self.script.popleft()).rstrip('\r\n')
+
+    def info(self, message_text: str, title: bool = False,
+             error: bool = False) -> None:
+        if error and self.strict:
+            raise ScriptError(message_text)
+
+        super().info(message_text, title, error)
+
+        return
+
+
 class Login:
     '''
     Collection of methods for generating a login window for an
     application.
     '''
 
-    def __init__(self) -> None:
+    def __init__(self, store: 'CredentialStore | None' = None,
+                 hasher: 'PasswordHasher | None' = None,
+                 limiter: 'RateLimiter | None' = None,
+                 path: str | None = None,
+                 interface: Interface | None = None,
+                 policy: 'ValidationPolicy | None' = None,
+                 tenant: str | None = None,
+                 registry: 'TenantRegistry | None' = None,
+                 feed: 'ChangeFeed | None' = None) -> None:
         '''
         Initialises the object.
+
+        Optionally takes the `CredentialStore` to keep users in, otherwise
+        the one at `path` is opened, by default `userdata.json` next to
+        this file, or with a `tenant` that tenant's store from `registry`,
+        by default one keeping stores in `tenants` next to this file. Also
+        optionally takes the `PasswordHasher` to hash passwords with and the
+        `RateLimiter` counting failed attempts. By default three failed
+        attempts lock an account, and the count is kept next to the data
+        file so restarting does not reset it. The `Interface` talks to the
+        terminal unless another driver is given, and new values are
+        checked against the default `ValidationPolicy` unless given
+        another. Every change to an account is published to the
+        `ChangeFeed`, by default one kept next to the data file.
+
+        Nothing is read from or written to disk until the store is first
+        needed, see `auth`.
         '''
         
         # create object for the interface
-        self.InterfaceObj = Interface()
+        self.InterfaceObj = interface if interface is not None else Interface()
 
         # print a title and description
         self.InterfaceObj.info('Login Feature Project', title=True)
@@ -136,230 +401,308 @@ class Login:
             +'into another program.')
 
         # setup data file
-        self.userdata_path = os.path.join(
-            os.path.dirname(__file__),
-            'userdata.json'
-        )
+        self.tenant = tenant
+        self.registry = None
+        self._owns_registry = False
+        if store is not None:
+            self.userdata_path = getattr(store, 'path', None)
+        elif tenant is not None:
+            if registry is None:
+                from tenants import TenantRegistry
+
+                # made for this object alone, so closed along with it
+                registry = TenantRegistry(default_tenant_root())
+                self._owns_registry = True
+            self.registry = registry
+            self.userdata_path = registry.path(tenant)
+        else:
+            self.userdata_path = path or default_userdata_path()
 
-        # create initial data file if not present
-        if not os.path.exists(self.userdata_path):
-            with open(self.userdata_path, 'w') as userdata_file:
-                self.InterfaceObj.info(
-                    'File `userdata.json` does not exist, creating now.'
-                )
-                
-                # creates a blank file
-                json.dump({}, userdata_file)
+        # hashes passwords off the interactive thread
+        self._owns_hasher = hasher is None
+        if hasher is None:
+            from hashing import PasswordHasher
+
+            hasher = PasswordHasher()
+        self.hasher = hasher
+
+        # store and rules are setup on first use
+        self._store = store
+        self._limiter = limiter
+        self._policy = policy
+        self._feed = feed
+        self._auth = None
+
+        # only what is made here is closed along with this object
+        self._owns_store = False
+        self._owns_limiter = False
+        self._owns_feed = False
 
         # set current account
         self.current_user = None
 
         return
 
-    def login(self) -> None:
+    @property
+    def auth(self) -> 'AuthService':
         '''
-        Method for processing a user login.
+        The rules for logging in and changing accounts, setup along with
+        the store and rate limiter the first time they are needed.
         '''
 
-        # get credentials from file
-        with open(self.userdata_path, 'r') as userdata_file:
-            userdata = json.load(userdata_file)
+        if self._auth is None:
+            from auth import AuthService
+            from changefeed import ChangeFeed
+            from ratelimit import RateLimiter
+            from store import open_store
 
-        while True:
-            # retrieve username and hash it
-            username_hash = sha256(
-                self.InterfaceObj.prompt(
-                    'Username: '
-                ).encode()
-            ).hexdigest()
-
-            # if username is not valid
-            if username_hash not in userdata:
-                self.InterfaceObj.info(
-                    'Account does not exist, please try again.',
-                    error=True
+            store = self._store
+            if store is None:
+                # initial data file is created by the store if not present
+                if not os.path.exists(self.userdata_path):
+                    self.InterfaceObj.info(
+                        f'File `{os.path.basename(self.userdata_path)}` '
+                        'does not exist, creating now.'
+                    )
+
+                if self.registry is not None:
+                    store = self.registry.acquire(self.tenant)
+                else:
+                    store = open_store(self.userdata_path)
+                self._owns_store = True
+
+            # limits failed attempts across runs
+            limiter = self._limiter
+            if limiter is None:
+                limiter = RateLimiter(
+                    capacity=3,
+                    path=None if self.userdata_path is None
+                        else f'{self.userdata_path}.ratelimit'
                 )
-                continue
-            # if field is blank
-            elif not username_hash:
-                self.InterfaceObj.info(
-                    'Field blank, please enter a username.',
-                    error=True
+                self._owns_limiter = True
+
+            # publishes every change for downstream consumers
+            feed = self._feed
+            if feed is None:
+                feed = ChangeFeed(
+                    None if self.userdata_path is None
+                        else f'{self.userdata_path}.changes'
                 )
+                self._owns_feed = True
+
+            self._auth = AuthService(
+                store,
+                self.hasher,
+                limiter=limiter,
+                policy=self._policy,
+                feed=feed
+            )
+
+        return self._auth
+
+    @property
+    def store(self) -> 'CredentialStore':
+        '''
+        The backend holding the user records.
+        '''
+
+        return self.auth.store
+
+    def close(self) -> None:
+        '''
+        Makes sure every change is on disk, once hashing has finished, and
+        releases the interface. Of the store, hasher, rate limiter, change
+        feed and registry, only those made by this object are closed, and
+        those given to it are left to the caller.
+        '''
+
+        if self._owns_hasher:
+            self.hasher.close()
+        if self._owns_limiter:
+            self._auth.limiter.close()
+        if self._owns_feed:
+            self._auth.feed.close()
+        if self._owns_store:
+            if self.registry is not None:
+                self.registry.release(self.tenant)
+            else:
+                self._auth.store.close()
+        if self._owns_registry:
+            self.registry.close()
+        self.InterfaceObj.close()
+
+        return
+
+    def login(self) -> None:
+        '''
+        Method for processing a user login.
+        '''
+
+        while True:
+            # retrieve username
+            username = self.InterfaceObj.prompt(
+                'Username: '
+            )
+
+            # check the account exists
+            result = self.auth.check_username(username)
+            if not result.ok:
+                self.InterfaceObj.info(result.message, error=True)
                 continue
             else:
                 break
 
-        for i in range(3):
-            # retrieve password and hash it
-            password_hash = sha256(
-                self.InterfaceObj.prompt(
-                    'Password: ',
-                    hidden=True
-                ).encode()
-            ).hexdigest()
+        while True:
+            # retrieve password
+            password = self.InterfaceObj.prompt(
+                'Password: ',
+                hidden=True
+            )
 
             # check if password is correct
-            if password_hash != userdata[username_hash]['password']:
-                if i < 2:
-                    self.InterfaceObj.info(
-                        'Password is incorrect, please try again.',
-                        error=True
-                    )
-                else:
+            result = self.auth.authenticate(username, password, client=None)
+            del password
+            if not result.ok:
+                # stop once the rate limiter has locked the account
+                if (result.code == 'rate_limited'
+                    or self.auth.retry_after(result.username_hash, None)):
                     self.InterfaceObj.info(
                         'Too many incorrect attempts. Exiting progam.',
                         error=True
                     )
                     return 
+                self.InterfaceObj.info(result.message, error=True)
                 continue
             else:
                 break
-        
+
         # set current account
-        self.current_user = username_hash
+        self.current_user = result.username_hash
         
         self.InterfaceObj.info('\nLogged in successfully.')
 
         return
-    
-    def signup(self) -> None:
+
+    def prompt_email(self, username_hash: str | None = None) -> str:
         '''
-        Method for creating a new user.
+        Prompts for an email address until a valid one is entered that no
+        user other than `username_hash` has.
         '''
 
-        # get current credentials from file
-        with open(self.userdata_path, 'r') as userdata_file:
-            userdata = json.load(userdata_file)
-
-        while True:
-            # retrieve username and hash it
-            username_hash = sha256(
-                self.InterfaceObj.prompt(
-                    'Username: '
-                ).encode()
-            ).hexdigest()
-
-            # if username already exists
-            if username_hash in userdata:
-                self.InterfaceObj.info(
-                    'Account already exists, please use a different name.',
-                    error=True
-                )
-                continue
-            # if field blank
-            elif not username_hash:
-                self.InterfaceObj.info(
-                    'Field blank, please enter a username.',
-                    error=True
-                )
-                continue
-            else:
-                break
-
-        # retrieve a display name
-        display_name = self.InterfaceObj.prompt(
-            'Display Name: '
-        )
-        
         while True:
             # retrieve an email address
             email_address = self.InterfaceObj.prompt(
                 'Email Address: '
             )
 
-            # check is the email is valid
-            if fullmatch(r'[^@]+@[^@]+\.[^@]+', email_address):
-                break
-            else:
-                self.InterfaceObj.info(
-                    'Email is invalid, please try again.',
-                    error=True
-                )
+            # check is the email is valid and free
+            result = self.auth.check_email(email_address, username_hash)
+            if not result.ok:
+                self.InterfaceObj.info(result.message, error=True)
                 continue
+            else:
+                break
+
+        return email_address
+
+    def prompt_new_password(self, prompt_text: str = 'Password: ',
+                            confirm_text: str = 'Confirm Password: ') -> str:
+        '''
+        Prompts for a new password until a valid one is entered and then
+        confirmed.
+        '''
 
         while True:
             # retrieve password
             password = self.InterfaceObj.prompt(
-                'Password: ',
+                prompt_text,
                 hidden=True
             )
 
             # check if password is valid
-            if len(password) < 8:
-                self.InterfaceObj.info(
-                    'Password must be 8 or more characters, please try again.',
-                    error=True
-                )
-                continue
-            elif password.lower() == password:
-                self.InterfaceObj.info(
-                    'Password needs an uppercase, please try again.',
-                    error=True
-                )
-                continue
-            elif password.upper() == password:
-                self.InterfaceObj.info(
-                    'Password needs a lowercase, please try again.',
-                    error=True
-                )
-                continue
-            elif password.isalpha():
-                self.InterfaceObj.info(
-                    'Password needs a number, please try again.',
-                    error=True
-                )
+            error = self.auth.policy.validate_password(password)
+            if error:
+                from auth import MESSAGES
+
+                self.InterfaceObj.info(MESSAGES[error], error=True)
                 continue
             else:
-                # if all requirements are met, hash the password
-                password_hash = sha256(password.encode()).hexdigest()
-                del password
                 break
 
-
         # retrieve a confirmation of the password
-        confirm_password_hash = sha256(
-            self.InterfaceObj.prompt(
-                'Confirm Password: ',
-                hidden=True
-            ).encode()
-        ).hexdigest()
+        confirm_password = self.InterfaceObj.prompt(
+            confirm_text,
+            hidden=True
+        )
+
+        from hmac import compare_digest
 
         # check if passwords match
-        while password_hash != confirm_password_hash:
+        while not compare_digest(password.encode(), confirm_password.encode()):
             self.InterfaceObj.info(
                 'Passwords do not match, please try again.',
                 error=True
             )
 
             # retrieve password
-            password_hash = sha256(
-                self.InterfaceObj.prompt(
-                    'Password: ',
-                    hidden=True
-                ).encode()
-            ).hexdigest()
+            password = self.InterfaceObj.prompt(
+                prompt_text,
+                hidden=True
+            )
 
             # retrieve a confirmation of the password
-            confirm_password_hash = sha256(
-                self.InterfaceObj.prompt(
-                    'Confirm Password: ',
-                    hidden=True
-                ).encode()
-            ).hexdigest()
-
-        # add new user to data
-        userdata[username_hash] = dict() 
-        userdata[username_hash]['password'] = password_hash
-        userdata[username_hash]['display_name'] = display_name
-        userdata[username_hash]['email_address'] = email_address
-    
-        # write new data to file
-        with open(self.userdata_path, 'w') as userdata_file:
-            json.dump(userdata, userdata_file)
+            confirm_password = self.InterfaceObj.prompt(
+                confirm_text,
+                hidden=True
+            )
+
+        del confirm_password
+
+        return password
+
+    def signup(self) -> None:
+        '''
+        Method for creating a new user.
+        '''
+
+        while True:
+            # retrieve username
+            username = self.InterfaceObj.prompt(
+                'Username: '
+            )
+
+            # check the username is free
+            result = self.auth.check_username(username, available=True)
+            if not result.ok:
+                self.InterfaceObj.info(result.message, error=True)
+                continue
+            else:
+                break
+
+        # retrieve a display name
+        display_name = self.InterfaceObj.prompt(
+            'Display Name: '
+        )
+
+        # retrieve an email address and password
+        email_address = self.prompt_email()
+        password = self.prompt_new_password()
+
+        # add new user
+        result = self.auth.register(
+            username,
+            display_name,
+            email_address,
+            password
+        )
+        del password
+        if not result.ok:
+            # e.g. username was taken by someone else while signing up
+            self.InterfaceObj.info(result.message, error=True)
+            return
 
         # set current account
-        self.current_user = username_hash
+        self.current_user = result.username_hash
 
         self.InterfaceObj.info('\nAccount created successfully.')
 
@@ -370,13 +713,12 @@ class Login:
         Method for displaying the landing page after a successful login. 
         '''
         
-        # get user info from file
-        with open(self.userdata_path, 'r') as userdata_file:
-            userdata = json.load(userdata_file)
+        # get user info
+        profile = self.auth.get_profile(self.current_user).profile
 
         # print welcome message
         self.InterfaceObj.info(
-            f'Hello {userdata[self.current_user]["display_name"]}!'
+            f'Hello {profile["display_name"]}!'
         )
 
         # loop
@@ -406,10 +748,6 @@ class Login:
         '''
 
         while True:
-            # get current credentials from file
-            with open(self.userdata_path, 'r') as userdata_file:
-                userdata = json.load(userdata_file)
-
             # print title
             self.InterfaceObj.info(
                 'Account Options',
@@ -430,39 +768,20 @@ class Login:
             match choice:
                 case 0:
                     while True:
-                        # retrieve username and hash it
-                        username_hash = sha256(
-                            self.InterfaceObj.prompt(
-                                'Username: '
-                            ).encode()
-                        ).hexdigest()
-
-                        # if username already exists
-                        if username_hash in userdata:
-                            self.InterfaceObj.info(
-                                'Account already exists, please use a'
-                                    +'different name.',
-                                error=True
-                            )
-                            continue
-                        # if field blank
-                        elif not username_hash:
-                            self.InterfaceObj.info(
-                                'Field blank, please enter a username.',
-                                error=True
-                            )
+                        # retrieve username
+                        username = self.InterfaceObj.prompt(
+                            'Username: '
+                        )
+
+                        # move current user details to new username
+                        result = self.auth.rename(self.current_user, username)
+                        if not result.ok:
+                            self.InterfaceObj.info(result.message, error=True)
                             continue
                         else:
                             break
 
-                    # move current user details to new username
-                    userdata[username_hash] = userdata[self.current_user].copy()
-                    userdata.pop(self.current_user)
-                    self.current_user = username_hash
-
-                    # write new data to file
-                    with open(self.userdata_path, 'w') as userdata_file:
-                        json.dump(userdata, userdata_file)
+                    self.current_user = result.username_hash
 
                     self.InterfaceObj.info('\nUsername changed successfully.')
                 case 1:
@@ -472,140 +791,71 @@ class Login:
                     )
                     
                     # change stored name
-                    userdata[self.current_user]['display_name'] = display_name
-
-                    # write new data to file
-                    with open(self.userdata_path, 'w') as userdata_file:
-                        json.dump(userdata, userdata_file)
+                    self.auth.update_profile(
+                        self.current_user,
+                        display_name=display_name
+                    )
 
                     self.InterfaceObj.info('\nDisplay Name changed successfully.')
                 case 2:
-                    while True:
-                        # retrieve an email address
-                        email_address = self.InterfaceObj.prompt(
-                            'Email Address: '
-                        )
-
-                        # check is the email is valid
-                        if fullmatch(r'[^@]+@[^@]+\.[^@]+', email_address):
-                            break
-                        else:
-                            self.InterfaceObj.info(
-                                'Email is invalid, please try again.',
-                                error=True
-                            )
-                            continue
+                    # retrieve an email address
+                    email_address = self.prompt_email(self.current_user)
 
                     # change stored email
-                    userdata[self.current_user]['email_address'] = email_address
-
-                    # write new data to file
-                    with open(self.userdata_path, 'w') as userdata_file:
-                        json.dump(userdata, userdata_file)
+                    result = self.auth.update_profile(
+                        self.current_user,
+                        email_address=email_address
+                    )
+                    if not result.ok:
+                        # e.g. taken by someone else in the meantime
+                        self.InterfaceObj.info(result.message, error=True)
+                        continue
 
                     self.InterfaceObj.info('\nEmail Address changed successfully.')
                 case 3:
-                    for i in range(3):
-                        # retrieve password and hash it
-                        password_hash = sha256(
-                            self.InterfaceObj.prompt(
-                                'Current Password: ',
-                                hidden=True
-                            ).encode()
-                        ).hexdigest()
-
-                        # check if password is correct
-                        if password_hash != userdata[self.current_user]['password']:
-                            if i < 2:
-                                self.InterfaceObj.info(
-                                    'Password is incorrect, please try again.',
-                                    error=True
-                                )
-                            else:
-                                self.InterfaceObj.info(
-                                    'Too many incorrect attempts. Exiting progam.',
-                                    error=True
-                                )
-                                return 
-                            continue
-                        else:
-                            break
-
+                    password = None
                     while True:
                         # retrieve password
-                        password = self.InterfaceObj.prompt(
-                            'New Password: ',
+                        current_password = self.InterfaceObj.prompt(
+                            'Current Password: ',
                             hidden=True
                         )
 
-                        # check if password is valid
-                        if len(password) < 8:
-                            self.InterfaceObj.info(
-                                'Password must be 8 or more characters, please try again.',
-                                error=True
-                            )
-                            continue
-                        elif password.lower() == password:
-                            self.InterfaceObj.info(
-                                'Password needs an uppercase, please try again.',
-                                error=True
-                            )
-                            continue
-                        elif password.upper() == password:
-                            self.InterfaceObj.info(
-                                'Password needs a lowercase, please try again.',
-                                error=True
+                        # retrieve the new password, kept if the current
+                        # one has to be entered again
+                        if password is None:
+                            password = self.prompt_new_password(
+                                'New Password: ',
+                                'Confirm New Password: '
                             )
-                            continue
-                        elif password.isalpha():
+
+                        # change stored password, checking the current one
+                        result = self.auth.change_password(
+                            self.current_user,
+                            current_password,
+                            password,
+                            client=None
+                        )
+                        del current_password
+                        if result.code not in ('password_incorrect',
+                                               'rate_limited'):
+                            break
+
+                        # stop once the rate limiter has locked the account
+                        if (result.code == 'rate_limited'
+                            or self.auth.retry_after(self.current_user, None)):
+                            del password
                             self.InterfaceObj.info(
-                                'Password needs a number, please try again.',
+                                'Too many incorrect attempts. Exiting progam.',
                                 error=True
                             )
-                            continue
-                        else:
-                            # if all requirements are met, hash the password
-                            password_hash = sha256(password.encode()).hexdigest()
-                            del password
-                            break
+                            return
+                        self.InterfaceObj.info(result.message, error=True)
 
-                    # retrieve a confirmation of the password
-                    confirm_password_hash = sha256(
-                        self.InterfaceObj.prompt(
-                            'Confirm New Password: ',
-                            hidden=True
-                        ).encode()
-                    ).hexdigest()
-
-                    # check if passwords match
-                    while password_hash != confirm_password_hash:
-                        self.InterfaceObj.info(
-                            'Passwords do not match, please try again.',
-                            error=True
-                        )
-
-                        # retrieve password
-                        password_hash = sha256(
-                            self.InterfaceObj.prompt(
-                                'New Password: ',
-                                hidden=True
-                            ).encode()
-                        ).hexdigest()
-
-                        # retrieve a confirmation of the password
-                        confirm_password_hash = sha256(
-                            self.InterfaceObj.prompt(
-                                'Confirm New Password: ',
-                                hidden=True
-                            ).encode()
-                        ).hexdigest()
-                        
-                    # change stored password
-                    userdata[self.current_user]['password'] = password_hash
-
-                    # write new data to file
-                    with open(self.userdata_path, 'w') as userdata_file:
-                        json.dump(userdata, userdata_file)
+                    del password
+                    if not result.ok:
+                        self.InterfaceObj.info(result.message, error=True)
+                        continue
 
                     self.InterfaceObj.info('\nPassword changed successfully.')
                 case 4:
@@ -644,13 +894,16 @@ class Login:
                     return
 
 
-def main() -> None:
+def interactive(store_path: str | None = None,
+                interface: Interface | None = None,
+                policy: 'ValidationPolicy | None' = None) -> None:
     '''
-    Controls the main program flow.
+    Runs the interactive login program, on the terminal unless given
+    another `Interface` driver.
     '''
 
     # initialise object
-    LoginObj = Login()
+    LoginObj = Login(path=store_path, interface=interface, policy=policy)
     
     # start auth
     choice = LoginObj.InterfaceObj.option(
@@ -667,10 +920,468 @@ def main() -> None:
     if LoginObj.current_user:
         # display program main menu
         LoginObj.main_menu()
+
+    # make sure every change is on disk, once hashing has finished
+    LoginObj.close()
     
     return
 
 
+def bulk_import(store_path: str, source: str, format: str | None,
+                chunk_size: int, replace: bool,
+                policy: 'ValidationPolicy | None' = None) -> None:
+    '''
+    Imports users from a CSV or JSON lines file, `-` for stdin.
+    '''
+
+    import bulk
+    from changefeed import ChangeFeed
+    from hashing import PasswordHasher
+    from store import open_store
+    from validation import default_policy
+
+    format = bulk.detect_format(source, format)
+    policy = policy or default_policy
+    store = open_store(store_path)
+    hasher = PasswordHasher()
+    # imported users are signups like any other to feed consumers
+    feed = ChangeFeed(f'{store_path}.changes')
+
+    try:
+        if source == '-':
+            rows = bulk.read_rows(sys.stdin, format)
+            report = bulk.import_users(
+                store,
+                hasher,
+                rows,
+                chunk_size,
+                replace,
+                policy,
+                feed
+            )
+        else:
+            with open(source, 'r', newline='') as source_file:
+                rows = bulk.read_rows(source_file, format)
+                report = bulk.import_users(
+                    store,
+                    hasher,
+                    rows,
+                    chunk_size,
+                    replace,
+                    policy,
+                    feed
+                )
+    finally:
+        hasher.close()
+        feed.close()
+        store.close()
+
+    # summarise
+    problems = report.invalid + [
+        (row_number, 'email_taken') for row_number in report.email_taken
+    ]
+    for row_number, error in sorted(problems):
+        print(f'Row {row_number}: {error}', file=sys.stderr)
+    print(f'Imported {report.imported}, skipped {report.skipped} existing '
+        f'and {len(report.email_taken)} with a taken email, rejected '
+        f'{len(report.invalid)} invalid.')
+
+    return
+
+
+def bulk_export(store_path: str, destination: str,
+                format: str | None) -> None:
+    '''
+    Exports every user to a CSV or JSON lines file, `-` for stdout.
+    '''
+
+    import bulk
+    from store import open_store
+
+    format = bulk.detect_format(destination, format)
+    store = open_store(store_path)
+
+    try:
+        if destination == '-':
+            count = bulk.export_users(store, sys.stdout, format)
+        else:
+            with open(destination, 'w', newline='') as destination_file:
+                count = bulk.export_users(store, destination_file, format)
+    finally:
+        store.close()
+
+    print(f'Exported {count} users.', file=sys.stderr)
+
+    return
+
+
+def password_audit(store_path: str, source: str,
+                   workers: int | None) -> None:
+    '''
+    Prints the username hash of every user whose password is in a file of
+    candidate passwords, one per line, `-` for stdin.
+    '''
+
+    import audit
+    from store import open_store
+
+    if source == '-':
+        candidates = sys.stdin.read().splitlines()
+    else:
+        with open(source, 'r') as source_file:
+            candidates = source_file.read().splitlines()
+
+    store = open_store(store_path)
+    found = 0
+
+    try:
+        for username_hash, _ in audit.audit_passwords(
+            store,
+            candidates,
+            workers
+        ):
+            print(username_hash, flush=True)
+            found += 1
+    finally:
+        store.close()
+
+    print(f'Found {found} users with a listed password.', file=sys.stderr)
+
+    return
+
+
+def build_breach_filter(source: str, destination: str, hashed: bool,
+                        count: int | None, error_rate: float) -> None:
+    '''
+    Builds a breach filter from a list of passwords, one per line, `-` for
+    stdin.
+    '''
+
+    import breachfilter
+
+    if source == '-':
+        keys = breachfilter.read_keys(sys.stdin, hashed)
+        added = breachfilter.build_filter(destination, keys, count, error_rate)
+    else:
+        with open(source, 'r', errors='replace') as source_file:
+            # size the filter from a first pass unless told the count
+            if count is None:
+                count = sum(1 for line in source_file if line.strip())
+                source_file.seek(0)
+
+            keys = breachfilter.read_keys(source_file, hashed)
+            added = breachfilter.build_filter(
+                destination,
+                keys,
+                count,
+                error_rate
+            )
+
+    print(f'Added {added} passwords to `{destination}`.', file=sys.stderr)
+
+    return
+
+
+def print_changes(store_path: str, offset: int, follow: bool,
+                  interval: float) -> None:
+    '''
+    Prints the account changes made after `offset` in the change feed as
+    JSON lines, each with the `offset` to resume from after it, and with
+    `follow` keeps printing new changes as they are made.
+    '''
+
+    import json
+
+    import changefeed
+
+    feed_path = f'{store_path}.changes'
+    if follow:
+        changes = changefeed.follow(feed_path, offset, interval)
+    else:
+        changes = changefeed.iter_changes(feed_path, offset)
+
+    for event, offset in changes:
+        print(json.dumps(event | {'offset': offset}), flush=True)
+
+    return
+
+
+def health_check(store_path: str, budget: float) -> int:
+    '''
+    Checks the program starts within `budget` seconds and could use its
+    store, without opening or creating anything, and returns the exit
+    status.
+    '''
+
+    problems = []
+
+    elapsed = time.perf_counter() - STARTED
+    if elapsed > budget:
+        problems.append(
+            f'Startup took {elapsed * 1000:.1f}ms, over the '
+            f'{budget * 1000:.0f}ms budget.'
+        )
+
+    # a missing store is created on first use, along with any missing
+    # directories, so only needs the nearest existing one to be writable
+    directory = os.path.dirname(os.path.abspath(store_path))
+    while not os.path.exists(directory):
+        directory = os.path.dirname(directory)
+    if os.path.exists(store_path):
+        if not os.access(store_path, os.R_OK | os.W_OK):
+            problems.append(f'Store `{store_path}` is not readable and '
+                'writable.')
+    elif not os.access(directory, os.W_OK | os.X_OK):
+        problems.append(f'Store `{store_path}` cannot be created.')
+
+    for problem in problems:
+        print(f'ERROR: {problem}', file=sys.stderr)
+    if problems:
+        return 1
+
+    print(f'OK: started in {elapsed * 1000:.1f}ms, store `{store_path}`.')
+
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int | None:
+    '''
+    Controls the main program flow, returning the exit status.
+    '''
+
+    import argparse
+
+    # parse the command line
+    parser = argparse.ArgumentParser(
+        description='Simple login feature that could be implemented into '
+            'another program.'
+    )
+    parser.add_argument(
+        '--store',
+        help='user database, `.db` files use SQLite '
+            '(default: userdata.json next to this file)'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='file to write metrics to, as Prometheus text for `.prom` '
+            'files or else as JSON lines'
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=10.0,
+        help='seconds between metrics writes'
+    )
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='check the program starts in time and could use its store, '
+            'then exit'
+    )
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=STARTUP_BUDGET,
+        help='seconds startup may take with --check '
+            f'(default: {STARTUP_BUDGET})'
+    )
+    parser.add_argument(
+        '--tenant',
+        help='application whose users to use, each kept in its own store'
+    )
+    parser.add_argument(
+        '--tenant-root',
+        action='append',
+        help='directory tenant stores are kept in, repeat to spread them '
+            'across several (default: tenants next to this file)'
+    )
+    parser.add_argument(
+        '--breach-filter',
+        help='breach filter built by `breach-filter`, new passwords found '
+            'in it are refused'
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    import_parser = commands.add_parser(
+        'import',
+        help='add users from a CSV or JSON lines file'
+    )
+    import_parser.add_argument('source', help='file to read, `-` for stdin')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'])
+    import_parser.add_argument('--chunk-size', type=int, default=1000)
+    import_parser.add_argument(
+        '--replace',
+        action='store_true',
+        help='overwrite existing users instead of skipping them'
+    )
+
+    export_parser = commands.add_parser(
+        'export',
+        help='write every user to a CSV or JSON lines file'
+    )
+    export_parser.add_argument(
+        'destination',
+        help='file to write, `-` for stdout'
+    )
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'])
+
+    audit_parser = commands.add_parser(
+        'audit',
+        help='find users whose password is in a list, such as a breach list'
+    )
+    audit_parser.add_argument(
+        'source',
+        help='file of candidate passwords, one per line, `-` for stdin'
+    )
+    audit_parser.add_argument(
+        '--workers',
+        type=int,
+        help='processes to check salted hashes on (default: CPU count)'
+    )
+
+    filter_parser = commands.add_parser(
+        'breach-filter',
+        help='build a breach filter from a list of breached passwords'
+    )
+    filter_parser.add_argument(
+        'source',
+        help='file of passwords, one per line, `-` for stdin'
+    )
+    filter_parser.add_argument('destination', help='filter file to write')
+    filter_parser.add_argument(
+        '--hashed',
+        action='store_true',
+        help='lines are SHA-1 hexdigests, optionally followed by `:COUNT`'
+    )
+    filter_parser.add_argument(
+        '--count',
+        type=int,
+        help='number of passwords in the list, needed when reading stdin '
+            '(default: counted from the file)'
+    )
+    filter_parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.001,
+        help='share of other passwords wrongly refused (default: 0.001)'
+    )
+
+    changes_parser = commands.add_parser(
+        'changes',
+        help='print account changes from the change feed as JSON lines'
+    )
+    changes_parser.add_argument(
+        '--offset',
+        type=int,
+        default=0,
+        help='offset to resume from, as given with the last change read'
+    )
+    changes_parser.add_argument(
+        '--follow',
+        action='store_true',
+        help='keep printing changes as they are made'
+    )
+    changes_parser.add_argument(
+        '--interval',
+        type=float,
+        default=1.0,
+        help='seconds between checks for new changes with --follow'
+    )
+
+    args = parser.parse_args(argv)
+    store_path = args.store or default_userdata_path()
+
+    # a tenant has its own store, found the same way as by `Login`
+    if args.tenant is not None:
+        from tenants import TenantRegistry
+
+        if args.store is not None:
+            parser.error('--store and --tenant cannot be used together')
+        registry = TenantRegistry(args.tenant_root or [default_tenant_root()])
+        try:
+            store_path = registry.path(args.tenant)
+        except ValueError as error:
+            parser.error(str(error))
+
+        # roots are created as they are first used, though not by a check
+        if not args.check:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+
+    # health checks exit before anything is setup
+    if args.check:
+        return health_check(store_path, args.budget)
+
+    if args.command == 'breach-filter':
+        if args.source == '-' and args.count is None:
+            parser.error('--count is needed to read passwords from stdin')
+        if not 0 < args.error_rate < 1:
+            parser.error('--error-rate must be between 0 and 1')
+
+    # refuse breached passwords when given a filter
+    policy = None
+    if args.breach_filter is not None:
+        from breachfilter import BreachFilter
+        from validation import ValidationPolicy
+
+        try:
+            policy = ValidationPolicy(
+                breach_filter=BreachFilter(args.breach_filter)
+            )
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    # only instrument when asked, so there is no cost otherwise
+    exporter = None
+    if args.metrics is not None:
+        from auth import AuthService
+        from metrics import MetricsExporter, metrics
+
+        metrics.enable()
+        metrics.instrument(Login, 'login_method_seconds')
+        metrics.instrument(AuthService, 'auth_method_seconds')
+        exporter = MetricsExporter(metrics, args.metrics, args.metrics_interval)
+
+    try:
+        match args.command:
+            case 'import':
+                bulk_import(
+                    store_path,
+                    args.source,
+                    args.format,
+                    args.chunk_size,
+                    args.replace,
+                    policy
+                )
+            case 'export':
+                bulk_export(store_path, args.destination, args.format)
+            case 'audit':
+                password_audit(store_path, args.source, args.workers)
+            case 'changes':
+                print_changes(
+                    store_path,
+                    args.offset,
+                    args.follow,
+                    args.interval
+                )
+            case 'breach-filter':
+                build_breach_filter(
+                    args.source,
+                    args.destination,
+                    args.hashed,
+                    args.count,
+                    args.error_rate
+                )
+            case _:
+                interactive(store_path, policy=policy)
+    finally:
+        if exporter is not None:
+            exporter.close()
+        if policy is not None:
+            policy.breach_filter.close()
+
+    return
+
+
 # only execute if called directly
 if __name__ == '__main__':
     try:
@@ -0,0 +1,356 @@
+'''
+# Metrics
+
+Opt-in counters and histograms for seeing where time goes: loading and
+writing the store, hashing, checking passwords and the `Login` flows.
+
+Everything records into the process-wide `metrics` registry, which is
+disabled by default. While disabled, the hot paths only check
+`metrics.enabled` and `instrument()` has not wrapped anything, so the
+cost is a single attribute lookup. Once enabled the registry can be
+written out as Prometheus text or as JSON lines, periodically, by a
+`MetricsExporter`.
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# upper bounds of the size buckets, 1 KiB to 1 GiB in bytes
+SIZE_BUCKETS = tuple(2 ** power for power in range(10, 31, 2))
+
+
+class Histogram:
+    '''
+    Counts of observed values falling in each bucket, with their total.
+    '''
+
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__(self, buckets: tuple) -> None:
+        '''
+        Initialises an empty histogram, with an extra bucket for values
+        above the last bound.
+        '''
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+        return
+
+    def observe(self, value: float) -> None:
+        '''
+        Records a value.
+        '''
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+        return
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        '''
+        Returns the count of values up to each bound, as Prometheus
+        reports them.
+        '''
+
+        running = 0
+        bounds = []
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            running += count
+            bounds.append((str(bound), running))
+
+        return bounds
+
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    '''
+    Returns labels in Prometheus `{name="value"}` form.
+    '''
+
+    pairs = (*labels, *extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(
+        f'{name}="' + str(value).replace('\\', '\\\\').replace(
+            '"', '\\"'
+        ).replace('\n', '\\n') + '"'
+        for name, value in pairs
+    ) + '}'
+
+
+class Metrics:
+    '''
+    Registry of counters and histograms, each identified by a name and
+    optional labels.
+
+    Nothing is recorded until `enable()` is called, callers on hot paths
+    should check `enabled` before doing any work to record.
+    '''
+
+    def __init__(self) -> None:
+        '''
+        Initialises an empty, disabled registry.
+        '''
+
+        self.enabled = False
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def enable(self) -> None:
+        '''
+        Starts recording.
+        '''
+
+        self.enabled = True
+
+        return
+
+    def disable(self) -> None:
+        '''
+        Stops recording, keeping what has been recorded.
+        '''
+
+        self.enabled = False
+
+        return
+
+    def reset(self) -> None:
+        '''
+        Forgets everything recorded.
+        '''
+
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+        return
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        '''
+        Adds to a counter.
+        '''
+
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+        return
+
+    def observe(self, name: str, value: float,
+                buckets: tuple = LATENCY_BUCKETS, **labels: str) -> None:
+        '''
+        Records a value in a histogram, created with `buckets` the first
+        time it is used.
+        '''
+
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+        return
+
+    def instrument(self, cls: type, name: str) -> None:
+        '''
+        Wraps every public method of a class so its duration is recorded
+        in the `name` histogram, labelled with the method name. Coroutine
+        methods are left alone.
+
+        Methods are only wrapped when this is called, so classes that are
+        never instrumented pay nothing.
+        '''
+
+        # imported here as it is slow to import and rarely needed
+        import inspect
+
+        for method_name, method in list(vars(cls).items()):
+            if (method_name.startswith('_')
+                or not inspect.isfunction(method)
+                or inspect.iscoroutinefunction(method)
+                or hasattr(method, '__wrapped__')):
+                continue
+
+            def wrap(method_name: str, method):
+                @functools.wraps(method)
+                def timed(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return method(*args, **kwargs)
+                    finally:
+                        self.observe(
+                            name,
+                            time.perf_counter() - started,
+                            method=method_name
+                        )
+
+                return timed
+
+            setattr(cls, method_name, wrap(method_name, method))
+
+        return
+
+    def snapshot(self) -> dict:
+        '''
+        Returns everything recorded so far as plain data, keyed by the
+        name and labels in Prometheus form.
+        '''
+
+        with self._lock:
+            counters = {
+                name + format_labels(labels): value
+                for (name, labels), value in sorted(self._counters.items())
+            }
+            histograms = {
+                name + format_labels(labels): {
+                    'count': histogram.count,
+                    'sum': histogram.total,
+                    'buckets': dict(histogram.cumulative())
+                }
+                for (name, labels), histogram in
+                sorted(self._histograms.items())
+            }
+
+        return {
+            'time': time.time(),
+            'counters': counters,
+            'histograms': histograms
+        }
+
+    def prometheus(self) -> str:
+        '''
+        Returns everything recorded so far in the Prometheus text format.
+        '''
+
+        lines = []
+        typed = set()
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                for bound, count in histogram.cumulative():
+                    lines.append(
+                        f'{name}_bucket'
+                        f'{format_labels(labels, (("le", bound),))} {count}'
+                    )
+                lines.append(
+                    f'{name}_sum{format_labels(labels)} {histogram.total}'
+                )
+                lines.append(
+                    f'{name}_count{format_labels(labels)} {histogram.count}'
+                )
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    '''
+    Writes a registry out every `interval` seconds on a background
+    thread, and once more when closed.
+
+    Files ending in `.prom` or `.txt` are rewritten whole in the
+    Prometheus text format, suitable for a textfile collector. Anything
+    else has a JSON line appended for each snapshot.
+    '''
+
+    def __init__(self, registry: Metrics, path: str,
+                 interval: float = 10.0) -> None:
+        '''
+        Initialises the object and starts the background thread.
+        '''
+
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.format = (
+            'prometheus'
+            if os.path.splitext(path)[1].lower() in ('.prom', '.txt')
+            else 'jsonl'
+        )
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='metrics-exporter',
+            daemon=True
+        )
+        self._thread.start()
+
+        return
+
+    def _run(self) -> None:
+        '''
+        Writes the registry out until stopped.
+        '''
+
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+        return
+
+    def write(self) -> None:
+        '''
+        Writes the registry out now.
+        '''
+
+        if self.format == 'prometheus':
+            # swap the file in whole so it is never read half written
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as metrics_file:
+                metrics_file.write(self.registry.prometheus())
+            os.replace(temp_path, self.path)
+        else:
+            with open(self.path, 'a') as metrics_file:
+                metrics_file.write(
+                    json.dumps(self.registry.snapshot()) + '\n'
+                )
+
+        return
+
+    def close(self) -> None:
+        '''
+        Stops the background thread and writes the final figures.
+        '''
+
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+        return
+
+
+# registry shared by everything in the process
+metrics = Metrics()
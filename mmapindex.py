@@ -0,0 +1,148 @@
+'''
+# Mapped Index
+
+Read-only index from username hash to where that user's record sits in
+a JSON snapshot, so one record can be read without parsing the rest.
+
+The index is an open addressing table kept in a file and memory mapped,
+so a lookup probes it in place and only touches the pages it needs,
+however many users there are. Layout, little endian:
+
+    header  magic, snapshot size and mtime, slot count
+    slots   32 byte username digest, record offset and length
+
+An all zero digest marks an empty slot, and the table is never more than
+70% full so a probe rarely goes past the first slot. The header records
+which snapshot the offsets belong to, and an index that does not match
+the snapshot on disk must not be used. Copies of a snapshot that keep
+its modification time, such as `cp -p`, keep their index.
+'''
+
+import mmap
+import os
+import struct
+
+
+MAGIC = b'LFI1'
+HEADER = struct.Struct('<4sQqQ')
+SLOT = struct.Struct('<32sQI')
+
+# digest of an unused slot
+EMPTY = bytes(32)
+
+# highest fraction of slots in use
+MAX_LOAD = 0.7
+
+
+def snapshot_signature(stat: os.stat_result) -> tuple[int, int]:
+    '''
+    Returns what identifies a snapshot, from its `os.stat()`.
+    '''
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def write_index(path: str, entries: list[tuple[str, int, int]],
+                signature: tuple[int, int]) -> None:
+    '''
+    Writes an index over `(username_hash, offset, length)` entries for
+    the snapshot with `signature`, replacing any old index in one step.
+    '''
+
+    slots = int(len(entries) / MAX_LOAD) + 1
+    table = bytearray(HEADER.size + slots * SLOT.size)
+    HEADER.pack_into(table, 0, MAGIC, *signature, slots)
+
+    for username_hash, offset, length in entries:
+        digest = bytes.fromhex(username_hash)
+
+        # step along from the home slot to the first free one
+        slot = int.from_bytes(digest[:8], 'little') % slots
+        while True:
+            position = HEADER.size + slot * SLOT.size
+            if table[position:position + 32] == EMPTY:
+                break
+            slot = (slot + 1) % slots
+        SLOT.pack_into(table, position, digest, offset, length)
+
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(table)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(temp_path, path)
+
+    return
+
+
+class MappedIndex:
+    '''
+    An index file mapped into memory for probing.
+    '''
+
+    def __init__(self, path: str) -> None:
+        '''
+        Maps an index file, raising `ValueError` if it is not one.
+        '''
+
+        with open(path, 'rb') as index_file:
+            stat = os.fstat(index_file.fileno())
+            if stat.st_size < HEADER.size:
+                raise ValueError(f'Not an index: {path}')
+            self._map = mmap.mmap(
+                index_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+
+        magic, *signature, slots = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or stat.st_size != HEADER.size + slots * SLOT.size:
+            self._map.close()
+            raise ValueError(f'Not an index: {path}')
+
+        # the snapshot the offsets point into, and this file itself
+        self.signature = tuple(signature)
+        self.file_id = stat.st_ino
+        self.slots = slots
+
+        return
+
+    @classmethod
+    def open(cls, path: str) -> 'MappedIndex | None':
+        '''
+        Returns the index at `path`, or `None` if there is no valid one.
+        '''
+
+        try:
+            return cls(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def lookup(self, username_hash: str) -> tuple[int, int] | None:
+        '''
+        Returns the offset and length of a user's record in the snapshot,
+        or `None` if the user is not in it.
+        '''
+
+        digest = bytes.fromhex(username_hash)
+        slot = int.from_bytes(digest[:8], 'little') % self.slots
+
+        for _ in range(self.slots):
+            position = HEADER.size + slot * SLOT.size
+            slot_digest, offset, length = SLOT.unpack_from(self._map, position)
+            if slot_digest == digest:
+                return offset, length
+            if slot_digest == EMPTY:
+                return None
+            slot = (slot + 1) % self.slots
+
+        return None
+
+    def close(self) -> None:
+        '''
+        Unmaps the file.
+        '''
+
+        self._map.close()
+
+        return
@@ -0,0 +1,196 @@
+'''
+# Rate Limiting
+
+Token bucket limiter for failed login attempts, shared by every caller
+of `auth.AuthService`.
+
+Each key, such as a username hash or a client address, has a bucket of
+`capacity` tokens that refills at one token every `refill_time` seconds.
+Every failed attempt takes a token, and once a bucket is empty further
+attempts for that key are refused, before any password hashing or store
+access, until it refills. Only the `max_keys` most recently used buckets
+are kept, and they can be saved to a file so a restart does not reset
+them.
+'''
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class RateLimiter:
+    '''
+    Collection of methods for tracking and limiting attempts per key.
+    '''
+
+    def __init__(self, capacity: int = 5, refill_time: float = 60.0,
+                 max_keys: int = 100_000, path: str | None = None,
+                 save_interval: float = 10.0) -> None:
+        '''
+        Initialises the object, loading saved buckets if `path` exists.
+        '''
+
+        self.capacity = capacity
+        self.refill_time = refill_time
+        self.max_keys = max_keys
+        self.path = path
+        self.save_interval = save_interval
+
+        # (tokens, last update time) for each key, least recently used first
+        self._buckets = OrderedDict()
+        self._reset_keys = set()
+        self._lock = threading.Lock()
+        self._last_save = time.time()
+
+        if path is not None:
+            self._buckets.update(self._read_saved())
+
+        return
+
+    def _read_saved(self) -> dict:
+        '''
+        Returns the buckets saved in the state file.
+        '''
+
+        try:
+            with open(self.path, 'r') as state_file:
+                saved = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+        return {key: tuple(bucket) for key, bucket in saved.items()}
+
+    def _tokens(self, key: str, now: float) -> float:
+        '''
+        Returns how many tokens a key has, refilled up to `now`.
+        '''
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(self.capacity)
+
+        tokens, updated = bucket
+
+        return min(
+            float(self.capacity),
+            tokens + (now - updated) / self.refill_time
+        )
+
+    def retry_after(self, *keys: str) -> float:
+        '''
+        Returns how many seconds until every key may be tried again, or
+        `0` if they may be tried now.
+        '''
+
+        now = time.time()
+        wait = 0.0
+
+        with self._lock:
+            for key in keys:
+                tokens = self._tokens(key, now)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) * self.refill_time)
+
+        return wait
+
+    def consume(self, *keys: str) -> None:
+        '''
+        Takes a token from each key, after a failed attempt.
+        '''
+
+        now = time.time()
+        locked = False
+
+        with self._lock:
+            for key in keys:
+                tokens = max(0.0, self._tokens(key, now) - 1)
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+                self._reset_keys.discard(key)
+                locked = locked or tokens < 1
+
+            # forget the least recently used keys
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        if metrics.enabled:
+            metrics.increment('ratelimit_consumed_total', len(keys))
+            if locked:
+                metrics.increment('ratelimit_lockouts_total')
+
+        # save straight away once a key is locked out
+        if self.path is not None and (
+            locked or now - self._last_save >= self.save_interval
+        ):
+            self.save()
+
+        return
+
+    def reset(self, *keys: str) -> None:
+        '''
+        Refills the buckets of keys, after a successful attempt.
+        '''
+
+        with self._lock:
+            for key in keys:
+                if self._buckets.pop(key, None) is not None:
+                    self._reset_keys.add(key)
+
+        return
+
+    def save(self) -> None:
+        '''
+        Writes the buckets that are not full to the state file, keeping
+        whichever of the saved and current buckets is emptier so other
+        processes sharing the file are not undone. Keys reset here since
+        the last save are dropped from the file.
+        '''
+
+        if self.path is None:
+            return
+
+        now = time.time()
+
+        with self._lock:
+            merged = self._read_saved()
+            for key in self._reset_keys:
+                merged.pop(key, None)
+            self._reset_keys.clear()
+            for key, bucket in self._buckets.items():
+                saved = merged.get(key)
+                if saved is None or self._tokens(key, now) < (
+                    saved[0] + (now - saved[1]) / self.refill_time
+                ):
+                    merged[key] = bucket
+
+            # full buckets are the same as no bucket
+            state = {
+                key: (tokens, updated)
+                for key, (tokens, updated) in merged.items()
+                if tokens + (now - updated) / self.refill_time < self.capacity
+            }
+            self._last_save = now
+
+        # swap the file in whole
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.path)
+
+        return
+
+    def close(self) -> None:
+        '''
+        Saves the buckets, if there is a state file.
+        '''
+
+        self.save()
+
+        return
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+
+'''
+# Login Server
+
+Minimal HTTP/1.1 JSON front end for `auth.AuthService`, built on
+`asyncio` streams.
+
+Endpoints, all `POST` with a JSON object body:
+
+    /login    {username, password}
+    /signup   {username, display_name, email_address, password}
+    /account  {token, or username and password, and any of
+               new_username, display_name, email_address,
+               new_password (which also needs password)}
+    /logout   {token}
+
+Each responds with `{ok, code, message, profile, token}`, where a
+successful login returns a session token that later requests can send
+instead of the password, skipping password hashing. Connections are kept
+alive, and pipelined requests are read and parsed ahead while earlier
+ones are still being served. Requests on one connection take effect in
+the order sent, requests on different connections run concurrently.
+Service calls, and so password hashing, run on an executor so the event
+loop is never blocked.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from auth import AuthResult, AuthService, hash_username
+from breachfilter import BreachFilter
+from changefeed import ChangeFeed
+from hashing import PasswordHasher
+from metrics import MetricsExporter, metrics
+from sessions import SessionManager
+from store import open_store
+from validation import ValidationPolicy
+
+
+# status code used for each result code
+STATUS_CODES = {
+    'ok': 200,
+    'account_missing': 401,
+    'password_incorrect': 401,
+    'account_exists': 409,
+    'email_taken': 409,
+    'conflict': 409,
+    'session_invalid': 401,
+    'rate_limited': 429
+}
+
+# reason phrases for the status codes sent
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error'
+}
+
+# limits on what a client may send
+MAX_HEADER_LINES = 100
+MAX_BODY_SIZE = 64 * 1024
+
+# most requests read ahead per connection
+PIPELINE_DEPTH = 16
+
+
+def fields_are_text(body: dict, *names: str) -> bool:
+    '''
+    Returns whether each named field of a request body is text, or
+    missing or `null`, which are taken as blank.
+    '''
+
+    return all(
+        body.get(name) is None or isinstance(body[name], str)
+        for name in names
+    )
+
+
+class BadRequest(Exception):
+    '''
+    Raised when a request cannot be parsed.
+    '''
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class LoginServer:
+    '''
+    Collection of methods for serving an `AuthService` over HTTP.
+    '''
+
+    def __init__(self, auth: AuthService, workers: int | None = None) -> None:
+        '''
+        Initialises the object.
+
+        `workers` bounds how many service calls run at once.
+        '''
+
+        self.auth = auth
+        self.executor = ThreadPoolExecutor(
+            workers or min(32, (os.cpu_count() or 1) * 4),
+            thread_name_prefix='login-server'
+        )
+
+        # handlers for each path
+        self.routes = {
+            '/login': self.handle_login,
+            '/signup': self.handle_signup,
+            '/account': self.handle_account,
+            '/logout': self.handle_logout
+        }
+
+        return
+
+    def handle_login(self, body: dict, client: str) -> AuthResult:
+        '''
+        Checks a username and password.
+        '''
+
+        if not fields_are_text(body, 'username', 'password'):
+            return AuthResult('field_invalid')
+
+        return self.auth.authenticate(
+            body.get('username') or '',
+            body.get('password') or '',
+            client
+        )
+
+    def handle_signup(self, body: dict, client: str) -> AuthResult:
+        '''
+        Creates a new user.
+        '''
+
+        fields = ('username', 'display_name', 'email_address', 'password')
+        if not fields_are_text(body, *fields):
+            return AuthResult('field_invalid')
+
+        return self.auth.register(*(body.get(name) or '' for name in fields))
+
+    def handle_account(self, body: dict, client: str) -> AuthResult:
+        '''
+        Changes the account of a user, after checking their session token
+        or password.
+        '''
+
+        # optional fields left `null` are taken as not given
+        if not fields_are_text(body, 'username', 'password', 'token',
+                'new_password', 'display_name', 'email_address',
+                'new_username'):
+            return AuthResult('field_invalid')
+
+        # a password is checked without starting a session, and only once,
+        # by the password change itself when there is one
+        password = body.get('password') or ''
+        new_password = body.get('new_password')
+        if body.get('token') is not None:
+            result = self.auth.resume(body['token'])
+        else:
+            username = body.get('username') or ''
+            error = self.auth.policy.validate_username(username)
+            if error:
+                return AuthResult(error)
+            result = AuthResult('ok', hash_username(username))
+            if new_password is None:
+                result = self.auth.verify(result.username_hash, password,
+                    client)
+        if not result.ok:
+            return result
+        username_hash = result.username_hash
+        token = result.token
+
+        # apply each requested change in turn
+        if new_password is not None:
+            result = self.auth.change_password(
+                username_hash,
+                password,
+                new_password,
+                client
+            )
+            if not result.ok:
+                return result
+        if (body.get('display_name') is not None
+            or body.get('email_address') is not None):
+            result = self.auth.update_profile(
+                username_hash,
+                display_name=body.get('display_name'),
+                email_address=body.get('email_address')
+            )
+            if not result.ok:
+                return result
+        if body.get('new_username') is not None:
+            result = self.auth.rename(username_hash, body['new_username'])
+            if not result.ok:
+                return result
+        if result.profile is None:
+            result = self.auth.get_profile(username_hash)
+
+        # a changed password ends the session it was changed in
+        if new_password is None:
+            result.token = token
+
+        return result
+
+    def handle_logout(self, body: dict, client: str) -> AuthResult:
+        '''
+        Ends a session.
+        '''
+
+        if not fields_are_text(body, 'token'):
+            return AuthResult('field_invalid')
+
+        return self.auth.logout(body.get('token') or '')
+
+    async def read_request(self, reader: asyncio.StreamReader
+                           ) -> tuple[str, str, dict, bytes] | None:
+        '''
+        Reads one request from a connection, returning its method, path,
+        headers and body, or `None` once the client has finished.
+        '''
+
+        # skip blank lines allowed between requests
+        request_line = b'\r\n'
+        while request_line in (b'\r\n', b'\n'):
+            request_line = await reader.readline()
+        if not request_line:
+            return None
+
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400, 'Malformed request line')
+
+        # read headers up to the blank line
+        headers = {'_version': version}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise BadRequest(400, 'Too many headers')
+
+        # read the body
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest(400, 'Invalid Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise BadRequest(413, 'Body too large')
+        body = await reader.readexactly(length) if length else b''
+
+        return method, path, headers, body
+
+    async def respond(self, method: str, path: str, body: bytes,
+                      client: str, previous: asyncio.Task | None = None
+                      ) -> tuple[int, dict]:
+        '''
+        Works out the status and JSON payload for a request, once the
+        `previous` request on the connection has been served.
+        '''
+
+        # keep the effects of a connection's requests in order
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        handler = self.routes.get(path)
+        if handler is None:
+            return 404, {'ok': False, 'code': 'not_found'}
+        if method != 'POST':
+            return 405, {'ok': False, 'code': 'method_not_allowed'}
+
+        try:
+            payload = json.loads(body or b'{}')
+            if not isinstance(payload, dict):
+                raise ValueError
+        except ValueError:
+            return 400, {'ok': False, 'code': 'invalid_json'}
+
+        # run the service call, and its hashing, off the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self.executor,
+                handler,
+                payload,
+                client
+            )
+        except Exception:
+            return 500, {'ok': False, 'code': 'server_error'}
+
+        metrics.increment('server_results_total', path=path, code=result.code)
+
+        return STATUS_CODES.get(result.code, 400), {
+            'ok': result.ok,
+            'code': result.code,
+            'message': result.message,
+            'profile': result.profile,
+            'token': result.token
+        }
+
+    @staticmethod
+    def keep_alive(headers: dict) -> bool:
+        '''
+        Returns whether the client wants the connection kept open.
+        '''
+
+        connection = headers.get('connection', '').lower()
+        if headers['_version'] == 'HTTP/1.0':
+            return connection == 'keep-alive'
+
+        return connection != 'close'
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        '''
+        Serves requests on one connection until the client is done.
+        '''
+
+        # responses waiting to be sent, in request order
+        pending = asyncio.Queue(PIPELINE_DEPTH)
+
+        # failed logins are limited per client address
+        peer = writer.get_extra_info('peername')
+        client = peer[0] if peer else 'unknown'
+
+        async def send_responses() -> None:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                response_task, keep_alive = item
+                status, payload = await response_task
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                    'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}'
+                    '\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+
+        sender = asyncio.create_task(send_responses())
+        previous = None
+
+        try:
+            while not sender.done():
+                try:
+                    request = await self.read_request(reader)
+                except BadRequest as error:
+                    # answer, then drop the connection as it is out of step
+                    response = asyncio.get_running_loop().create_future()
+                    response.set_result(
+                        (error.status, {'ok': False, 'code': 'bad_request'})
+                    )
+                    await pending.put((response, False))
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+
+                # queue the request behind the one before it
+                method, path, headers, body = request
+                keep_alive = self.keep_alive(headers)
+                previous = asyncio.create_task(
+                    self.respond(method, path, body, client, previous)
+                )
+                await pending.put((previous, keep_alive))
+                if not keep_alive:
+                    break
+
+            if not sender.done():
+                await pending.put(None)
+            await sender
+        except ConnectionError:
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+        return
+
+    async def serve(self, host: str, port: int) -> None:
+        '''
+        Serves connections until cancelled.
+        '''
+
+        server = await asyncio.start_server(
+            self.handle_connection,
+            host,
+            port
+        )
+        async with server:
+            await server.serve_forever()
+
+        return
+
+    def close(self) -> None:
+        '''
+        Waits for running service calls and shuts down the executor.
+        '''
+
+        self.executor.shutdown()
+
+        return
+
+
+def main() -> None:
+    '''
+    Parses arguments and runs the server.
+    '''
+
+    parser = argparse.ArgumentParser(
+        description='Serves the login feature over HTTP.'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--store',
+        default=os.path.join(os.path.dirname(__file__), 'userdata.json'),
+        help='user database, `.db` files use SQLite'
+    )
+    parser.add_argument(
+        '--sessions',
+        help='file to keep sessions in across restarts'
+    )
+    parser.add_argument(
+        '--session-ttl',
+        type=int,
+        default=3600,
+        help='seconds a session lasts'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='most service calls to run at once'
+    )
+    parser.add_argument(
+        '--feed',
+        help='file to publish account changes to '
+            '(default: the store path with `.changes` added)'
+    )
+    parser.add_argument(
+        '--breach-filter',
+        help='breach filter built by `login.py breach-filter`, new '
+            'passwords found in it are refused'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='file to write metrics to, as Prometheus text for `.prom` '
+            'files or else as JSON lines'
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=10.0,
+        help='seconds between metrics writes'
+    )
+    args = parser.parse_args()
+
+    # only instrument when asked, so there is no cost otherwise
+    exporter = None
+    if args.metrics is not None:
+        metrics.enable()
+        metrics.instrument(LoginServer, 'server_handler_seconds')
+        metrics.instrument(AuthService, 'auth_method_seconds')
+        exporter = MetricsExporter(metrics, args.metrics, args.metrics_interval)
+
+    # refuse breached passwords when given a filter
+    policy = None
+    if args.breach_filter is not None:
+        try:
+            policy = ValidationPolicy(
+                breach_filter=BreachFilter(args.breach_filter)
+            )
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    # setup the service
+    store = open_store(args.store)
+    hasher = PasswordHasher()
+    sessions = SessionManager(args.session_ttl, path=args.sessions)
+    feed = ChangeFeed(args.feed or f'{args.store}.changes')
+    server = LoginServer(
+        AuthService(store, hasher, sessions, policy=policy, feed=feed),
+        args.workers
+    )
+
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    finally:
+        server.close()
+        hasher.close()
+        sessions.close()
+        feed.close()
+        store.close()
+        if policy is not None:
+            policy.breach_filter.close()
+        if exporter is not None:
+            exporter.close()
+
+    return
+
+
+# only execute if called directly
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print()
+        sys.exit()
@@ -0,0 +1,446 @@
+'''
+# Sessions
+
+Signed session tokens, so a client that has logged in once can prove it
+on later requests without its password being hashed again.
+
+A token looks like `<session id>.<expiry>.<signature>`, where the
+signature is an HMAC-SHA256 of the id and expiry under a secret key. A
+token is rejected on its signature or expiry alone before the session
+table is touched, and looking up a session is a single dict access.
+Expired sessions are evicted in bulk using a timing wheel of expiry
+slots, so there is never a scan over every session.
+
+With a `path`, every change is appended to a log shared by all the
+processes using it. Each process replays what the others have appended
+before checking or changing a session, so a token issued or revoked in
+one process is seen by the rest.
+
+Tokens are for the HTTP server's clients. The interactive `Login` asks
+for the password on every run and does not use them.
+'''
+
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from base64 import urlsafe_b64encode
+from contextlib import contextmanager
+from hashlib import sha256
+
+from store import file_lock
+
+
+class Session:
+    '''
+    A logged in user.
+    '''
+
+    __slots__ = ('session_id', 'username_hash', 'expires')
+
+    def __init__(self, session_id: str, username_hash: str,
+                 expires: int) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.session_id = session_id
+        self.username_hash = username_hash
+        self.expires = expires
+
+        return
+
+
+class SessionManager:
+    '''
+    Collection of methods for issuing, checking and revoking sessions.
+
+    `ttl` is how many seconds a session lasts and `slot_size` how many
+    seconds of expiry times share a slot of the eviction wheel. If `path`
+    is given, sessions and the signing key are kept on disk so they
+    survive a restart and can be shared with later invocations.
+    '''
+
+    def __init__(self, ttl: int = 3600, slot_size: int = 60,
+                 path: str | None = None) -> None:
+        '''
+        Initialises the object, loading saved sessions if `path` exists.
+        '''
+
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.path = path
+
+        # sessions by id, and ids by user and expiry slot
+        self._sessions = {}
+        self._by_user = {}
+        self._wheel = {}
+        self._next_slot = int(time.time()) // slot_size
+
+        self._lock = threading.Lock()
+        self._log_file = None
+        self._lock_file = None
+
+        # which log file has been replayed, and how far
+        self._log_id = None
+        self._offset = 0
+
+        if path is None:
+            self._key = secrets.token_bytes(32)
+        else:
+            # processes sharing the files take turns creating the key and
+            # rewriting the log
+            self._lock_file = open(f'{path}.lock', 'a')
+            with file_lock(self._lock_file):
+                self._key = self._load_key(f'{path}.key')
+                self._load()
+
+        return
+
+    @staticmethod
+    def _load_key(key_path: str) -> bytes:
+        '''
+        Reads the signing key, creating it readable only by the owner if
+        not present.
+        '''
+
+        key = secrets.token_bytes(32)
+        try:
+            # only ever created once, so every process signs with one key
+            descriptor = os.open(key_path,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(descriptor, 'wb') as key_file:
+                key_file.write(key)
+            return key
+
+        # without locking, the process creating it may not be done yet
+        for _ in range(50):
+            with open(key_path, 'rb') as key_file:
+                key = key_file.read()
+            if len(key) >= 32:
+                break
+            time.sleep(0.01)
+
+        return key
+
+    def _replay(self, log_file) -> None:
+        '''
+        Applies the complete events in an open session log from where it
+        is positioned, moving the replayed offset past them.
+        '''
+
+        now = int(time.time())
+
+        for line in log_file:
+            if not line.endswith(b'\n'):
+                # partly written, or by a crash
+                break
+            self._offset += len(line)
+
+            event = json.loads(line)
+            match event['op']:
+                case 'issue' if event['expires'] > now:
+                    self._add(Session(
+                        event['id'],
+                        event['user'],
+                        event['expires']
+                    ))
+                case 'revoke':
+                    self._remove(event['id'])
+                case 'rename':
+                    self._move(event['user'], event['new_user'])
+
+        return
+
+    def _load(self) -> None:
+        '''
+        Replays the saved session log, then rewrites it without expired
+        or revoked sessions.
+
+        Must be called with the file lock held exclusively, so no other
+        process appends while the log is read and replaced.
+        '''
+
+        try:
+            with open(self.path, 'rb') as log_file:
+                self._replay(log_file)
+        except FileNotFoundError:
+            pass
+
+        # write out only what is still live
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as log_file:
+            for session in self._sessions.values():
+                log_file.write(
+                    json.dumps(self._issue_event(session)).encode() + b'\n'
+                )
+            self._offset = log_file.tell()
+            self._log_id = os.fstat(log_file.fileno()).st_ino
+        os.replace(temp_path, self.path)
+
+        return
+
+    def _catch_up(self) -> None:
+        '''
+        Replays the events other processes have appended to the saved
+        session log since it was last read. If another process has
+        rewritten the log meanwhile, it is replayed from the start, as
+        the new log holds every live session.
+
+        Must be called with the thread lock and the file lock held.
+        '''
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        if stat.st_ino != self._log_id:
+            self._sessions.clear()
+            self._by_user.clear()
+            self._wheel.clear()
+            self._log_id = stat.st_ino
+            self._offset = 0
+
+        if stat.st_size > self._offset:
+            with open(self.path, 'rb') as log_file:
+                log_file.seek(self._offset)
+                self._replay(log_file)
+
+        return
+
+    @contextmanager
+    def _synced(self, exclusive: bool = False):
+        '''
+        Holds the thread lock for the `with` block and, with a saved log,
+        the file lock, after catching up with the log. The file lock is
+        shared for reading sessions and exclusive for changing them, so
+        appends are never interleaved with other processes' catching up.
+        '''
+
+        with self._lock:
+            if self.path is None:
+                yield
+            else:
+                with file_lock(self._lock_file, exclusive):
+                    self._catch_up()
+                    yield
+
+        return
+
+    @staticmethod
+    def _issue_event(session: Session) -> dict:
+        '''
+        Returns the log event recording a session.
+        '''
+
+        return {
+            'op': 'issue',
+            'id': session.session_id,
+            'user': session.username_hash,
+            'expires': session.expires
+        }
+
+    def _log(self, event: dict) -> None:
+        '''
+        Appends an event to the saved session log, if there is one.
+
+        Must be called inside `_synced(exclusive=True)`, so the event
+        follows everything already replayed.
+        '''
+
+        if self.path is None:
+            return
+
+        # reopen if another process has rewritten the log since
+        if (self._log_file is not None
+            and os.fstat(self._log_file.fileno()).st_ino != self._log_id):
+            self._log_file.close()
+            self._log_file = None
+
+        if self._log_file is None:
+            self._log_file = open(self.path, 'ab')
+        self._log_file.write(json.dumps(event).encode() + b'\n')
+        self._log_file.flush()
+        self._offset = os.fstat(self._log_file.fileno()).st_size
+
+        return
+
+    def _sign(self, payload: str) -> str:
+        '''
+        Returns the signature of a token payload.
+        '''
+
+        digest = hmac.new(self._key, payload.encode(), sha256).digest()
+
+        return urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def _add(self, session: Session) -> None:
+        '''
+        Puts a session in the table, the user index and the wheel.
+        '''
+
+        self._sessions[session.session_id] = session
+        self._by_user.setdefault(session.username_hash, set()).add(
+            session.session_id
+        )
+        self._wheel.setdefault(session.expires // self.slot_size, set()).add(
+            session.session_id
+        )
+
+        return
+
+    def _remove(self, session_id: str) -> Session | None:
+        '''
+        Takes a session out of the table and the user index. Its wheel
+        entry is left to be dropped when its slot is evicted.
+        '''
+
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            user_sessions = self._by_user.get(session.username_hash)
+            if user_sessions is not None:
+                user_sessions.discard(session_id)
+                if not user_sessions:
+                    del self._by_user[session.username_hash]
+
+        return session
+
+    def _move(self, username_hash: str, new_username_hash: str) -> None:
+        '''
+        Hands every session of a user over to a new username hash.
+        '''
+
+        session_ids = self._by_user.pop(username_hash, set())
+        for session_id in session_ids:
+            self._sessions[session_id].username_hash = new_username_hash
+        if session_ids:
+            self._by_user.setdefault(new_username_hash, set()).update(
+                session_ids
+            )
+
+        return
+
+    def _evict(self, now: int) -> None:
+        '''
+        Drops every session in the slots that have fully passed.
+        '''
+
+        current_slot = now // self.slot_size
+        while self._next_slot < current_slot:
+            for session_id in self._wheel.pop(self._next_slot, ()):
+                self._remove(session_id)
+            self._next_slot += 1
+
+        return
+
+    def issue(self, username_hash: str) -> str:
+        '''
+        Starts a session for a user, returning its token.
+        '''
+
+        now = int(time.time())
+        session = Session(secrets.token_urlsafe(16), username_hash,
+            now + self.ttl)
+
+        with self._synced(exclusive=True):
+            self._evict(now)
+            self._add(session)
+            self._log(self._issue_event(session))
+
+        payload = f'{session.session_id}.{session.expires}'
+
+        return f'{payload}.{self._sign(payload)}'
+
+    def validate(self, token: str) -> str | None:
+        '''
+        Returns the username hash a token belongs to, or `None` if the
+        token is forged, expired or revoked.
+        '''
+
+        # check the token itself before touching the table
+        payload, _, signature = token.rpartition('.')
+        session_id, _, expires = payload.partition('.')
+        if not hmac.compare_digest(
+            self._sign(payload).encode(),
+            signature.encode()
+        ):
+            return None
+        now = int(time.time())
+        if not expires.isdigit() or int(expires) <= now:
+            return None
+
+        # other processes may have issued or revoked it
+        with self._synced():
+            self._evict(now)
+            session = self._sessions.get(session_id)
+
+        if session is None or session.expires <= now:
+            return None
+
+        return session.username_hash
+
+    def revoke(self, token: str) -> None:
+        '''
+        Ends the session a token belongs to.
+        '''
+
+        session_id = token.partition('.')[0]
+
+        with self._synced(exclusive=True):
+            if self._remove(session_id) is not None:
+                self._log({'op': 'revoke', 'id': session_id})
+
+        return
+
+    def revoke_user(self, username_hash: str) -> None:
+        '''
+        Ends every session of a user.
+        '''
+
+        with self._synced(exclusive=True):
+            for session_id in list(self._by_user.get(username_hash, ())):
+                self._remove(session_id)
+                self._log({'op': 'revoke', 'id': session_id})
+
+        return
+
+    def rename_user(self, username_hash: str, new_username_hash: str) -> None:
+        '''
+        Keeps a renamed user's sessions going under their new username
+        hash, so their tokens stay valid.
+        '''
+
+        with self._synced(exclusive=True):
+            if username_hash in self._by_user:
+                self._move(username_hash, new_username_hash)
+                self._log({
+                    'op': 'rename',
+                    'user': username_hash,
+                    'new_user': new_username_hash
+                })
+
+        return
+
+    def close(self) -> None:
+        '''
+        Closes the saved session log.
+        '''
+
+        with self._lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+        return
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,2435 @@
+'''
+# Credential Store
+
+Storage backends for the user database used by `login.Login`.
+
+Every backend is keyed by the sha256 hexdigest of the username and holds
+one record per user, a `UserRecord` with the `password`, `display_name`
+and `email_address` fields. Callers only ever ask for, or change, a single
+record at a time so that a backend is free to avoid touching the rest.
+'''
+
+import json
+import os
+import string
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from hashlib import sha256
+
+try:
+    import fcntl
+except ImportError:
+    # advisory locking is skipped where `fcntl` is not available
+    fcntl = None
+
+from metrics import SIZE_BUCKETS, metrics
+from mmapindex import MappedIndex, snapshot_signature, write_index
+
+
+# fields held for each user, in storage order
+RECORD_FIELDS = ('password', 'display_name', 'email_address')
+
+
+class UserRecord:
+    '''
+    The fields held for one user, along with the `version` number of the
+    change that last wrote them.
+
+    Fields are kept in slots rather than a dict, as a store may cache
+    millions of records. Records held by a store are shared, so changes
+    are made to a copy from `replace()`.
+    '''
+
+    __slots__ = ('password', 'display_name', 'email_address', 'version')
+
+    def __init__(self, password: str, display_name: str, email_address: str,
+                 version: int = 0) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.password = password
+        self.display_name = display_name
+        self.email_address = email_address
+        self.version = version
+
+        return
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'UserRecord':
+        '''
+        Returns a record from its JSON form. Records written before
+        versions were kept are at version 0.
+        '''
+
+        return cls(
+            data['password'],
+            data['display_name'],
+            data['email_address'],
+            data.get('version', 0)
+        )
+
+    @classmethod
+    def coerce(cls, record: 'UserRecord | dict') -> 'UserRecord':
+        '''
+        Returns a record as a `UserRecord`, converting it from its JSON
+        form if needed.
+        '''
+
+        return record if isinstance(record, cls) else cls.from_dict(record)
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the record in its JSON form.
+        '''
+
+        return {
+            'password': self.password,
+            'display_name': self.display_name,
+            'email_address': self.email_address,
+            'version': self.version
+        }
+
+    def replace(self, **fields: str) -> 'UserRecord':
+        '''
+        Returns a copy of the record with some of its fields changed,
+        raising `ValueError` for fields that are not held.
+        '''
+
+        unknown = set(fields) - set(RECORD_FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+
+        return UserRecord(
+            fields.get('password', self.password),
+            fields.get('display_name', self.display_name),
+            fields.get('email_address', self.email_address),
+            self.version
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, UserRecord):
+            return NotImplemented
+
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'UserRecord(display_name={self.display_name!r}, '
+            f'email_address={self.email_address!r}, version={self.version})'
+        )
+
+
+class StoreError(Exception):
+    '''
+    Base class for errors raised by a credential store.
+    '''
+
+
+class ConflictError(StoreError):
+    '''
+    Raised when a record was changed by someone else since it was read.
+    '''
+
+
+class RecordExistsError(ConflictError):
+    '''
+    Raised when inserting a user that already exists.
+    '''
+
+
+class DuplicateEmailError(ConflictError):
+    '''
+    Raised when an email address is already used by another user.
+    '''
+
+
+class FieldTooLongError(StoreError, ValueError):
+    '''
+    Raised when a field is longer than the backend can store.
+    '''
+
+
+class StoreLockTimeout(StoreError, TimeoutError):
+    '''
+    Raised when the write lock could not be taken in time.
+    '''
+
+
+# lower cases ASCII letters only, the same as SQLite's `lower()`
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def index_key(value: str) -> str:
+    '''
+    Returns the form an email address or display name is indexed under,
+    so lookups ignore the case of ASCII letters.
+    '''
+
+    return value.translate(_ASCII_LOWER)
+
+
+@contextmanager
+def file_lock(lock_file, exclusive: bool = True,
+              deadline: float | None = None):
+    '''
+    Holds an advisory lock on an open file for the `with` block, shared
+    with other holders unless `exclusive`.
+
+    With a `deadline`, a `time.monotonic()` time, raises
+    `StoreLockTimeout` if the lock is not taken by then, otherwise waits
+    as long as it takes. Does nothing where `fcntl` is not available.
+    '''
+
+    if fcntl is None:
+        yield
+        return
+
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if deadline is None:
+        fcntl.flock(lock_file, operation)
+    else:
+        while True:
+            try:
+                fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise StoreLockTimeout(
+                        f'Timed out waiting for {lock_file.name}'
+                    )
+                time.sleep(0.005)
+
+    try:
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return
+
+
+def apply_event(userdata: dict, event: dict) -> None:
+    '''
+    Applies a single journal event to a user database in place, the
+    record in a `put` or `rename` event being in its JSON form.
+    '''
+
+    match event['op']:
+        case 'put':
+            userdata[event['key']] = UserRecord.from_dict(event['record'])
+        case 'delete':
+            userdata.pop(event['key'], None)
+        case 'rename':
+            userdata.pop(event['key'], None)
+            userdata[event['new_key']] = UserRecord.from_dict(event['record'])
+        case _:
+            raise ValueError(f'Unknown journal operation: {event["op"]}')
+
+    return
+
+
+class RecordIndexes:
+    '''
+    Secondary indexes over a user database, mapping each email address
+    and display name to the username hashes using it.
+
+    Email addresses should be unique, but earlier versions did not check,
+    so both indexes map to sets.
+    '''
+
+    def __init__(self) -> None:
+        '''
+        Initialises empty indexes.
+        '''
+
+        self.email_address = {}
+        self.display_name = {}
+
+        return
+
+    @classmethod
+    def build(cls, userdata: dict) -> 'RecordIndexes':
+        '''
+        Returns indexes over every user in a user database.
+        '''
+
+        indexes = cls()
+        for username_hash, record in userdata.items():
+            indexes.add(username_hash, record)
+
+        return indexes
+
+    def add(self, username_hash: str, record: UserRecord) -> None:
+        '''
+        Adds a user's record to the indexes.
+        '''
+
+        self.email_address.setdefault(
+            index_key(record.email_address),
+            set()
+        ).add(username_hash)
+        self.display_name.setdefault(
+            index_key(record.display_name),
+            set()
+        ).add(username_hash)
+
+        return
+
+    def remove(self, username_hash: str, record: UserRecord) -> None:
+        '''
+        Removes a user's record from the indexes.
+        '''
+
+        for index, value in (
+            (self.email_address, record.email_address),
+            (self.display_name, record.display_name)
+        ):
+            users = index.get(index_key(value))
+            if users is not None:
+                users.discard(username_hash)
+                if not users:
+                    del index[index_key(value)]
+
+        return
+
+    def apply(self, userdata: dict, event: dict) -> None:
+        '''
+        Applies a journal event to a user database and these indexes.
+        '''
+
+        # a rename touches the users under both keys
+        keys = [event['key']]
+        if event['op'] == 'rename':
+            keys.append(event['new_key'])
+
+        for key in keys:
+            old_record = userdata.get(key)
+            if old_record is not None:
+                self.remove(key, old_record)
+
+        apply_event(userdata, event)
+
+        for key in keys:
+            new_record = userdata.get(key)
+            if new_record is not None:
+                self.add(key, new_record)
+
+        return
+
+
+def read_journal(journal_path: str, offset: int = 0) -> tuple[list, int]:
+    '''
+    Reads the journal events written after `offset`, and returns them
+    along with the offset just past the last complete line.
+
+    A partly written final line, left by a crash mid-append, is ignored.
+    '''
+
+    try:
+        with open(journal_path, 'rb') as journal_file:
+            journal_file.seek(offset)
+            data = journal_file.read()
+    except FileNotFoundError:
+        return [], 0
+
+    # only consume up to the last complete line
+    end = data.rfind(b'\n') + 1
+    events = [
+        json.loads(line) for line in data[:end].splitlines() if line.strip()
+    ]
+
+    return events, offset + end
+
+
+def find_in_journal(journal_path: str, username_hash: str,
+                    chunk_size: int = 64 * 1024
+                    ) -> tuple[bool, UserRecord | None]:
+    '''
+    Returns whether the journal has an event for a user and, if so, the
+    record the latest one leaves, or `None` if it was a delete.
+
+    The journal is read backwards a chunk at a time, stopping at the
+    latest event for the user, so memory use does not grow with the
+    journal. A partly written final line is ignored.
+    '''
+
+    # keys are written unescaped, and quotes inside values are escaped,
+    # so these only match the keys of an event
+    pattern = f'"key": "{username_hash}"'.encode()
+    new_pattern = f'"new_key": "{username_hash}"'.encode()
+
+    try:
+        journal_file = open(journal_path, 'rb')
+    except FileNotFoundError:
+        return False, None
+
+    with journal_file:
+        # find the end of the last complete line
+        end = journal_file.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - chunk_size)
+            journal_file.seek(start)
+            newline = journal_file.read(end - start).rfind(b'\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+
+        # step back through the lines, newest first
+        position = end
+        carry = b''
+        while position > 0:
+            start = max(0, position - chunk_size)
+            journal_file.seek(start)
+            lines = (journal_file.read(position - start) + carry).split(b'\n')
+            if position == end:
+                lines.pop()
+            position = start
+
+            # the first line may start in the chunk before
+            carry = lines.pop(0) if start > 0 else b''
+
+            for line in reversed(lines):
+                if pattern in line or new_pattern in line:
+                    event = json.loads(line)
+                    # a rename leaves nothing under the key it moved from
+                    if event['op'] == 'delete' or (
+                        event['op'] == 'rename'
+                        and event['key'] == username_hash
+                    ):
+                        return True, None
+                    return True, UserRecord.from_dict(event['record'])
+
+    return False, None
+
+
+def file_signature(path: str) -> tuple[int, int] | None:
+    '''
+    Returns the modification time and size of a file, or `None` if it
+    does not exist.
+    '''
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+class UserdataCache:
+    '''
+    Process-wide cache of parsed JSON user databases, keyed by absolute
+    file path.
+
+    Each entry remembers the modification time and size of the snapshot
+    it was parsed from, and how much of the journal has been replayed on
+    top of it. A change made by another process is noticed from these, an
+    appended journal only has its new lines replayed, and the snapshot is
+    only re-parsed if it was replaced. Writes made through a store update
+    the entry directly, and bump a version counter, so they never cause a
+    re-parse.
+    '''
+
+    def __init__(self) -> None:
+        '''
+        Initialises an empty cache.
+        '''
+
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def load(self, path: str, journal_path: str | None = None) -> dict:
+        '''
+        Returns the parsed contents of a snapshot with its journal
+        replayed on top, as `UserRecord`s by username hash, only reading
+        what has changed since it was last cached.
+
+        The returned dict is shared and must not be mutated, use `apply()`
+        or `store()` to record a change.
+        '''
+
+        path = os.path.abspath(path)
+        signature = file_signature(path)
+        journal_size = 0
+        if journal_path is not None:
+            journal_size = (file_signature(journal_path) or (0, 0))[1]
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['signature'] == signature:
+                # nothing new
+                if entry['journal_offset'] == journal_size:
+                    return entry['userdata']
+
+                # journal was appended to by someone else
+                if entry['journal_offset'] < journal_size:
+                    events, offset = read_journal(
+                        journal_path,
+                        entry['journal_offset']
+                    )
+                    for event in events:
+                        entry['indexes'].apply(entry['userdata'], event)
+                    entry['journal_offset'] = offset
+                    entry['version'] += 1
+                    metrics.increment(
+                        'store_journal_replayed_events_total',
+                        len(events)
+                    )
+
+                    return entry['userdata']
+
+        # parse outside the lock so other files are not held up
+        started = time.perf_counter()
+        with open(path, 'r') as userdata_file:
+            userdata = json.load(userdata_file)
+
+        # swap each record for its compact form as we go, so the dicts
+        # parsed are freed one at a time
+        for username_hash, record in userdata.items():
+            userdata[username_hash] = UserRecord.from_dict(record)
+
+        # replay the whole journal on top of the snapshot
+        offset = 0
+        if journal_path is not None:
+            events, offset = read_journal(journal_path)
+            for event in events:
+                apply_event(userdata, event)
+
+        # index outside the lock too
+        indexes = RecordIndexes.build(userdata)
+
+        if metrics.enabled:
+            metrics.observe('store_load_seconds', time.perf_counter() - started)
+            metrics.observe(
+                'store_load_bytes',
+                (signature or (0, 0))[1],
+                SIZE_BUCKETS
+            )
+
+        with self._lock:
+            self._entries[path] = {
+                'signature': signature,
+                'journal_offset': offset,
+                'version': entry['version'] + 1 if entry is not None else 0,
+                'userdata': userdata,
+                'indexes': indexes
+            }
+
+        return userdata
+
+    def apply(self, path: str, event: dict, journal_offset: int) -> None:
+        '''
+        Records an event just appended to the journal of a cached file,
+        ending at `journal_offset`.
+        '''
+
+        path = os.path.abspath(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            entry['indexes'].apply(entry['userdata'], event)
+            entry['journal_offset'] = journal_offset
+            entry['version'] += 1
+
+        return
+
+    def store(self, path: str, userdata: dict,
+              journal_offset: int = 0) -> None:
+        '''
+        Records the contents of a snapshot just written to a file.
+        '''
+
+        path = os.path.abspath(path)
+        signature = file_signature(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+
+            # keep the indexes if they are already over this data
+            if entry is not None and entry['userdata'] is userdata:
+                indexes = entry['indexes']
+            else:
+                indexes = RecordIndexes.build(userdata)
+
+            self._entries[path] = {
+                'signature': signature,
+                'journal_offset': journal_offset,
+                'version': entry['version'] + 1 if entry is not None else 0,
+                'userdata': userdata,
+                'indexes': indexes
+            }
+
+        return
+
+    def lookup(self, path: str, field: str, value: str) -> list[str]:
+        '''
+        Returns the username hashes of a cached file with `value` in an
+        indexed field, in sorted order.
+        '''
+
+        with self._lock:
+            index = getattr(self._entries[os.path.abspath(path)]['indexes'],
+                field)
+            return sorted(index.get(index_key(value), ()))
+
+    def rebuild_indexes(self, path: str) -> None:
+        '''
+        Rebuilds the secondary indexes of a cached file from its data.
+        '''
+
+        path = os.path.abspath(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry['indexes'] = RecordIndexes.build(entry['userdata'])
+
+        return
+
+    def holds(self, path: str) -> bool:
+        '''
+        Returns whether the current snapshot of a file is cached.
+        '''
+
+        path = os.path.abspath(path)
+        signature = file_signature(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+
+            return entry is not None and entry['signature'] == signature
+
+    def journal_offset(self, path: str) -> int:
+        '''
+        Returns how far into its journal a cached file has been replayed.
+        '''
+
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(path))
+
+        return 0 if entry is None else entry['journal_offset']
+
+    def version(self, path: str) -> int | None:
+        '''
+        Returns the number of times a cached file has changed, or `None`
+        if it is not cached.
+        '''
+
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(path))
+
+        return None if entry is None else entry['version']
+
+    def invalidate(self, path: str | None = None) -> None:
+        '''
+        Drops the entry for a file, or every entry if no path is given.
+        '''
+
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(path), None)
+
+        return
+
+
+# cache shared by every JSON store in the process
+userdata_cache = UserdataCache()
+
+
+class CredentialStore:
+    '''
+    Base class describing the operations every storage backend provides.
+
+    Records carry a `version` number, bumped on every change, which can
+    be passed back as `expected_version` to make a write conditional on
+    nobody else having changed the record since it was read.
+
+    `max_field_bytes` is the longest a field may be once encoded, or
+    `None` if there is no limit. Writes with a longer field raise
+    `FieldTooLongError` and store nothing.
+    '''
+
+    max_field_bytes = None
+
+    def get(self, username_hash: str) -> UserRecord | None:
+        '''
+        Returns a copy of the record for a user, or `None` if the user
+        does not exist.
+        '''
+
+        raise NotImplementedError
+
+    def exists(self, username_hash: str) -> bool:
+        '''
+        Returns whether a record exists for a user.
+        '''
+
+        return self.get(username_hash) is not None
+
+    def insert(self, username_hash: str, record: UserRecord) -> None:
+        '''
+        Adds the record for a new user. Records may also be given in
+        their JSON form, here and in the other writes.
+
+        Raises `RecordExistsError` if the user already exists, or
+        `DuplicateEmailError` if another user has the same email address.
+        '''
+
+        raise NotImplementedError
+
+    def insert_many(self, records: list[tuple[str, UserRecord]],
+                    replace: bool = False) -> list[str]:
+        '''
+        Adds the records for many users in one go, returning the username
+        hashes of those skipped because they already exist.
+
+        With `replace`, existing users are overwritten instead. Records
+        whose email address is used by another user are always skipped.
+        '''
+
+        skipped = []
+        for username_hash, record in records:
+            try:
+                if replace:
+                    self.put(username_hash, record)
+                else:
+                    self.insert(username_hash, record)
+            except (RecordExistsError, DuplicateEmailError):
+                skipped.append(username_hash)
+
+        return skipped
+
+    def put(self, username_hash: str, record: UserRecord,
+            expected_version: int | None = None) -> None:
+        '''
+        Inserts or replaces the whole record for a user.
+
+        Raises `ConflictError` if `expected_version` is given and does not
+        match the stored record, or `DuplicateEmailError` if another user
+        has the same email address.
+        '''
+
+        raise NotImplementedError
+
+    def update(self, username_hash: str, expected_version: int | None = None,
+               **fields: str) -> None:
+        '''
+        Changes some of the fields of an existing record.
+
+        Raises `KeyError` if the user does not exist, `ConflictError` if
+        `expected_version` is given and does not match, or
+        `DuplicateEmailError` if the new email address is used by another
+        user.
+        '''
+
+        # merge the changes into the current record
+        record = self.get(username_hash)
+        if record is None:
+            raise KeyError(username_hash)
+        if expected_version is None:
+            expected_version = record.version
+
+        self.put(username_hash, record.replace(**fields), expected_version)
+
+        return
+
+    def delete(self, username_hash: str,
+               expected_version: int | None = None) -> None:
+        '''
+        Removes the record for a user, if present.
+        '''
+
+        raise NotImplementedError
+
+    def rename(self, username_hash: str, new_username_hash: str,
+               expected_version: int | None = None) -> None:
+        '''
+        Moves a user's record to a new username hash, keeping its fields
+        and email address, as a single change.
+
+        Raises `KeyError` if the user does not exist, `RecordExistsError`
+        if the new username hash is taken, or `ConflictError` if
+        `expected_version` is given and does not match.
+        '''
+
+        # backends without a rename of their own move the record in two
+        # steps, the old record going first so its email address is free
+        record = self.get(username_hash)
+        if record is None:
+            raise KeyError(username_hash)
+        if self.exists(new_username_hash):
+            raise RecordExistsError(new_username_hash)
+        if expected_version is None:
+            expected_version = record.version
+
+        self.delete(username_hash, expected_version)
+        try:
+            self.insert(new_username_hash, record)
+        except ConflictError:
+            self.insert(username_hash, record)
+            raise
+
+        return
+
+    def keys(self) -> list[str]:
+        '''
+        Returns the username hashes of every stored user.
+        '''
+
+        raise NotImplementedError
+
+    def items(self):
+        '''
+        Yields `(username_hash, record)` pairs for every stored user.
+        '''
+
+        for username_hash in self.keys():
+            record = self.get(username_hash)
+            if record is not None:
+                yield username_hash, record
+
+        return
+
+    def find_by_email(self, email_address: str) -> str | None:
+        '''
+        Returns the username hash of the user with an email address, or
+        `None` if nobody uses it. Case of ASCII letters is ignored.
+        '''
+
+        for username_hash, record in self.items():
+            if index_key(record.email_address) == index_key(email_address):
+                return username_hash
+
+        return None
+
+    def find_by_display_name(self, display_name: str) -> list[str]:
+        '''
+        Returns the username hashes of every user with a display name.
+        Case of ASCII letters is ignored.
+        '''
+
+        return [
+            username_hash for username_hash, record in self.items()
+            if index_key(record.display_name) == index_key(display_name)
+        ]
+
+    def rebuild_indexes(self) -> None:
+        '''
+        Rebuilds the secondary indexes from the stored records.
+        '''
+
+        return
+
+    def flush(self) -> None:
+        '''
+        Forces any buffered changes to disk.
+        '''
+
+        return
+
+    def close(self) -> None:
+        '''
+        Releases any resources held by the backend.
+        '''
+
+        return
+
+    def __contains__(self, username_hash: str) -> bool:
+        return self.exists(username_hash)
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+
+def check_version(username_hash: str, current: UserRecord | None,
+                  expected_version: int | None) -> None:
+    '''
+    Raises `ConflictError` if a record is not at the expected version.
+    '''
+
+    if expected_version is None:
+        return
+
+    current_version = None if current is None else current.version
+    if current_version != expected_version:
+        raise ConflictError(
+            f'Record {username_hash} is at version {current_version}, '
+            f'expected {expected_version}'
+        )
+
+    return
+
+
+def check_field_lengths(record: UserRecord, max_bytes: int | None) -> None:
+    '''
+    Raises `FieldTooLongError` if a field of a record is longer than
+    `max_bytes` once encoded, if there is a limit.
+    '''
+
+    if max_bytes is None:
+        return
+
+    for name in RECORD_FIELDS:
+        if len(getattr(record, name).encode()) > max_bytes:
+            raise FieldTooLongError(
+                f'Field {name} is longer than {max_bytes} bytes'
+            )
+
+    return
+
+
+def stored_record(record: UserRecord | dict, current: UserRecord | None,
+                  max_bytes: int | None = None) -> UserRecord:
+    '''
+    Returns the fields of `record` to store over `current`, with the
+    version number moved on.
+
+    Raises `TypeError` if a field is not a string, or `FieldTooLongError`
+    if one is longer than `max_bytes`, before anything is written, as
+    every index and file format relies on them being text.
+    '''
+
+    record = UserRecord.coerce(record)
+    for name in RECORD_FIELDS:
+        if not isinstance(getattr(record, name), str):
+            raise TypeError(f'Field {name} must be a string')
+    check_field_lengths(record, max_bytes)
+
+    return UserRecord(
+        record.password,
+        record.display_name,
+        record.email_address,
+        1 if current is None else current.version + 1
+    )
+
+
+class JSONCredentialStore(CredentialStore):
+    '''
+    Backend keeping every user in a single JSON object on disk, which is
+    the original `userdata.json` format.
+
+    Changes are not written into the JSON object straight away. Each one
+    is appended as a line to a journal file next to it, which is replayed
+    over the snapshot when it is read. Once the journal holds
+    `compact_threshold` events, and at least as many as there are users,
+    it is folded into a new snapshot. Appends are only fsynced every
+    `sync_every` events, or on `flush()`/`close()`.
+
+    Several processes may share the same files. Reads take no lock, as
+    snapshots are swapped in whole and only complete journal lines are
+    replayed. Writes take an advisory lock on a `.lock` file, waiting at
+    most `lock_timeout` seconds, and only hold it to catch up with the
+    journal, check the record version and append one line.
+
+    Email addresses and display names are indexed in memory alongside the
+    cached data, and kept up to date as journal events are applied. With
+    `unique_email`, a write giving a user an email address already used by
+    another is refused.
+
+    Each snapshot is written with a memory mapped `.index` file giving
+    where every record sits in it. Until the database has been loaded,
+    `get()` and `exists()` read just the one record they need through the
+    index, after checking the journal for a newer event, so logging in
+    does not parse the whole file. The journal is scanned for that check,
+    so once it is past `lookup_journal_bytes` the database is loaded
+    instead, and later lookups are served from memory.
+    Snapshots written by earlier versions have no index until the next
+    compaction.
+    '''
+
+    def __init__(self, path: str, compact_threshold: int = 1000,
+                 sync_every: int = 16, lock_timeout: float = 5.0,
+                 unique_email: bool = True,
+                 lookup_journal_bytes: int = 1024 * 1024) -> None:
+        '''
+        Opens the store, creating an empty file if not present.
+        '''
+
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.index_path = f'{path}.index'
+        self.compact_threshold = compact_threshold
+        self.lookup_journal_bytes = lookup_journal_bytes
+        self.sync_every = sync_every
+        self.lock_timeout = lock_timeout
+        self.unique_email = unique_email
+
+        # lock shared with other processes, and threads in this one
+        self._lock_file = open(f'{path}.lock', 'a')
+        self._thread_lock = threading.Lock()
+
+        # journal is opened on the first change
+        self._journal_file = None
+        self._journal_events = None
+        self._unsynced = 0
+
+        # record index is mapped on the first lookup
+        self._index = None
+        self._index_lock = threading.Lock()
+
+        # create initial data file if not present
+        with self._locked():
+            if not os.path.exists(self.path):
+                self._dump({})
+
+        return
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Holds the write lock, raising `StoreLockTimeout` if it cannot be
+        taken within `lock_timeout` seconds.
+        '''
+
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.lock_timeout
+
+        if not self._thread_lock.acquire(timeout=self.lock_timeout):
+            raise StoreLockTimeout(f'Timed out waiting for {self.path}')
+
+        try:
+            with file_lock(self._lock_file, deadline=deadline):
+                if metrics.enabled:
+                    metrics.observe(
+                        'store_lock_wait_seconds',
+                        time.perf_counter() - started
+                    )
+
+                yield
+        finally:
+            self._thread_lock.release()
+
+        return
+
+    def _load(self) -> dict:
+        '''
+        Returns the whole user database, parsing the snapshot only if it
+        has changed since it was last read and replaying any new journal
+        lines.
+
+        The returned dict is shared through `userdata_cache` and must not
+        be mutated in place.
+        '''
+
+        return userdata_cache.load(self.path, self.journal_path)
+
+    def _check_email(self, username_hash: str, record: UserRecord,
+                     current: UserRecord | None) -> None:
+        '''
+        Raises `DuplicateEmailError` if a record takes an email address
+        already used by another user.
+
+        Must be called with the write lock held, after `_load()`.
+        '''
+
+        if not self.unique_email or (current is not None and index_key(
+            current.email_address
+        ) == index_key(record.email_address)):
+            return
+
+        owners = userdata_cache.lookup(
+            self.path,
+            'email_address',
+            record.email_address
+        )
+        if set(owners) - {username_hash}:
+            raise DuplicateEmailError(record.email_address)
+
+        return
+
+    def _dump(self, userdata: dict) -> None:
+        '''
+        Writes the whole user database to a new snapshot, replacing the
+        old one in a single step, and empties the journal.
+
+        Must be called with the write lock held.
+        '''
+
+        started = time.perf_counter()
+
+        # write the snapshot beside the old one, in the same form as
+        # `json.dump()`, noting where each record starts
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        entries = []
+        with open(temp_path, 'w') as userdata_file:
+            # output is ASCII, so lengths in characters are in bytes
+            size = userdata_file.write('{')
+            parts = []
+            for username_hash, record in userdata.items():
+                key_text = f'{", " if entries else ""}{json.dumps(username_hash)}: '
+                record_text = json.dumps(record.to_dict())
+                entries.append(
+                    (username_hash, size + len(key_text), len(record_text))
+                )
+                size += len(key_text) + len(record_text)
+                parts += (key_text, record_text)
+                if len(parts) >= 4096:
+                    userdata_file.write(''.join(parts))
+                    parts.clear()
+            parts.append('}')
+            size += 1
+            userdata_file.write(''.join(parts))
+            userdata_file.flush()
+            os.fsync(userdata_file.fileno())
+            signature = snapshot_signature(os.fstat(userdata_file.fileno()))
+
+        # index the snapshot before swapping it in, the signature in the
+        # index stops it being used with any other snapshot
+        try:
+            write_index(self.index_path, entries, signature)
+        except ValueError:
+            # keys that are not hexdigests cannot be indexed
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+        os.replace(temp_path, self.path)
+
+        # everything in the journal is now in the snapshot
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        with open(self.journal_path, 'w'):
+            pass
+        self._journal_events = 0
+        self._unsynced = 0
+
+        userdata_cache.store(self.path, userdata)
+
+        if metrics.enabled:
+            metrics.observe('store_dump_seconds', time.perf_counter() - started)
+            metrics.observe('store_dump_bytes', size, SIZE_BUCKETS)
+
+        return
+
+    def _append(self, userdata: dict, *events: dict) -> None:
+        '''
+        Appends events to the journal, compacting the journal into the
+        snapshot once it grows past the threshold.
+
+        Must be called with the write lock held, after `_load()`.
+        '''
+
+        started = time.perf_counter()
+
+        if self._journal_file is None:
+            self._journal_file = open(self.journal_path, 'a')
+        if self._journal_events is None:
+            self._journal_events = len(read_journal(self.journal_path)[0])
+
+        # drop a partly written line left by a crash mid-append
+        offset = userdata_cache.journal_offset(self.path)
+        if os.fstat(self._journal_file.fileno()).st_size != offset:
+            self._journal_file.truncate(offset)
+
+        # write each event as a single line
+        self._journal_file.write(
+            ''.join(json.dumps(event) + '\n' for event in events)
+        )
+        self._journal_file.flush()
+        self._journal_events += len(events)
+        self._unsynced += len(events)
+        if self._unsynced >= self.sync_every:
+            self.flush()
+
+        offset = os.fstat(self._journal_file.fileno()).st_size
+        for event in events:
+            userdata_cache.apply(self.path, event, offset)
+
+        if metrics.enabled:
+            metrics.observe(
+                'store_write_seconds',
+                time.perf_counter() - started,
+                backend='json'
+            )
+            metrics.increment(
+                'store_written_events_total',
+                len(events),
+                backend='json'
+            )
+
+        # compact once the journal is as big as the snapshot, so the cost
+        # of rewriting the snapshot is spread over as many changes
+        if self._journal_events >= max(self.compact_threshold, len(userdata)):
+            self._dump(userdata)
+
+        return
+
+    def _mapped_index(self) -> MappedIndex | None:
+        '''
+        Returns the record index, mapping it again if it has been
+        replaced, or `None` if there is none.
+
+        Must be called with the index lock held.
+        '''
+
+        try:
+            file_id = os.stat(self.index_path).st_ino
+        except FileNotFoundError:
+            return None
+
+        if self._index is None or self._index.file_id != file_id:
+            if self._index is not None:
+                self._index.close()
+            self._index = MappedIndex.open(self.index_path)
+
+        return self._index
+
+    def _lookup(self, username_hash: str
+                ) -> tuple[bool, UserRecord | None]:
+        '''
+        Reads one user's record without loading the database, from the
+        journal if it has an event for the user or else from the snapshot
+        through the record index.
+
+        Returns whether the lookup could be made, as there may be no
+        index for the current snapshot or the journal may be too long to
+        scan, and the record if it was.
+        '''
+
+        # scanning a long journal for every lookup costs more than
+        # loading the database once
+        journal_signature = file_signature(self.journal_path)
+        if (journal_signature is not None
+            and journal_signature[1] > self.lookup_journal_bytes):
+            return False, None
+
+        with self._index_lock:
+            for _ in range(3):
+                index = self._mapped_index()
+                if index is None:
+                    return False, None
+
+                try:
+                    snapshot_file = open(self.path, 'rb')
+                except FileNotFoundError:
+                    return False, None
+
+                with snapshot_file:
+                    signature = snapshot_signature(
+                        os.fstat(snapshot_file.fileno())
+                    )
+                    if signature != index.signature:
+                        return False, None
+
+                    found, record = find_in_journal(
+                        self.journal_path,
+                        username_hash
+                    )
+                    if not found:
+                        try:
+                            position = index.lookup(username_hash)
+                        except ValueError:
+                            return False, None
+                        if position is not None:
+                            # check the key is right before the record, in
+                            # case the snapshot changed within its mtime
+                            key_text = f'"{username_hash}": '.encode()
+                            offset, length = position
+                            snapshot_file.seek(offset - len(key_text))
+                            text = snapshot_file.read(len(key_text) + length)
+                            if not text.startswith(key_text):
+                                return False, None
+                            try:
+                                record = UserRecord.from_dict(
+                                    json.loads(text[len(key_text):])
+                                )
+                            except (KeyError, ValueError):
+                                return False, None
+
+                # a compaction meanwhile may have moved the journal into a
+                # newer snapshot, so try again
+                try:
+                    if snapshot_signature(os.stat(self.path)) == signature:
+                        return True, record
+                except FileNotFoundError:
+                    return False, None
+
+        return False, None
+
+    def flush(self) -> None:
+        '''
+        Forces journalled changes to disk.
+        '''
+
+        if self._journal_file is not None and self._unsynced:
+            self._journal_file.flush()
+            os.fsync(self._journal_file.fileno())
+            self._unsynced = 0
+
+        return
+
+    def compact(self) -> None:
+        '''
+        Folds the journal into a new snapshot.
+        '''
+
+        with self._locked():
+            self._dump(self._load())
+
+        return
+
+    def get(self, username_hash: str) -> UserRecord | None:
+        # read just this record if the database is not already loaded
+        if not userdata_cache.holds(self.path):
+            indexed, record = self._lookup(username_hash)
+            if indexed:
+                return record
+
+        record = self._load().get(username_hash)
+
+        return None if record is None else record.replace()
+
+    def exists(self, username_hash: str) -> bool:
+        if not userdata_cache.holds(self.path):
+            indexed, record = self._lookup(username_hash)
+            if indexed:
+                return record is not None
+
+        return username_hash in self._load()
+
+    def insert(self, username_hash: str, record: UserRecord) -> None:
+        with self._locked():
+            userdata = self._load()
+            if username_hash in userdata:
+                raise RecordExistsError(username_hash)
+            stored = stored_record(record, None)
+            self._check_email(username_hash, stored, None)
+
+            self._append(userdata, {
+                'op': 'put',
+                'key': username_hash,
+                'record': stored.to_dict()
+            })
+
+        return
+
+    def insert_many(self, records: list[tuple[str, UserRecord]],
+                    replace: bool = False) -> list[str]:
+        skipped = []
+        events = {}
+        batch_emails = {}
+
+        with self._locked():
+            userdata = self._load()
+
+            for username_hash, record in records:
+                current = userdata.get(username_hash)
+                if current is not None and not replace:
+                    skipped.append(username_hash)
+                    continue
+                # a user repeated within the batch is only added once
+                if username_hash in events and not replace:
+                    skipped.append(username_hash)
+                    continue
+
+                # email must be free in the store and earlier in the batch
+                stored = stored_record(record, current)
+                email_key = index_key(stored.email_address)
+                try:
+                    self._check_email(username_hash, stored, current)
+                except DuplicateEmailError:
+                    skipped.append(username_hash)
+                    continue
+                if self.unique_email and batch_emails.get(
+                    email_key, username_hash
+                ) != username_hash:
+                    skipped.append(username_hash)
+                    continue
+                batch_emails[email_key] = username_hash
+
+                events[username_hash] = {
+                    'op': 'put',
+                    'key': username_hash,
+                    'record': stored.to_dict()
+                }
+
+            if events:
+                self._append(userdata, *events.values())
+
+        return skipped
+
+    def put(self, username_hash: str, record: UserRecord,
+            expected_version: int | None = None) -> None:
+        with self._locked():
+            userdata = self._load()
+            current = userdata.get(username_hash)
+            check_version(username_hash, current, expected_version)
+            stored = stored_record(record, current)
+            self._check_email(username_hash, stored, current)
+
+            self._append(userdata, {
+                'op': 'put',
+                'key': username_hash,
+                'record': stored.to_dict()
+            })
+
+        return
+
+    def update(self, username_hash: str, expected_version: int | None = None,
+               **fields: str) -> None:
+        with self._locked():
+            userdata = self._load()
+            current = userdata.get(username_hash)
+            if current is None:
+                raise KeyError(username_hash)
+            check_version(username_hash, current, expected_version)
+            stored = stored_record(current.replace(**fields), current)
+            self._check_email(username_hash, stored, current)
+
+            # merge while locked so concurrent field changes are kept
+            self._append(userdata, {
+                'op': 'put',
+                'key': username_hash,
+                'record': stored.to_dict()
+            })
+
+        return
+
+    def delete(self, username_hash: str,
+               expected_version: int | None = None) -> None:
+        with self._locked():
+            userdata = self._load()
+            current = userdata.get(username_hash)
+            check_version(username_hash, current, expected_version)
+
+            if current is not None:
+                self._append(userdata, {'op': 'delete', 'key': username_hash})
+
+        return
+
+    def rename(self, username_hash: str, new_username_hash: str,
+               expected_version: int | None = None) -> None:
+        with self._locked():
+            userdata = self._load()
+            current = userdata.get(username_hash)
+            if current is None:
+                raise KeyError(username_hash)
+            check_version(username_hash, current, expected_version)
+            if new_username_hash in userdata:
+                raise RecordExistsError(new_username_hash)
+
+            # one event moves the record, its email address staying with it
+            self._append(userdata, {
+                'op': 'rename',
+                'key': username_hash,
+                'new_key': new_username_hash,
+                'record': stored_record(current, current).to_dict()
+            })
+
+        return
+
+    def find_by_email(self, email_address: str) -> str | None:
+        self._load()
+        owners = userdata_cache.lookup(self.path, 'email_address',
+            email_address)
+
+        return owners[0] if owners else None
+
+    def find_by_display_name(self, display_name: str) -> list[str]:
+        self._load()
+
+        return userdata_cache.lookup(self.path, 'display_name', display_name)
+
+    def rebuild_indexes(self) -> None:
+        self._load()
+        userdata_cache.rebuild_indexes(self.path)
+
+        return
+
+    def keys(self) -> list[str]:
+        return list(self._load())
+
+    def close(self) -> None:
+        self.flush()
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        with self._index_lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+        self._lock_file.close()
+
+        return
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+
+class SQLiteCredentialStore(CredentialStore):
+    '''
+    Backend keeping users in an SQLite table indexed on the username
+    hash, so a lookup or a single-record write costs the same no matter
+    how many users are stored. Email addresses and display names have
+    their own indexes.
+
+    The database is put in WAL mode so readers in other processes are not
+    blocked by a writer, and writers wait at most `lock_timeout` seconds
+    for each other. The connection may be shared between threads.
+    '''
+
+    def __init__(self, path: str, lock_timeout: float = 5.0,
+                 unique_email: bool = True) -> None:
+        '''
+        Opens the database, creating the table if not present.
+        '''
+
+        # imported here so other backends do not pay for it
+        import sqlite3
+
+        self.path = path
+        self.unique_email = unique_email
+        self.connection = sqlite3.connect(
+            self.path,
+            timeout=lock_timeout,
+            check_same_thread=False
+        )
+        self._thread_lock = threading.RLock()
+
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+
+            # create the table, keyed on the username hash
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'username_hash TEXT PRIMARY KEY, '
+                'password TEXT NOT NULL, '
+                'display_name TEXT NOT NULL, '
+                'email_address TEXT NOT NULL, '
+                'version INTEGER NOT NULL DEFAULT 0)'
+            )
+
+            # add the version column to tables made before it existed
+            columns = [
+                row[1] for row in
+                self.connection.execute('PRAGMA table_info(users)')
+            ]
+            if 'version' not in columns:
+                self.connection.execute(
+                    'ALTER TABLE users ADD COLUMN '
+                    'version INTEGER NOT NULL DEFAULT 0'
+                )
+
+            # secondary indexes, not unique as earlier data may repeat
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS users_email_address '
+                'ON users (lower(email_address))'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS users_display_name '
+                'ON users (lower(display_name))'
+            )
+
+        return
+
+    @contextmanager
+    def _transaction(self):
+        '''
+        Holds a write transaction, so rows read inside it cannot change
+        before it commits.
+        '''
+
+        started = time.perf_counter()
+
+        with self._thread_lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.connection.rollback()
+                raise
+            else:
+                self.connection.commit()
+
+        if metrics.enabled:
+            metrics.observe(
+                'store_write_seconds',
+                time.perf_counter() - started,
+                backend='sqlite'
+            )
+            metrics.increment('store_written_events_total', backend='sqlite')
+
+        return
+
+    def _get(self, username_hash: str) -> UserRecord | None:
+        '''
+        Returns the record for a user, without taking the thread lock.
+        '''
+
+        row = self.connection.execute(
+            'SELECT password, display_name, email_address, version '
+            'FROM users WHERE username_hash = ?',
+            (username_hash,)
+        ).fetchone()
+
+        return None if row is None else UserRecord(*row)
+
+    def _check_email(self, username_hash: str, record: UserRecord,
+                     current: UserRecord | None) -> None:
+        '''
+        Raises `DuplicateEmailError` if a record takes an email address
+        already used by another user.
+        '''
+
+        if not self.unique_email or (current is not None and index_key(
+            current.email_address
+        ) == index_key(record.email_address)):
+            return
+
+        row = self.connection.execute(
+            'SELECT 1 FROM users WHERE lower(email_address) = ? '
+            'AND username_hash != ? LIMIT 1',
+            (index_key(record.email_address), username_hash)
+        ).fetchone()
+        if row is not None:
+            raise DuplicateEmailError(record.email_address)
+
+        return
+
+    def _write(self, username_hash: str, record: UserRecord | dict,
+               current: UserRecord | None) -> None:
+        '''
+        Inserts or replaces a row, moving its version on, after checking
+        its email address is free.
+        '''
+
+        stored = stored_record(record, current)
+        self._check_email(username_hash, stored, current)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO users (username_hash, password, '
+            'display_name, email_address, version) VALUES (?, ?, ?, ?, ?)',
+            (username_hash, stored.password, stored.display_name,
+                stored.email_address, stored.version)
+        )
+
+        return
+
+    def get(self, username_hash: str) -> UserRecord | None:
+        with self._thread_lock:
+            return self._get(username_hash)
+
+    def exists(self, username_hash: str) -> bool:
+        with self._thread_lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM users WHERE username_hash = ?',
+                (username_hash,)
+            ).fetchone()
+
+        return row is not None
+
+    def insert(self, username_hash: str, record: UserRecord) -> None:
+        with self._transaction():
+            if self._get(username_hash) is not None:
+                raise RecordExistsError(username_hash)
+            self._write(username_hash, record, None)
+
+        return
+
+    def insert_many(self, records: list[tuple[str, UserRecord]],
+                    replace: bool = False) -> list[str]:
+        skipped = []
+
+        with self._transaction():
+            for username_hash, record in records:
+                current = self._get(username_hash)
+                if current is not None and not replace:
+                    skipped.append(username_hash)
+                    continue
+                try:
+                    self._write(username_hash, record, current)
+                except DuplicateEmailError:
+                    skipped.append(username_hash)
+
+        return skipped
+
+    def put(self, username_hash: str, record: UserRecord,
+            expected_version: int | None = None) -> None:
+        with self._transaction():
+            current = self._get(username_hash)
+            check_version(username_hash, current, expected_version)
+            self._write(username_hash, record, current)
+
+        return
+
+    def update(self, username_hash: str, expected_version: int | None = None,
+               **fields: str) -> None:
+        # only allow known columns
+        unknown = set(fields) - set(RECORD_FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+
+        with self._transaction():
+            current = self._get(username_hash)
+            if current is None:
+                raise KeyError(username_hash)
+            check_version(username_hash, current, expected_version)
+            self._write(username_hash, current.replace(**fields), current)
+
+        return
+
+    def delete(self, username_hash: str,
+               expected_version: int | None = None) -> None:
+        with self._transaction():
+            current = self._get(username_hash)
+            check_version(username_hash, current, expected_version)
+            self.connection.execute(
+                'DELETE FROM users WHERE username_hash = ?',
+                (username_hash,)
+            )
+
+        return
+
+    def rename(self, username_hash: str, new_username_hash: str,
+               expected_version: int | None = None) -> None:
+        with self._transaction():
+            current = self._get(username_hash)
+            if current is None:
+                raise KeyError(username_hash)
+            check_version(username_hash, current, expected_version)
+            if self._get(new_username_hash) is not None:
+                raise RecordExistsError(new_username_hash)
+
+            # change the key of the row in place, its indexes follow
+            self.connection.execute(
+                'UPDATE users SET username_hash = ?, version = version + 1 '
+                'WHERE username_hash = ?',
+                (new_username_hash, username_hash)
+            )
+
+        return
+
+    def find_by_email(self, email_address: str) -> str | None:
+        with self._thread_lock:
+            row = self.connection.execute(
+                'SELECT username_hash FROM users '
+                'WHERE lower(email_address) = ? '
+                'ORDER BY username_hash LIMIT 1',
+                (index_key(email_address),)
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def find_by_display_name(self, display_name: str) -> list[str]:
+        with self._thread_lock:
+            return [
+                row[0] for row in self.connection.execute(
+                    'SELECT username_hash FROM users '
+                    'WHERE lower(display_name) = ? ORDER BY username_hash',
+                    (index_key(display_name),)
+                )
+            ]
+
+    def rebuild_indexes(self) -> None:
+        with self._thread_lock, self.connection:
+            self.connection.execute('REINDEX users')
+
+        return
+
+    def keys(self) -> list[str]:
+        with self._thread_lock:
+            return [
+                row[0] for row in
+                self.connection.execute('SELECT username_hash FROM users')
+            ]
+
+    def items(self, batch_size: int = 1000):
+        # page through in key order so memory stays bounded
+        last_key = ''
+        while True:
+            with self._thread_lock:
+                rows = self.connection.execute(
+                    'SELECT username_hash, password, display_name, '
+                    'email_address, version FROM users '
+                    'WHERE username_hash > ? ORDER BY username_hash LIMIT ?',
+                    (last_key, batch_size)
+                ).fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                yield row[0], UserRecord(*row[1:])
+            last_key = rows[-1][0]
+
+        return
+
+    def close(self) -> None:
+        self.connection.close()
+
+        return
+
+    def __len__(self) -> int:
+        with self._thread_lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM users'
+            ).fetchone()[0]
+
+
+# layout of sharded store files, little endian: a magic number, then for
+# each user its raw username digest, version and field lengths followed
+# by the fields, or for each email address its digest and owner count
+# followed by the raw digests of the owners
+SHARD_MAGIC = {'users': b'LFU1', 'emails': b'LFE1'}
+USER_ENTRY = struct.Struct('<32sIHHH')
+EMAIL_ENTRY = struct.Struct('<32sH')
+
+
+def email_digest(email_address: str) -> bytes:
+    '''
+    Returns the digest an email address is indexed under in a sharded
+    store.
+    '''
+
+    return sha256(index_key(email_address).encode()).digest()
+
+
+def parse_shard(kind: str, data: bytes) -> dict:
+    '''
+    Returns the contents of a sharded store file: records by username
+    hash for `users` shards, or sets of username hashes by email digest
+    for `emails` shards.
+    '''
+
+    if not data:
+        return {}
+    if data[:4] != SHARD_MAGIC[kind]:
+        raise StoreError(f'Not a {kind} shard')
+
+    contents = {}
+    offset = 4
+    while offset < len(data):
+        if kind == 'users':
+            digest, version, *lengths = USER_ENTRY.unpack_from(data, offset)
+            offset += USER_ENTRY.size
+
+            fields = []
+            for length in lengths:
+                fields.append(data[offset:offset + length].decode())
+                offset += length
+            contents[digest.hex()] = UserRecord(*fields, version)
+        else:
+            digest, count = EMAIL_ENTRY.unpack_from(data, offset)
+            offset += EMAIL_ENTRY.size
+
+            contents[digest] = {
+                data[start:start + 32].hex()
+                for start in range(offset, offset + count * 32, 32)
+            }
+            offset += count * 32
+
+    return contents
+
+
+def pack_shard(kind: str, contents: dict) -> bytes:
+    '''
+    Returns the bytes of a sharded store file holding `contents`.
+    '''
+
+    parts = [SHARD_MAGIC[kind]]
+
+    for key, value in contents.items():
+        if kind == 'users':
+            fields = [
+                value.password.encode(),
+                value.display_name.encode(),
+                value.email_address.encode()
+            ]
+            if max(map(len, fields)) > 0xFFFF:
+                raise FieldTooLongError(f'Field too long for record {key}')
+            parts.append(USER_ENTRY.pack(
+                bytes.fromhex(key),
+                value.version,
+                *map(len, fields)
+            ))
+            parts.extend(fields)
+        else:
+            parts.append(EMAIL_ENTRY.pack(key, len(value)))
+            parts.extend(bytes.fromhex(owner) for owner in sorted(value))
+
+    return b''.join(parts)
+
+
+def shard_signature(path: str) -> tuple[int, int, int] | None:
+    '''
+    Returns the inode, modification time and size of a shard, or `None`
+    if it does not exist.
+    '''
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class ShardedCredentialStore(CredentialStore):
+    '''
+    Backend splitting users across many small binary files in a
+    directory, so a lookup or write only reads and rewrites the shard
+    holding that user, however many users there are.
+
+    Users are placed in `users/<prefix>.bin` by the first `prefix_length`
+    hex digits of their username hash. Each is stored as its hash in 32
+    raw bytes, a version number and length prefixed fields, without
+    repeating field names. Email addresses are indexed the same way in
+    `emails/<prefix>.bin`, keyed on a digest of the address, so checking
+    whether an address is taken also reads a single shard. Display names
+    are not indexed, and looking one up scans every shard.
+
+    Shards are swapped in whole on every write, and the `cache_size` most
+    recently read are kept parsed and checked against the file on each
+    read, so reads take no lock. Writes lock only the shards they touch,
+    with a byte range lock per shard on a shared `.lock` file, waiting at
+    most `lock_timeout` seconds. A crash between rewriting a user shard
+    and an email shard can leave the email index behind, which
+    `rebuild_indexes()` repairs. A rename across two shards writes the
+    new record first, so a crash part way leaves the user under both
+    names rather than neither.
+    '''
+
+    # field lengths are stored in two bytes
+    max_field_bytes = 0xFFFF
+
+    def __init__(self, path: str, prefix_length: int = 2,
+                 lock_timeout: float = 5.0, unique_email: bool = True,
+                 cache_size: int = 256) -> None:
+        '''
+        Opens the store, creating the directory if not present.
+
+        `prefix_length` only applies to a new store, an existing one
+        keeps the layout it was created with.
+        '''
+
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.unique_email = unique_email
+        self.cache_size = cache_size
+
+        for kind in SHARD_MAGIC:
+            os.makedirs(os.path.join(path, kind), exist_ok=True)
+
+        # the layout is fixed by whoever creates the store first
+        layout_path = os.path.join(path, 'layout.json')
+        temp_path = f'{layout_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as layout_file:
+            json.dump({'format': 1, 'prefix_length': prefix_length},
+                layout_file)
+        try:
+            os.link(temp_path, layout_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+        with open(layout_path, 'r') as layout_file:
+            self.prefix_length = json.load(layout_file)['prefix_length']
+        self.shard_count = 16 ** self.prefix_length
+
+        # parsed shards, least recently used first
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # lock shared with other processes, and threads in this one
+        self._lock_file = open(os.path.join(path, '.lock'), 'a')
+        self._thread_locks = {}
+
+        return
+
+    def _user_shard(self, username_hash: str) -> int:
+        '''
+        Returns the shard a user is kept in.
+        '''
+
+        return int(username_hash[:self.prefix_length], 16)
+
+    def _email_shard(self, digest: bytes) -> int:
+        '''
+        Returns the shard an email digest is indexed in.
+        '''
+
+        return int(digest.hex()[:self.prefix_length], 16)
+
+    def _shard_path(self, kind: str, index: int) -> str:
+        '''
+        Returns the file a shard is kept in.
+        '''
+
+        return os.path.join(
+            self.path,
+            kind,
+            f'{index:0{self.prefix_length}x}.bin'
+        )
+
+    @contextmanager
+    def _locked(self, *lock_ids: int):
+        '''
+        Holds the locks of some shards, taken in order, raising
+        `StoreLockTimeout` if they cannot all be taken within
+        `lock_timeout` seconds.
+
+        User shards are locked by their index and email shards by their
+        index after every user shard. Callers must take user shards
+        before email shards, so locks are always taken in one order.
+        '''
+
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.lock_timeout
+        held = []
+
+        try:
+            for lock_id in sorted(set(lock_ids)):
+                with self._cache_lock:
+                    thread_lock = self._thread_locks.setdefault(
+                        lock_id,
+                        threading.Lock()
+                    )
+                if not thread_lock.acquire(
+                    timeout=max(0.0, deadline - time.monotonic())
+                ):
+                    raise StoreLockTimeout(f'Timed out waiting for {self.path}')
+                held.append((lock_id, thread_lock, False))
+
+                # advisory lock is not available on every platform
+                if fcntl is not None:
+                    while True:
+                        try:
+                            fcntl.lockf(
+                                self._lock_file,
+                                fcntl.LOCK_EX | fcntl.LOCK_NB,
+                                1,
+                                lock_id
+                            )
+                            break
+                        except OSError:
+                            if time.monotonic() >= deadline:
+                                raise StoreLockTimeout(
+                                    f'Timed out waiting for {self.path}'
+                                )
+                            time.sleep(0.005)
+                    held[-1] = (lock_id, thread_lock, True)
+
+            if metrics.enabled:
+                metrics.observe(
+                    'store_lock_wait_seconds',
+                    time.perf_counter() - started
+                )
+
+            yield
+        finally:
+            for lock_id, thread_lock, file_locked in reversed(held):
+                if file_locked:
+                    fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, lock_id)
+                thread_lock.release()
+
+        return
+
+    def _read(self, kind: str, index: int, fresh: bool = False) -> dict:
+        '''
+        Returns the contents of a shard, parsing it only if it has changed
+        since it was cached.
+
+        The returned dict is shared and must not be mutated, unless
+        `fresh` is given, which always reads the file and returns a
+        private copy for changing under the shard's lock.
+        '''
+
+        shard_path = self._shard_path(kind, index)
+        signature = shard_signature(shard_path)
+
+        if not fresh:
+            with self._cache_lock:
+                cached = self._cache.get(shard_path)
+                if cached is not None and cached[0] == signature:
+                    self._cache.move_to_end(shard_path)
+                    return cached[1]
+
+        try:
+            with open(shard_path, 'rb') as shard_file:
+                contents = parse_shard(kind, shard_file.read())
+        except FileNotFoundError:
+            contents = {}
+
+        if not fresh:
+            self._remember(shard_path, signature, contents)
+
+        return contents
+
+    def _remember(self, shard_path: str, signature: tuple | None,
+                  contents: dict) -> None:
+        '''
+        Caches the contents of a shard, forgetting the least recently used
+        once there are more than `cache_size`.
+        '''
+
+        with self._cache_lock:
+            self._cache[shard_path] = (signature, contents)
+            self._cache.move_to_end(shard_path)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return
+
+    def _write(self, kind: str, index: int, contents: dict) -> None:
+        '''
+        Replaces a shard in a single step.
+
+        Must be called with the shard's lock held.
+        '''
+
+        shard_path = self._shard_path(kind, index)
+        temp_path = f'{shard_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as shard_file:
+            shard_file.write(pack_shard(kind, contents))
+            shard_file.flush()
+            os.fsync(shard_file.fileno())
+        os.replace(temp_path, shard_path)
+
+        self._remember(shard_path, shard_signature(shard_path), contents)
+
+        return
+
+    def _change(self, username_hashes, decide,
+                skip_taken_emails: bool = False) -> list[str]:
+        '''
+        Changes some users, only reading and rewriting the shards holding
+        them and their email addresses.
+
+        `decide` is given the current record of each user, or `None`, and
+        returns the record to store for each user to change, or `None` to
+        delete them. It may raise to abandon the change.
+
+        Raises `DuplicateEmailError` if a change would give a user an
+        email address used by another, or with `skip_taken_emails` leaves
+        that change out and returns the users left out.
+        '''
+
+        started = time.perf_counter()
+        user_shards = {
+            self._user_shard(username_hash) for username_hash in username_hashes
+        }
+        skipped = []
+
+        with ExitStack() as stack:
+            stack.enter_context(self._locked(*user_shards))
+            shards = {
+                index: self._read('users', index, fresh=True)
+                for index in user_shards
+            }
+            current = {
+                username_hash:
+                    shards[self._user_shard(username_hash)].get(username_hash)
+                for username_hash in username_hashes
+            }
+            changes = decide(current)
+
+            # email index entries to move, as (old, new) digests
+            moves = {}
+            for username_hash, record in changes.items():
+                old_record = current.get(username_hash)
+                old_digest = None if old_record is None else email_digest(
+                    old_record.email_address
+                )
+                new_digest = None if record is None else email_digest(
+                    record.email_address
+                )
+                if old_digest != new_digest:
+                    moves[username_hash] = (old_digest, new_digest)
+
+            email_shards = {
+                self._email_shard(digest)
+                for digests in moves.values() for digest in digests
+                if digest is not None
+            }
+            stack.enter_context(self._locked(*(
+                self.shard_count + index for index in email_shards
+            )))
+            emails = {
+                index: self._read('emails', index, fresh=True)
+                for index in email_shards
+            }
+
+            # refuse addresses already taken, in the store or the batch,
+            # other than by users this change removes, as in a rename
+            if self.unique_email:
+                removed = {
+                    username_hash for username_hash, record in changes.items()
+                    if record is None
+                }
+                claimed = {}
+                for username_hash, (_, new_digest) in list(moves.items()):
+                    if new_digest is None:
+                        continue
+                    owners = emails[self._email_shard(new_digest)].get(
+                        new_digest,
+                        set()
+                    )
+                    if owners - removed - {username_hash} or claimed.get(
+                        new_digest,
+                        username_hash
+                    ) != username_hash:
+                        if not skip_taken_emails:
+                            raise DuplicateEmailError(
+                                changes[username_hash].email_address
+                            )
+                        skipped.append(username_hash)
+                        del changes[username_hash], moves[username_hash]
+                        continue
+                    claimed[new_digest] = username_hash
+
+            # apply the changes and write out what they touched, in the
+            # order of the changes
+            changed_users = {}
+            for username_hash, record in changes.items():
+                index = self._user_shard(username_hash)
+                if record is None:
+                    shards[index].pop(username_hash, None)
+                else:
+                    shards[index][username_hash] = record
+                changed_users[index] = None
+
+            changed_emails = set()
+            for username_hash, (old_digest, new_digest) in moves.items():
+                if old_digest is not None:
+                    index = self._email_shard(old_digest)
+                    owners = emails[index].get(old_digest, set())
+                    owners.discard(username_hash)
+                    if not owners:
+                        emails[index].pop(old_digest, None)
+                    changed_emails.add(index)
+                if new_digest is not None:
+                    index = self._email_shard(new_digest)
+                    emails[index].setdefault(new_digest, set()).add(
+                        username_hash
+                    )
+                    changed_emails.add(index)
+
+            for index in changed_users:
+                self._write('users', index, shards[index])
+            for index in changed_emails:
+                self._write('emails', index, emails[index])
+
+        if metrics.enabled:
+            metrics.observe(
+                'store_write_seconds',
+                time.perf_counter() - started,
+                backend='sharded'
+            )
+            metrics.increment(
+                'store_written_events_total',
+                len(changes),
+                backend='sharded'
+            )
+
+        return skipped
+
+    def get(self, username_hash: str) -> UserRecord | None:
+        record = self._read('users', self._user_shard(username_hash)).get(
+            username_hash
+        )
+
+        return None if record is None else record.replace()
+
+    def exists(self, username_hash: str) -> bool:
+        return username_hash in self._read(
+            'users',
+            self._user_shard(username_hash)
+        )
+
+    def insert(self, username_hash: str, record: UserRecord) -> None:
+        def decide(current: dict) -> dict:
+            if current[username_hash] is not None:
+                raise RecordExistsError(username_hash)
+
+            return {
+                username_hash:
+                    stored_record(record, None, self.max_field_bytes)
+            }
+
+        self._change([username_hash], decide)
+
+        return
+
+    def insert_many(self, records: list[tuple[str, UserRecord]],
+                    replace: bool = False) -> list[str]:
+        skipped = []
+
+        def decide(current: dict) -> dict:
+            changes = {}
+            for username_hash, record in records:
+                # a user repeated within the batch is only added once
+                if not replace and (
+                    current[username_hash] is not None
+                    or username_hash in changes
+                ):
+                    skipped.append(username_hash)
+                    continue
+                changes[username_hash] = stored_record(
+                    record,
+                    current[username_hash],
+                    self.max_field_bytes
+                )
+
+            return changes
+
+        skipped += self._change(
+            [username_hash for username_hash, _ in records],
+            decide,
+            skip_taken_emails=True
+        )
+
+        return skipped
+
+    def put(self, username_hash: str, record: UserRecord,
+            expected_version: int | None = None) -> None:
+        def decide(current: dict) -> dict:
+            check_version(username_hash, current[username_hash],
+                expected_version)
+
+            return {
+                username_hash: stored_record(
+                    record,
+                    current[username_hash],
+                    self.max_field_bytes
+                )
+            }
+
+        self._change([username_hash], decide)
+
+        return
+
+    def update(self, username_hash: str, expected_version: int | None = None,
+               **fields: str) -> None:
+        # only allow known fields
+        unknown = set(fields) - set(RECORD_FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+
+        def decide(current: dict) -> dict:
+            record = current[username_hash]
+            if record is None:
+                raise KeyError(username_hash)
+            check_version(username_hash, record, expected_version)
+
+            # merge while locked so concurrent field changes are kept
+            return {
+                username_hash: stored_record(
+                    record.replace(**fields),
+                    record,
+                    self.max_field_bytes
+                )
+            }
+
+        self._change([username_hash], decide)
+
+        return
+
+    def delete(self, username_hash: str,
+               expected_version: int | None = None) -> None:
+        def decide(current: dict) -> dict:
+            check_version(username_hash, current[username_hash],
+                expected_version)
+
+            if current[username_hash] is None:
+                return {}
+
+            return {username_hash: None}
+
+        self._change([username_hash], decide)
+
+        return
+
+    def rename(self, username_hash: str, new_username_hash: str,
+               expected_version: int | None = None) -> None:
+        def decide(current: dict) -> dict:
+            record = current[username_hash]
+            if record is None:
+                raise KeyError(username_hash)
+            check_version(username_hash, record, expected_version)
+            if current[new_username_hash] is not None:
+                raise RecordExistsError(new_username_hash)
+
+            # the new record first, so its shard is written first
+            return {
+                new_username_hash: stored_record(record, record),
+                username_hash: None
+            }
+
+        self._change([username_hash, new_username_hash], decide)
+
+        return
+
+    def find_by_email(self, email_address: str) -> str | None:
+        digest = email_digest(email_address)
+        owners = self._read('emails', self._email_shard(digest)).get(digest)
+
+        return min(owners) if owners else None
+
+    def rebuild_indexes(self) -> None:
+        with self._locked(*range(2 * self.shard_count)):
+            emails = {index: {} for index in range(self.shard_count)}
+            for index in range(self.shard_count):
+                shard = self._read('users', index, fresh=True)
+                for username_hash, record in shard.items():
+                    digest = email_digest(record.email_address)
+                    emails[self._email_shard(digest)].setdefault(
+                        digest,
+                        set()
+                    ).add(username_hash)
+
+            for index, contents in emails.items():
+                self._write('emails', index, contents)
+
+        return
+
+    def keys(self) -> list[str]:
+        return [
+            username_hash
+            for index in range(self.shard_count)
+            for username_hash in self._read('users', index)
+        ]
+
+    def items(self):
+        for index in range(self.shard_count):
+            for username_hash, record in self._read('users', index).items():
+                yield username_hash, record.replace()
+
+        return
+
+    def close(self) -> None:
+        self._lock_file.close()
+
+        return
+
+    def __len__(self) -> int:
+        return sum(
+            len(self._read('users', index)) for index in range(self.shard_count)
+        )
+
+
+def open_store(path: str) -> CredentialStore:
+    '''
+    Opens the backend matching the file extension of `path`.
+
+    `.db`, `.sqlite` and `.sqlite3` files use SQLite, `.shards`
+    directories use the sharded binary format, anything else is treated
+    as a JSON file.
+    '''
+
+    match os.path.splitext(path.rstrip(os.sep))[1].lower():
+        case '.db' | '.sqlite' | '.sqlite3':
+            return SQLiteCredentialStore(path)
+        case '.shards':
+            return ShardedCredentialStore(path)
+        case _:
+            return JSONCredentialStore(path)
@@ -0,0 +1,193 @@
+'''
+# Tenants
+
+Separate user namespaces for several applications sharing the login
+feature, each tenant having its own store file so one tenant's users,
+and the size of its file, never touch another's.
+
+A `TenantRegistry` places each tenant's store in one of its root
+directories, chosen by a hash of the tenant name, so tenants can be
+spread across directories or disks. Stores are opened on first use and
+only the `max_open` most recently used are kept open. Closing one also
+drops its parsed data from the process cache, so memory follows the
+tenants in use rather than every tenant ever seen.
+'''
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha256
+
+from metrics import metrics
+from store import CredentialStore, open_store, userdata_cache
+
+
+# letters, digits, `-` and `_`, so a name is always a safe file name
+TENANT_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def check_tenant(tenant: str) -> str:
+    '''
+    Returns a tenant name, raising `ValueError` if it is not allowed.
+    '''
+
+    if not isinstance(tenant, str) or not TENANT_PATTERN.fullmatch(tenant):
+        raise ValueError(f'Invalid tenant name: {tenant!r}')
+
+    return tenant
+
+
+class TenantRegistry:
+    '''
+    Collection of methods for finding and opening the store of each
+    tenant.
+
+    `roots` is a directory, or a list of them, to keep stores in, and
+    `extension` picks the backend of new stores the same way as
+    `store.open_store()`. A tenant already stored under any root is
+    found there, so roots can be added without moving existing tenants.
+
+    Stores handed out by `acquire()` stay open until given back with
+    `release()`. Past `max_open` open stores, the least recently used
+    that nobody holds are closed.
+    '''
+
+    def __init__(self, roots: str | list[str], extension: str = '.json',
+                 max_open: int = 16) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.roots = [roots] if isinstance(roots, str) else list(roots)
+        if not self.roots:
+            raise ValueError('At least one root directory is needed')
+        self.extension = extension
+        self.max_open = max_open
+
+        # open stores and how many holders each has, least recently used
+        # first
+        self._stores = OrderedDict()
+        self._holders = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def path(self, tenant: str) -> str:
+        '''
+        Returns where a tenant's store is kept.
+        '''
+
+        file_name = f'{check_tenant(tenant)}{self.extension}'
+
+        # an existing store wins, wherever it is
+        if len(self.roots) > 1:
+            for root in self.roots:
+                path = os.path.join(root, file_name)
+                if os.path.exists(path):
+                    return path
+
+        digest = sha256(tenant.encode()).digest()
+        index = int.from_bytes(digest[:8], 'little') % len(self.roots)
+
+        return os.path.join(self.roots[index], file_name)
+
+    def acquire(self, tenant: str) -> CredentialStore:
+        '''
+        Returns a tenant's store, opening it if needed, and holds it open
+        until `release()` is called.
+        '''
+
+        with self._lock:
+            store = self._stores.get(tenant)
+            if store is None:
+                # roots are created as they are first used
+                path = self.path(tenant)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                store = open_store(path)
+                self._stores[tenant] = store
+                metrics.increment('tenant_stores_opened_total')
+            self._stores.move_to_end(tenant)
+            self._holders[tenant] = self._holders.get(tenant, 0) + 1
+            self._evict()
+
+        return store
+
+    def release(self, tenant: str) -> None:
+        '''
+        Gives back a store from `acquire()`, closing it if it is over the
+        limit of open stores.
+        '''
+
+        with self._lock:
+            holders = self._holders.get(tenant, 0) - 1
+            if holders > 0:
+                self._holders[tenant] = holders
+            else:
+                self._holders.pop(tenant, None)
+            self._evict()
+
+        return
+
+    @contextmanager
+    def store(self, tenant: str):
+        '''
+        Holds a tenant's store open for the `with` block.
+        '''
+
+        store = self.acquire(tenant)
+        try:
+            yield store
+        finally:
+            self.release(tenant)
+
+        return
+
+    def _evict(self) -> None:
+        '''
+        Closes the least recently used stores nobody holds, until no more
+        than `max_open` are open.
+
+        Must be called with the lock held.
+        '''
+
+        excess = len(self._stores) - self.max_open
+        for tenant in list(self._stores):
+            if excess <= 0:
+                break
+            if tenant in self._holders:
+                continue
+
+            self._close(self._stores.pop(tenant))
+            metrics.increment('tenant_stores_evicted_total')
+            excess -= 1
+
+        return
+
+    @staticmethod
+    def _close(store: CredentialStore) -> None:
+        '''
+        Closes a store and forgets any data cached for it.
+        '''
+
+        store.close()
+        userdata_cache.invalidate(store.path)
+
+        return
+
+    def close(self) -> None:
+        '''
+        Closes every open store, held or not.
+        '''
+
+        with self._lock:
+            for store in self._stores.values():
+                self._close(store)
+            self._stores.clear()
+            self._holders.clear()
+
+        return
+
+    def __len__(self) -> int:
+        return len(self._stores)
@@ -0,0 +1,43 @@
+'''
+Shared fixtures for the tests, which import the project modules from the
+repository root.
+'''
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from hashing import PasswordHasher
+
+
+# meets every rule of the default validation policy
+PASSWORD = 'Tr0ub4dor&3xyz!'
+
+
+@pytest.fixture
+def hasher():
+    '''
+    A hasher cheap enough to run many times.
+    '''
+
+    hasher = PasswordHasher('scrypt', {'ln': 4})
+    yield hasher
+    hasher.close()
+
+
+@pytest.fixture(params=['users.json', 'users.db', 'users.shards'])
+def store(request, tmp_path):
+    '''
+    An empty store of each backend.
+    '''
+
+    from store import open_store, userdata_cache
+
+    store = open_store(str(tmp_path / request.param))
+    yield store
+    store.close()
+    userdata_cache.invalidate()
@@ -0,0 +1,34 @@
+'''
+Finding users whose password is in a list.
+'''
+
+from hashlib import sha256
+
+from audit import audit_passwords
+from store import UserRecord
+
+from conftest import PASSWORD
+
+
+def test_salted_and_legacy_hashes_are_matched(store, hasher):
+    store.insert('a' * 64, UserRecord(hasher.hash(PASSWORD), 'A',
+        'a@example.com'))
+    store.insert('b' * 64, UserRecord(sha256(b'Legacy1!').hexdigest(), 'B',
+        'b@example.com'))
+    store.insert('c' * 64, UserRecord(hasher.hash('Unlisted1!'), 'C',
+        'c@example.com'))
+    store.insert('d' * 64, UserRecord('not a hash', 'D', 'd@example.com'))
+
+    found = dict(audit_passwords(
+        store,
+        ['Legacy1!', PASSWORD, 'Other1!'],
+        workers=2
+    ))
+
+    assert found == {'a' * 64: PASSWORD, 'b' * 64: 'Legacy1!'}
+
+
+def test_no_candidates_finds_nothing(store):
+    store.insert('a' * 64, UserRecord('a' * 64, 'A', 'a@example.com'))
+
+    assert list(audit_passwords(store, [])) == []
@@ -0,0 +1,129 @@
+'''
+Account rules of `AuthService`, run against a JSON store.
+'''
+
+import pytest
+
+from auth import AuthService, hash_username
+from changefeed import ChangeFeed
+from ratelimit import RateLimiter
+from sessions import SessionManager
+from store import open_store, userdata_cache
+
+from conftest import PASSWORD
+
+
+@pytest.fixture
+def auth(tmp_path, hasher):
+    store = open_store(str(tmp_path / 'users.json'))
+    auth = AuthService(
+        store,
+        hasher,
+        SessionManager(),
+        RateLimiter(capacity=3),
+        feed=ChangeFeed()
+    )
+    yield auth
+    store.close()
+    userdata_cache.invalidate()
+
+
+def test_register_and_authenticate(auth):
+    result = auth.register('alice', 'Alice', 'alice@example.com', PASSWORD)
+    assert result.ok
+    assert result.profile == {
+        'display_name': 'Alice',
+        'email_address': 'alice@example.com'
+    }
+
+    result = auth.authenticate('alice', PASSWORD)
+    assert result.ok
+    assert auth.resume(result.token).username_hash == hash_username('alice')
+
+    assert auth.authenticate('alice', 'Wr0ng-password').code \
+        == 'password_incorrect'
+    assert auth.authenticate('bob', PASSWORD).code == 'account_missing'
+
+
+def test_register_refuses_taken_and_invalid_values(auth):
+    auth.register('alice', 'Alice', 'alice@example.com', PASSWORD)
+
+    assert auth.register('alice', 'A', 'a@example.com', PASSWORD).code \
+        == 'account_exists'
+    assert auth.register('bob', 'Bob', 'ALICE@example.com', PASSWORD).code \
+        == 'email_taken'
+    assert auth.register('bob', 'Bob', 'bob', PASSWORD).code \
+        == 'email_invalid'
+    assert auth.register('bob', 'Bob', 'bob@example.com', 'short').code \
+        == 'password_short'
+    assert auth.register('', 'Bob', 'bob@example.com', PASSWORD).code \
+        == 'username_blank'
+
+
+def test_update_profile_refuses_non_text(auth):
+    username_hash = auth.register('alice', 'Alice', 'alice@example.com',
+        PASSWORD).username_hash
+
+    assert auth.update_profile(username_hash, display_name=5).code \
+        == 'field_invalid'
+    result = auth.update_profile(username_hash, display_name='Ali')
+    assert result.profile['display_name'] == 'Ali'
+
+
+def test_change_password_ends_sessions(auth):
+    username_hash = auth.register('alice', 'Alice', 'alice@example.com',
+        PASSWORD).username_hash
+    token = auth.authenticate('alice', PASSWORD).token
+
+    assert auth.change_password(username_hash, 'Wr0ng-password',
+        'N3w-password!').code == 'password_incorrect'
+    assert auth.change_password(username_hash, PASSWORD,
+        'N3w-password!').ok
+
+    assert auth.resume(token).code == 'session_invalid'
+    assert auth.authenticate('alice', 'N3w-password!').ok
+
+
+def test_rename_keeps_sessions(auth):
+    auth.register('alice', 'Alice', 'alice@example.com', PASSWORD)
+    result = auth.authenticate('alice', PASSWORD)
+
+    renamed = auth.rename(result.username_hash, 'alicia')
+    assert renamed.username_hash == hash_username('alicia')
+    assert auth.resume(result.token).username_hash == renamed.username_hash
+    assert auth.authenticate('alicia', PASSWORD).ok
+
+
+def test_failed_attempts_are_rate_limited(auth):
+    auth.register('alice', 'Alice', 'alice@example.com', PASSWORD)
+
+    for _ in range(3):
+        auth.authenticate('alice', 'Wr0ng-password', client='10.0.0.1')
+
+    assert auth.authenticate('alice', PASSWORD, client='10.0.0.2').code \
+        == 'rate_limited'
+
+
+def test_local_users_do_not_share_a_client_bucket(auth):
+    auth.register('alice', 'Alice', 'alice@example.com', PASSWORD)
+    auth.register('bob', 'Bob', 'bob@example.com', PASSWORD)
+
+    for _ in range(3):
+        auth.authenticate('alice', 'Wr0ng-password', client=None)
+
+    assert auth.authenticate('bob', PASSWORD, client=None).ok
+
+
+def test_changes_are_published(auth):
+    events = []
+    auth.feed.subscribe(events.append)
+
+    username_hash = auth.register('alice', 'Alice', 'alice@example.com',
+        PASSWORD).username_hash
+    auth.update_profile(username_hash, email_address='ali@example.com')
+    auth.rename(username_hash, 'alicia')
+
+    assert [event['type'] for event in events] \
+        == ['signup', 'profile', 'rename']
+    assert events[1]['fields'] == ['email_address']
+    assert events[2]['new_user'] == hash_username('alicia')
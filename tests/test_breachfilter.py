@@ -0,0 +1,49 @@
+'''
+Building and querying breach filters.
+'''
+
+import io
+from hashlib import sha1
+
+import pytest
+
+from breachfilter import BreachFilter, build_filter, read_keys
+from validation import ValidationPolicy
+
+from conftest import PASSWORD
+
+
+def test_listed_passwords_are_always_found(tmp_path):
+    path = str(tmp_path / 'breached.bloom')
+    listed = [f'Passw0rd{index}' for index in range(2000)]
+    assert build_filter(path, read_keys(listed), len(listed)) == 2000
+
+    breach_filter = BreachFilter(path)
+    assert all(password in breach_filter for password in listed)
+
+    # others are only reported at about the error rate
+    others = sum(f'Other{index}' in breach_filter for index in range(2000))
+    assert others < 20
+    breach_filter.close()
+
+
+def test_hashed_lists_are_read(tmp_path):
+    path = str(tmp_path / 'breached.bloom')
+    lines = io.StringIO(
+        f'{sha1(PASSWORD.encode()).hexdigest().upper()}:42\n\n'
+    )
+    build_filter(path, read_keys(lines, hashed=True), 1)
+
+    breach_filter = BreachFilter(path)
+    assert PASSWORD in breach_filter
+    policy = ValidationPolicy(breach_filter=breach_filter)
+    assert policy.validate_password(PASSWORD) == 'password_breached'
+    breach_filter.close()
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / 'not-a-filter'
+    path.write_bytes(b'LBF1' + bytes(40))
+
+    with pytest.raises(ValueError):
+        BreachFilter(str(path))
@@ -0,0 +1,89 @@
+'''
+Bulk import and export of users.
+'''
+
+import io
+
+from auth import hash_username
+from bulk import export_users, import_users, read_rows
+from changefeed import ChangeFeed
+from store import ShardedCredentialStore
+
+from conftest import PASSWORD
+
+
+def signup_row(name: str, **fields) -> dict:
+    return {
+        'username': name,
+        'display_name': name.title(),
+        'email_address': f'{name}@example.com',
+        'password': PASSWORD
+    } | fields
+
+
+def test_import_reports_each_row(store, hasher):
+    store_events = []
+    feed = ChangeFeed()
+    feed.subscribe(store_events.append)
+
+    report = import_users(store, hasher, [
+        signup_row('alice'),
+        signup_row('bob', email_address='not an address'),
+        signup_row('carol', email_address='alice@example.com'),
+        signup_row('dave', display_name=5),
+        signup_row('alice'),
+        signup_row('erin')
+    ], chunk_size=4, feed=feed)
+
+    assert report.imported == 2
+    assert report.skipped == 1
+    assert report.invalid == [(2, 'email_invalid'), (4, 'field_invalid')]
+    assert report.email_taken == [3]
+
+    # only the users stored are announced
+    assert [event['user'] for event in store_events] \
+        == [hash_username('alice'), hash_username('erin')]
+
+
+def test_exported_rows_import_into_another_store(store, hasher, tmp_path):
+    import_users(store, hasher, [signup_row('alice'), signup_row('bob')])
+    exported = io.StringIO()
+    assert export_users(store, exported, 'csv') == 2
+
+    copy = ShardedCredentialStore(str(tmp_path / 'copy.shards'))
+    exported.seek(0)
+    report = import_users(copy, hasher, read_rows(exported, 'csv'))
+
+    assert report.imported == 2
+    assert copy.get(hash_username('alice')) == store.get(hash_username('alice'))
+    copy.close()
+
+
+def test_exported_rows_are_checked(store, hasher):
+    rows = [
+        {'username_hash': 'not hex', 'password': 'a' * 64,
+            'display_name': 'A', 'email_address': 'a@example.com'},
+        {'username_hash': 'b' * 64, 'password': 'plain text',
+            'display_name': 'B', 'email_address': 'b@example.com'},
+        {'username_hash': 'c' * 64, 'password': 'c' * 64,
+            'display_name': 'C', 'email_address': 'c@example.com'}
+    ]
+
+    report = import_users(store, hasher, rows)
+
+    assert report.invalid == [(1, 'username_invalid'), (2, 'password_invalid')]
+    assert store.exists('c' * 64)
+
+
+def test_long_row_is_rejected_alone(tmp_path, hasher):
+    store = ShardedCredentialStore(str(tmp_path / 'users.shards'))
+
+    report = import_users(store, hasher, [
+        signup_row('alice'),
+        signup_row('bob', display_name='x' * 70_000)
+    ])
+
+    assert report.imported == 1
+    assert report.invalid == [(2, 'field_too_long')]
+    assert store.find_by_email('alice@example.com') == hash_username('alice')
+    store.close()
@@ -0,0 +1,64 @@
+'''
+Publishing to and reading from the change feed.
+'''
+
+from changefeed import ChangeFeed, read_changes
+
+
+def test_subscribers_get_events_in_order():
+    feed = ChangeFeed()
+    events = []
+    feed.subscribe(events.append)
+
+    feed.publish('signup', 'alice', ['display_name'])
+    feed.publish('rename', 'alice', new_user='alicia')
+    feed.unsubscribe(events.append)
+    feed.publish('profile', 'alicia')
+
+    assert [event['seq'] for event in events] == [1, 2]
+    assert events[1]['new_user'] == 'alicia'
+
+
+def test_failing_subscriber_does_not_stop_the_change():
+    feed = ChangeFeed()
+    feed.subscribe(lambda event: 1 / 0)
+
+    assert feed.publish('signup', 'alice')['seq'] == 1
+
+
+def test_feed_file_is_read_from_an_offset(tmp_path):
+    path = str(tmp_path / 'users.changes')
+    feed = ChangeFeed(path)
+    for name in ('alice', 'bob', 'carol'):
+        feed.publish('signup', name)
+    feed.close()
+
+    events, offset = read_changes(path, limit=2)
+    assert [event['user'] for event in events] == ['alice', 'bob']
+
+    events, offset = read_changes(path, offset)
+    assert [event['user'] for event in events] == ['carol']
+    assert read_changes(path, offset) == ([], offset)
+
+
+def test_sequence_carries_on_across_writers(tmp_path):
+    path = str(tmp_path / 'users.changes')
+    first = ChangeFeed(path)
+    second = ChangeFeed(path)
+
+    first.publish('signup', 'alice')
+    second.publish('signup', 'bob')
+    first.publish('signup', 'carol')
+    first.close()
+    second.close()
+
+    # a line left half written by a crash is dropped by the next write
+    with open(path, 'a') as feed_file:
+        feed_file.write('{"seq": 4, "ty')
+    feed = ChangeFeed(path)
+    feed.publish('signup', 'dave')
+    feed.close()
+
+    events, _ = read_changes(path)
+    assert [event['seq'] for event in events] == [1, 2, 3, 4]
+    assert events[-1]['user'] == 'dave'
@@ -0,0 +1,38 @@
+'''
+Password hashing schemes and the hasher pool.
+'''
+
+from hashlib import sha256
+
+import pytest
+
+from hashing import (LEGACY_SCHEME, PasswordHasher, hash_password,
+                     hash_scheme, verify_password)
+
+
+@pytest.mark.parametrize('scheme, params', [
+    ('scrypt', {'ln': 4, 'r': 8, 'p': 1}),
+    ('pbkdf2-sha256', {'i': 1000})
+])
+def test_hashes_verify_and_record_their_scheme(scheme, params):
+    stored_hash = hash_password('Secret1!', scheme, params)
+
+    assert verify_password('Secret1!', stored_hash)
+    assert not verify_password('Secret2!', stored_hash)
+    assert hash_scheme(stored_hash) == (scheme, params)
+    # salted, so the same password never hashes the same
+    assert stored_hash != hash_password('Secret1!', scheme, params)
+
+
+def test_legacy_hashes_verify_and_need_rehashing(hasher):
+    legacy_hash = sha256(b'Secret1!').hexdigest()
+
+    assert verify_password('Secret1!', legacy_hash)
+    assert hash_scheme(legacy_hash)[0] == LEGACY_SCHEME
+    assert hasher.needs_rehash(legacy_hash)
+    assert not hasher.needs_rehash(hasher.hash('Secret1!'))
+
+
+def test_unknown_scheme_is_refused():
+    with pytest.raises(ValueError):
+        PasswordHasher('md5')
@@ -0,0 +1,135 @@
+'''
+Interactive `Login` flows, driven by a `ScriptedInterface`.
+'''
+
+import pytest
+
+import login
+from auth import hash_username
+from changefeed import ChangeFeed
+from store import userdata_cache
+
+from conftest import PASSWORD
+
+
+@pytest.fixture
+def path(tmp_path):
+    yield str(tmp_path / 'users.json')
+    userdata_cache.invalidate()
+
+
+def run(path: str, hasher, answers: list, method: str = 'login',
+        strict: bool = True) -> login.Login:
+    interface = login.ScriptedInterface(answers, strict=strict)
+    login_obj = login.Login(path=path, hasher=hasher, interface=interface)
+    getattr(login_obj, method)()
+    login_obj.close()
+
+    # every answer was used
+    assert not interface.pending()
+
+    return login_obj
+
+
+def sign_up(path: str, hasher) -> login.Login:
+    return run(path, hasher, [
+        'alice', 'Alice', 'alice@example.com', PASSWORD, PASSWORD
+    ], 'signup')
+
+
+def test_signup_then_login(path, hasher):
+    assert sign_up(path, hasher).current_user == hash_username('alice')
+
+    login_obj = run(path, hasher, ['alice', PASSWORD])
+    assert login_obj.current_user == hash_username('alice')
+
+
+def test_signup_asks_again_for_bad_values(path, hasher):
+    sign_up(path, hasher)
+
+    login_obj = run(path, hasher, [
+        'alice', 'bob',
+        'Bob',
+        'bob', 'alice@example.com', 'bob@example.com',
+        'short', PASSWORD, 'mismatch', PASSWORD, PASSWORD
+    ], 'signup', strict=False)
+    assert login_obj.current_user == hash_username('bob')
+    assert login_obj.InterfaceObj.errors() == [
+        'Account already exists, please use a different name.',
+        'Email is invalid, please try again.',
+        'Email is already in use, please use a different one.',
+        'Password must be 8 or more characters, please try again.',
+        'Passwords do not match, please try again.'
+    ]
+
+
+def test_login_stops_after_too_many_attempts(path, hasher):
+    sign_up(path, hasher)
+
+    login_obj = run(path, hasher, ['alice', 'a', 'b', 'c'], strict=False)
+    assert login_obj.current_user is None
+    assert login_obj.InterfaceObj.errors()[-1] \
+        == 'Too many incorrect attempts. Exiting progam.'
+
+
+def test_account_options_change_the_profile(path, hasher):
+    sign_up(path, hasher)
+
+    interface = login.ScriptedInterface([
+        'alice', PASSWORD,
+        1, 2, 'Ali', 3, 'ali@example.com', 1, 'alicia', 5, 3
+    ], strict=True)
+    login_obj = login.Login(path=path, hasher=hasher, interface=interface)
+    login_obj.login()
+    login_obj.main_menu()
+
+    assert login_obj.current_user == hash_username('alicia')
+    assert login_obj.auth.get_profile(login_obj.current_user).profile == {
+        'display_name': 'Ali',
+        'email_address': 'ali@example.com'
+    }
+    login_obj.close()
+
+
+def test_password_change_checks_the_current_password_once(path, hasher,
+                                                          monkeypatch):
+    sign_up(path, hasher)
+    checks = []
+    verify = hasher.verify
+
+    def counted_verify(*args, **kwargs):
+        checks.append(args)
+        return verify(*args, **kwargs)
+
+    interface = login.ScriptedInterface([
+        'alice', PASSWORD,
+        1, 4, 'wrong', 'N3w&Secret!', 'N3w&Secret!', PASSWORD, 5, 3
+    ], strict=False)
+    login_obj = login.Login(path=path, hasher=hasher, interface=interface)
+    login_obj.login()
+    monkeypatch.setattr(hasher, 'verify', counted_verify)
+    login_obj.main_menu()
+    login_obj.close()
+
+    # the new password is asked for once, and each attempt hashes once
+    assert not interface.pending()
+    assert len(checks) == 2
+    assert interface.errors() == ['Password is incorrect, please try again.']
+    assert run(path, hasher, ['alice', 'N3w&Secret!']).current_user \
+        == hash_username('alice')
+
+
+def test_close_leaves_what_was_given_open(store, hasher, tmp_path):
+    feed = ChangeFeed(str(tmp_path / 'users.changes'))
+    interface = login.ScriptedInterface([
+        'alice', 'Alice', 'alice@example.com', PASSWORD, PASSWORD
+    ], strict=True)
+    login_obj = login.Login(store, hasher, interface=interface, feed=feed)
+    login_obj.signup()
+    login_obj.close()
+
+    # still usable by the caller, who closes them
+    assert store.get(hash_username('alice')).display_name == 'Alice'
+    assert hasher.verify(PASSWORD, store.get(hash_username('alice')).password)
+    assert feed._feed_file is not None
+    feed.close()
@@ -0,0 +1,51 @@
+'''
+Recording and exporting metrics.
+'''
+
+import json
+
+from metrics import Metrics, MetricsExporter
+
+
+class Greeter:
+    def greet(self, name: str) -> str:
+        return f'Hello {name}'
+
+
+def test_nothing_is_recorded_until_enabled():
+    registry = Metrics()
+    registry.increment('calls_total')
+    assert registry.snapshot()['counters'] == {}
+
+    registry.enable()
+    registry.increment('calls_total', method='get')
+    registry.increment('calls_total', 2, method='get')
+    registry.observe('call_seconds', 0.003)
+
+    snapshot = registry.snapshot()
+    assert snapshot['counters'] == {'calls_total{method="get"}': 3}
+    assert snapshot['histograms']['call_seconds']['count'] == 1
+    assert snapshot['histograms']['call_seconds']['buckets']['0.005'] == 1
+
+
+def test_instrumented_methods_are_timed():
+    registry = Metrics()
+    registry.enable()
+    registry.instrument(Greeter, 'greeter_seconds')
+
+    assert Greeter().greet('Alice') == 'Hello Alice'
+    assert 'greeter_seconds{method="greet"}' \
+        in registry.snapshot()['histograms']
+
+
+def test_exporter_writes_prometheus_and_json(tmp_path):
+    registry = Metrics()
+    registry.enable()
+    registry.increment('calls_total')
+
+    for name in ('metrics.prom', 'metrics.jsonl'):
+        MetricsExporter(registry, str(tmp_path / name), interval=60).close()
+
+    assert 'calls_total 1' in (tmp_path / 'metrics.prom').read_text()
+    line = (tmp_path / 'metrics.jsonl').read_text().splitlines()[-1]
+    assert json.loads(line)['counters'] == {'calls_total': 1}
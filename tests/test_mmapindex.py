@@ -0,0 +1,26 @@
+'''
+The mapped record index of JSON snapshots.
+'''
+
+from mmapindex import MappedIndex, write_index
+
+
+def test_every_entry_is_found(tmp_path):
+    path = str(tmp_path / 'users.json.index')
+    entries = [(f'{index:064x}', index * 100, 90) for index in range(1, 1000)]
+    write_index(path, entries, (123, 456))
+
+    index = MappedIndex.open(path)
+    assert index.signature == (123, 456)
+    for username_hash, offset, length in entries:
+        assert index.lookup(username_hash) == (offset, length)
+    assert index.lookup('f' * 64) is None
+    index.close()
+
+
+def test_missing_or_damaged_index_is_not_used(tmp_path):
+    path = tmp_path / 'users.json.index'
+    assert MappedIndex.open(str(path)) is None
+
+    path.write_bytes(b'LFI1' + bytes(100))
+    assert MappedIndex.open(str(path)) is None
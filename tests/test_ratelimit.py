@@ -0,0 +1,36 @@
+'''
+Token buckets for failed attempts.
+'''
+
+from ratelimit import RateLimiter
+
+
+def test_keys_lock_after_capacity_and_reset():
+    limiter = RateLimiter(capacity=2, refill_time=60)
+
+    limiter.consume('user')
+    assert limiter.retry_after('user') == 0
+    limiter.consume('user', 'client')
+    assert 59 < limiter.retry_after('user') <= 60
+    assert limiter.retry_after('client') == 0
+
+    limiter.reset('user')
+    assert limiter.retry_after('user', 'client') == 0
+
+
+def test_buckets_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'users.ratelimit')
+    limiter = RateLimiter(capacity=1, path=path)
+    limiter.consume('user')
+    limiter.close()
+
+    assert RateLimiter(capacity=1, path=path).retry_after('user') > 0
+
+
+def test_only_recent_keys_are_kept():
+    limiter = RateLimiter(capacity=1, max_keys=2)
+    for key in ('first', 'second', 'third'):
+        limiter.consume(key)
+
+    assert limiter.retry_after('first') == 0
+    assert limiter.retry_after('third') > 0
@@ -0,0 +1,108 @@
+'''
+Requests to the HTTP server, through `LoginServer.respond()`.
+'''
+
+import asyncio
+import json
+
+import pytest
+
+from auth import AuthService
+from server import LoginServer
+from sessions import SessionManager
+from store import open_store, userdata_cache
+
+from conftest import PASSWORD
+
+
+@pytest.fixture
+def server(tmp_path, hasher):
+    store = open_store(str(tmp_path / 'users.json'))
+    server = LoginServer(AuthService(store, hasher, SessionManager()))
+    yield server
+    server.close()
+    store.close()
+    userdata_cache.invalidate()
+
+
+def post(server: LoginServer, path: str, body) -> tuple[int, dict]:
+    return asyncio.run(server.respond(
+        'POST',
+        path,
+        json.dumps(body).encode(),
+        '127.0.0.1'
+    ))
+
+
+def signup(server: LoginServer, **fields) -> tuple[int, dict]:
+    return post(server, '/signup', {
+        'username': 'alice',
+        'display_name': 'Alice',
+        'email_address': 'alice@example.com',
+        'password': PASSWORD
+    } | fields)
+
+
+def test_signup_login_and_logout(server):
+    assert signup(server)[0] == 200
+    assert signup(server)[1]['code'] == 'account_exists'
+
+    status, payload = post(server, '/login',
+        {'username': 'alice', 'password': PASSWORD})
+    assert status == 200
+    token = payload['token']
+
+    status, payload = post(server, '/account', {'token': token})
+    assert payload['profile']['display_name'] == 'Alice'
+
+    post(server, '/logout', {'token': token})
+    assert post(server, '/account', {'token': token})[0] == 401
+
+
+def test_non_text_fields_are_refused_everywhere(server):
+    status, payload = signup(server, username=None)
+    assert payload['code'] == 'username_blank'
+
+    status, payload = signup(server, display_name=5)
+    assert (status, payload['code']) == (400, 'field_invalid')
+    assert post(server, '/login',
+        {'username': 'alice', 'password': 1})[1]['code'] == 'field_invalid'
+    assert post(server, '/logout', {'token': []})[1]['code'] \
+        == 'field_invalid'
+
+    # a missing display name is blank rather than "None"
+    signup(server, display_name=None)
+    status, payload = post(server, '/account',
+        {'username': 'alice', 'password': PASSWORD})
+    assert payload['profile']['display_name'] == ''
+    assert post(server, '/account', {'username': 'alice',
+        'password': PASSWORD, 'email_address': 7})[1]['code'] \
+        == 'field_invalid'
+
+
+def test_account_changes(server):
+    signup(server)
+
+    status, payload = post(server, '/account', {
+        'username': 'alice',
+        'password': PASSWORD,
+        'new_password': 'N3w-password!',
+        'display_name': 'Ali'
+    })
+    assert status == 200
+    assert payload['profile']['display_name'] == 'Ali'
+    # a changed password ends the session it was changed in
+    assert payload['token'] is None
+
+    assert post(server, '/login',
+        {'username': 'alice', 'password': PASSWORD})[0] == 401
+    assert post(server, '/login',
+        {'username': 'alice', 'password': 'N3w-password!'})[0] == 200
+
+
+def test_bad_requests(server):
+    assert asyncio.run(server.respond('POST', '/login', b'[1]', 'c'))[0] \
+        == 400
+    assert asyncio.run(server.respond('GET', '/login', b'', 'c'))[0] == 405
+    assert asyncio.run(server.respond('POST', '/nowhere', b'', 'c'))[0] \
+        == 404
@@ -0,0 +1,101 @@
+'''
+Session tokens, in one process and shared through a saved log.
+'''
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sessions import SessionManager
+
+
+def test_tokens_validate_until_revoked():
+    sessions = SessionManager()
+    token = sessions.issue('alice')
+
+    assert sessions.validate(token) == 'alice'
+    sessions.revoke(token)
+    assert sessions.validate(token) is None
+
+
+def test_forged_and_expired_tokens_are_refused():
+    sessions = SessionManager(ttl=1, slot_size=1)
+    token = sessions.issue('alice')
+
+    session_id, expires, signature = token.split('.')
+    assert sessions.validate(f'{session_id}.{int(expires) + 60}.{signature}') \
+        is None
+    assert sessions.validate(f'{token}x') is None
+
+    time.sleep(2.1)
+    assert sessions.validate(token) is None
+
+    # expired sessions are evicted as the wheel turns
+    sessions.issue('bob')
+    assert len(sessions) == 1
+
+
+def test_revoke_user_and_rename_user():
+    sessions = SessionManager()
+    first = sessions.issue('alice')
+    second = sessions.issue('alice')
+    other = sessions.issue('bob')
+
+    sessions.rename_user('bob', 'robert')
+    assert sessions.validate(other) == 'robert'
+
+    sessions.revoke_user('alice')
+    assert sessions.validate(first) is None
+    assert sessions.validate(second) is None
+
+
+def test_saved_sessions_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'sessions.log')
+    sessions = SessionManager(path=path)
+    kept = sessions.issue('alice')
+    revoked = sessions.issue('bob')
+    sessions.revoke(revoked)
+    sessions.close()
+
+    sessions = SessionManager(path=path)
+    assert sessions.validate(kept) == 'alice'
+    assert sessions.validate(revoked) is None
+    sessions.close()
+
+
+def test_managers_sharing_a_log_see_each_others_changes(tmp_path):
+    path = str(tmp_path / 'sessions.log')
+    first = SessionManager(path=path)
+    second = SessionManager(path=path)
+
+    token = first.issue('alice')
+    assert second.validate(token) == 'alice'
+
+    other = second.issue('bob')
+    SessionManager(path=path).revoke(other)
+    assert second.validate(other) is None
+
+    # a manager starting up rewrites the log under the others
+    SessionManager(path=path).close()
+    later = first.issue('carol')
+    assert second.validate(later) == 'carol'
+    assert second.validate(token) == 'alice'
+
+    first.close()
+    second.close()
+
+
+def load_key(path: str) -> bytes:
+    sessions = SessionManager(path=path)
+    key = sessions._key
+    sessions.close()
+
+    return key
+
+
+def test_racing_processes_share_one_key(tmp_path):
+    path = str(tmp_path / 'sessions.log')
+
+    with ProcessPoolExecutor(4) as pool:
+        keys = set(pool.map(load_key, [path] * 16))
+
+    assert len(keys) == 1
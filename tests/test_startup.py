@@ -0,0 +1,46 @@
+'''
+Startup of `login.py`, held to `STARTUP_BUDGET` by `--check`.
+'''
+
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+LOGIN = os.path.join(ROOT, 'login.py')
+
+
+def test_check_starts_within_budget(tmp_path):
+    result = subprocess.run(
+        [sys.executable, LOGIN, '--check', '--store',
+            str(tmp_path / 'users.json')],
+        capture_output=True,
+        text=True,
+        timeout=60
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith('OK: started in')
+    # nothing is created by a check
+    assert os.listdir(tmp_path) == []
+
+
+def test_check_loads_no_project_modules(tmp_path):
+    code = (
+        'import sys, login\n'
+        'login.main(["--check", "--store", sys.argv[1]])\n'
+        'print(",".join(name for name in ("auth", "store", "changefeed", '
+        '"validation", "hashing", "json", "hashlib") '
+        'if name in sys.modules))\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code, str(tmp_path / 'users.json')],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        timeout=60
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-1] == ''
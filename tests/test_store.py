@@ -0,0 +1,162 @@
+'''
+Behaviour shared by every `CredentialStore` backend, and the parts
+particular to the JSON and sharded ones.
+'''
+
+import pytest
+
+from store import (ConflictError, DuplicateEmailError, FieldTooLongError,
+                   JSONCredentialStore, RecordExistsError,
+                   ShardedCredentialStore, UserRecord, userdata_cache)
+
+
+def user(index: int) -> str:
+    return f'{index:064x}'
+
+
+def record(index: int, **fields: str) -> UserRecord:
+    return UserRecord(
+        fields.get('password', 'a' * 64),
+        fields.get('display_name', f'User {index}'),
+        fields.get('email_address', f'user{index}@example.com')
+    )
+
+
+def test_insert_get_and_versions(store):
+    store.insert(user(1), record(1))
+
+    stored = store.get(user(1))
+    assert stored.display_name == 'User 1'
+    assert stored.version == 1
+    assert store.exists(user(1))
+    assert store.get(user(2)) is None
+
+    store.update(user(1), display_name='Renamed')
+    assert store.get(user(1)).display_name == 'Renamed'
+    assert store.get(user(1)).version == 2
+
+
+def test_insert_refuses_existing_user_and_taken_email(store):
+    store.insert(user(1), record(1))
+
+    with pytest.raises(RecordExistsError):
+        store.insert(user(1), record(2))
+    with pytest.raises(DuplicateEmailError):
+        store.insert(user(2), record(2, email_address='USER1@example.com'))
+
+
+def test_expected_version_guards_writes(store):
+    store.insert(user(1), record(1))
+
+    with pytest.raises(ConflictError):
+        store.update(user(1), expected_version=5, display_name='Late')
+    store.update(user(1), expected_version=1, display_name='On time')
+    assert store.get(user(1)).display_name == 'On time'
+
+
+def test_rename_moves_record_and_email(store):
+    store.insert(user(1), record(1))
+    store.rename(user(1), user(2))
+
+    assert store.get(user(1)) is None
+    assert store.get(user(2)).display_name == 'User 1'
+    assert store.find_by_email('user1@example.com') == user(2)
+
+
+def test_delete_frees_email(store):
+    store.insert(user(1), record(1))
+    store.delete(user(1))
+
+    assert not store.exists(user(1))
+    assert store.find_by_email('user1@example.com') is None
+    store.insert(user(2), record(2, email_address='user1@example.com'))
+
+
+def test_insert_many_skips_existing_and_taken(store):
+    store.insert(user(1), record(1))
+
+    skipped = store.insert_many([
+        (user(1), record(1)),
+        (user(2), record(2)),
+        (user(3), record(3, email_address='user2@example.com')),
+        (user(4), record(4))
+    ])
+
+    assert sorted(skipped) == [user(1), user(3)]
+    assert len(store) == 3
+    assert store.find_by_email('user2@example.com') == user(2)
+
+
+def test_non_text_fields_are_refused(store):
+    with pytest.raises(TypeError):
+        store.insert(user(1), record(1, display_name=5))
+    assert not store.exists(user(1))
+
+
+def test_sharded_store_refuses_long_fields_before_writing(tmp_path):
+    store = ShardedCredentialStore(str(tmp_path / 'users.shards'))
+    records = [(user(index), record(index)) for index in range(50)]
+    records.append((user(50), record(50, display_name='x' * 70_000)))
+
+    with pytest.raises(FieldTooLongError):
+        store.insert_many(records)
+
+    # nothing was written, so no user is left without their email entry
+    assert len(store) == 0
+    assert store.find_by_email('user1@example.com') is None
+    store.close()
+
+
+def test_json_store_reads_one_record_without_loading(tmp_path):
+    path = str(tmp_path / 'users.json')
+    store = JSONCredentialStore(path)
+    store.insert_many([(user(index), record(index)) for index in range(10)])
+    store.compact()
+    store.update(user(3), display_name='Changed')
+    store.close()
+    userdata_cache.invalidate()
+
+    store = JSONCredentialStore(path)
+    # read from the snapshot through the index, and from the journal
+    assert store.get(user(5)).display_name == 'User 5'
+    assert store.get(user(3)).display_name == 'Changed'
+    assert not userdata_cache.holds(path)
+    store.close()
+    userdata_cache.invalidate()
+
+
+def test_json_store_loads_once_journal_is_long(tmp_path):
+    path = str(tmp_path / 'users.json')
+    store = JSONCredentialStore(path, lookup_journal_bytes=0)
+    store.insert(user(1), record(1))
+    store.close()
+    userdata_cache.invalidate()
+
+    store = JSONCredentialStore(path, lookup_journal_bytes=0)
+    assert store.get(user(1)).display_name == 'User 1'
+    assert userdata_cache.holds(path)
+    store.close()
+    userdata_cache.invalidate()
+
+
+def test_json_store_compaction_is_amortised(tmp_path, monkeypatch):
+    store = JSONCredentialStore(str(tmp_path / 'users.json'))
+    dumps = []
+    dump = store._dump
+    monkeypatch.setattr(store, '_dump', lambda data: (
+        dumps.append(len(data)),
+        dump(data)
+    ))
+
+    for start in range(0, 8000, 1000):
+        store.insert_many([
+            (user(index), record(index))
+            for index in range(start, start + 1000)
+        ])
+
+    # the journal is only folded in once it holds as many events as
+    # there are users, never on a fixed size, so an import is not
+    # rewriting the snapshot chunk after chunk
+    assert len(dumps) <= 2
+    store.close()
+    userdata_cache.invalidate()
@@ -0,0 +1,60 @@
+'''
+Per tenant stores and the registry keeping them open.
+'''
+
+import os
+
+import pytest
+
+from store import UserRecord
+from tenants import TenantRegistry, check_tenant
+
+
+def test_tenant_names_are_checked():
+    assert check_tenant('shop-eu_1') == 'shop-eu_1'
+    for name in ('', '../etc', 'a b', 'x' * 65, None):
+        with pytest.raises(ValueError):
+            check_tenant(name)
+
+
+def test_tenants_are_kept_apart(tmp_path):
+    registry = TenantRegistry(str(tmp_path))
+
+    with registry.store('shop') as store:
+        store.insert('a' * 64, UserRecord('p', 'Shop user', 'a@example.com'))
+    with registry.store('blog') as store:
+        assert not store.exists('a' * 64)
+        # the same address may be used by each tenant
+        store.insert('b' * 64, UserRecord('p', 'Blog user', 'a@example.com'))
+
+    assert os.path.exists(tmp_path / 'shop.json')
+    registry.close()
+
+
+def test_tenants_are_spread_over_roots_and_found_again(tmp_path):
+    roots = [str(tmp_path / f'root{index}') for index in range(4)]
+    registry = TenantRegistry(roots)
+
+    paths = {registry.path(f'tenant{index}') for index in range(32)}
+    assert {os.path.dirname(path) for path in paths} == set(roots)
+
+    # an existing store is found under whichever root holds it
+    os.makedirs(roots[0], exist_ok=True)
+    open(os.path.join(roots[0], 'moved.json'), 'w').close()
+    assert registry.path('moved') == os.path.join(roots[0], 'moved.json')
+
+
+def test_least_recently_used_stores_are_closed(tmp_path):
+    registry = TenantRegistry(str(tmp_path), max_open=2)
+
+    held = registry.acquire('first')
+    for name in ('second', 'third', 'fourth'):
+        with registry.store(name):
+            pass
+
+    # held stores stay open past the limit, others are closed
+    assert len(registry) == 2
+    held.insert('a' * 64, UserRecord('p', 'Still open', 'a@example.com'))
+    registry.release('first')
+    registry.close()
+    assert len(registry) == 0
@@ -0,0 +1,33 @@
+'''
+Rules for usernames, email addresses and passwords.
+'''
+
+from validation import ValidationPolicy, default_policy
+
+
+def test_passwords_are_checked_in_order():
+    assert default_policy.validate_password('Sh0rt!') == 'password_short'
+    assert default_policy.validate_password('lowercase1') \
+        == 'password_no_upper'
+    assert default_policy.validate_password('UPPERCASE1') \
+        == 'password_no_lower'
+    assert default_policy.validate_password('NoNumbers') \
+        == 'password_no_number'
+    assert default_policy.validate_password('Correct1') is None
+
+
+def test_rules_can_be_relaxed():
+    policy = ValidationPolicy(min_password_length=4, require_upper=False,
+        require_number=False)
+
+    assert policy.validate_password('word') is None
+
+
+def test_first_error_is_reported():
+    assert default_policy.validate('', 'bad', 'bad') == 'username_blank'
+    assert default_policy.validate('alice', 'bad', 'bad') == 'email_invalid'
+    assert default_policy.validate(email_address='a@example.com') is None
+    assert default_policy.validate_many([
+        {'username': 'alice', 'password': 'Correct1'},
+        {'username': 'bob', 'password': 'weak'}
+    ]) == [None, 'password_short']
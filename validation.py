@@ -0,0 +1,127 @@
+'''
+# Validation
+
+Rules for the usernames, email addresses and passwords users may choose,
+shared by signup, the account options, the server and bulk imports so a
+value is accepted or refused the same way everywhere.
+
+Each check returns `None` for a valid value or an error code, one of the
+keys of `auth.MESSAGES`, for the first rule it breaks.
+'''
+
+import re
+
+
+# loose shape of an email address, anything more is left to the mail
+EMAIL_PATTERN = r'[^@]+@[^@]+\.[^@]+'
+
+
+class ValidationPolicy:
+    '''
+    Collection of methods checking user supplied values against a set of
+    rules, compiled once when the policy is made.
+
+    Passwords must be at least `min_password_length` characters and, as
+    required, hold an uppercase letter, a lowercase letter and something
+    other than a letter. Given a `breachfilter.BreachFilter`, passwords
+    found in it are refused too. Email addresses must match
+    `email_pattern` in full.
+    '''
+
+    def __init__(self, min_password_length: int = 8,
+                 require_upper: bool = True, require_lower: bool = True,
+                 require_number: bool = True,
+                 email_pattern: str = EMAIL_PATTERN,
+                 breach_filter: 'BreachFilter | None' = None) -> None:
+        '''
+        Initialises the object.
+        '''
+
+        self.min_password_length = min_password_length
+        self.require_upper = require_upper
+        self.require_lower = require_lower
+        self.require_number = require_number
+        self.email_pattern = email_pattern
+        self.breach_filter = breach_filter
+
+        # bound once, so a check costs no pattern cache lookup
+        self._email_match = re.compile(email_pattern).fullmatch
+
+        return
+
+    def validate_username(self, username: str) -> str | None:
+        '''
+        Returns an error code if a username is not allowed.
+        '''
+
+        if not username:
+            return 'username_blank'
+
+        return None
+
+    def validate_email(self, email_address: str) -> str | None:
+        '''
+        Returns an error code if an email address is not valid.
+        '''
+
+        if self._email_match(email_address) is None:
+            return 'email_invalid'
+
+        return None
+
+    def validate_password(self, password: str) -> str | None:
+        '''
+        Returns an error code if a password does not meet the requirements.
+        '''
+
+        # case mapping runs in C, which beats a Python loop over the
+        # characters for passwords of any sensible length
+        if len(password) < self.min_password_length:
+            return 'password_short'
+        elif self.require_upper and password.lower() == password:
+            return 'password_no_upper'
+        elif self.require_lower and password.upper() == password:
+            return 'password_no_lower'
+        elif self.require_number and password.isalpha():
+            return 'password_no_number'
+        # checked last, as it hashes the password
+        elif self.breach_filter is not None and password in self.breach_filter:
+            return 'password_breached'
+
+        return None
+
+    def validate(self, username: str | None = None,
+                 email_address: str | None = None,
+                 password: str | None = None) -> str | None:
+        '''
+        Returns the error code of the first invalid value, checked in the
+        order signup asks for them. Values left as `None` are not checked.
+        '''
+
+        if username is not None:
+            error = self.validate_username(username)
+            if error:
+                return error
+        if email_address is not None:
+            error = self.validate_email(email_address)
+            if error:
+                return error
+        if password is not None:
+            return self.validate_password(password)
+
+        return None
+
+    def validate_many(self, rows) -> list[str | None]:
+        '''
+        Checks many sets of values at once, each a dict of the keyword
+        arguments to `validate()`, returning the error code or `None` for
+        each in order.
+        '''
+
+        validate = self.validate
+
+        return [validate(**row) for row in rows]
+
+
+# rules used unless a caller is given its own policy
+default_policy = ValidationPolicy()